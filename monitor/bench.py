@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: MIT
+# Throughput benchmarks for interact.py, run against the emulator or a real board.
+#
+# Usage: python3 ./bench.py [--baud 115200] [--latency 0.004] [benchmark...]
+#        python3 ./bench.py --device /dev/ttyUSB0 write_file read32
+#        python3 ./bench.py --save before.json; python3 ./bench.py --compare before.json
+
+import argparse, atexit, contextlib, io, json, os, subprocess, sys, tempfile, time
+import emulator, interact
+
+KiB = 1 << 10
+
+class CountingLolmon(interact.Lolmon):
+    def __init__(self, device):
+        super().__init__(device)
+        self.submitted = 0
+
+    # Count the commands as issued by callers, before any batching
+
+    def submit(self, *args, **kwargs):
+        self.submitted += 1
+        return super().submit(*args, **kwargs)
+
+    def run_command(self, *args, **kwargs):
+        self.submitted += 1
+        return super().run_command(*args, **kwargs)
+
+    def enter_command(self, *args, **kwargs):
+        self.submitted += 1
+        return super().enter_command(*args, **kwargs)
+
+# Each benchmark returns the number of payload bytes it moved
+
+def bench_write_file(l, args):
+    data = os.urandom(args.size)
+    with tempfile.NamedTemporaryFile() as f:
+        f.write(data)
+        f.flush()
+        l.write_file(args.ram, f.name)
+    return len(data)
+
+def bench_write32(l, args):
+    # Long lines of words, typed ahead while the previous line runs
+    l.write32(args.ram, list(range(args.size // 4)))
+    return args.size
+
+def bench_read32(l, args):
+    for i in range(args.count):
+        l.read32(args.ram + 4 * i)
+    return 4 * args.count
+
+def bench_memset(l, args):
+    l.memset(args.ram, 0x55, args.size)
+    return args.size
+
+def bench_dump32(l, args):
+    with contextlib.redirect_stdout(io.StringIO()):
+        l.dump32(args.ram, args.size // 4)
+    return args.size
+
+def bench_riu(l, args):
+    emac = interact.EMAC(l)
+    for _ in range(args.count // 40):
+        emac.mystery_init_sequence()
+    return 0
+
+BENCHMARKS = {
+    'write_file': bench_write_file,
+    'write32': bench_write32,
+    'read32': bench_read32,
+    'memset': bench_memset,
+    'dump32': bench_dump32,
+    'riu': bench_riu,
+}
+
+def run(l, names, args):
+    results = {}
+    for name in names:
+        l.submitted = 0
+        start = time.monotonic()
+        nbytes = BENCHMARKS[name](l, args)
+        l.wait()
+        seconds = time.monotonic() - start
+        results[name] = {
+            'seconds': seconds,
+            'bytes_per_s': nbytes / seconds,
+            'commands_per_s': l.submitted / seconds,
+        }
+        print(f'{name:12} {seconds:8.3f} s {nbytes / seconds:10.0f} B/s {l.submitted / seconds:8.1f} cmd/s')
+    return results
+
+def compare(results, baseline, tolerance):
+    regressed = False
+    for name, r in results.items():
+        if name not in baseline:
+            continue
+        change = baseline[name]['seconds'] / r['seconds'] - 1
+        status = ''
+        if change < -tolerance:
+            status = '  REGRESSION'
+            regressed = True
+        print(f'{name:12} {change * 100:+7.1f}% speed{status}')
+    return not regressed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the throughput of the lolmon protocol')
+    parser.add_argument('benchmarks', nargs='*', help=f'benchmarks to run: {", ".join(BENCHMARKS)} (default: all)')
+    parser.add_argument('--device', help='serial port of a real board (default: start an emulator)')
+    parser.add_argument('--host', action='store_true',
+                        help='run the host build of the monitor (make monitor-host) instead of the emulator')
+    parser.add_argument('--baud', type=int, default=115200, help='emulated baud rate, 0 for unlimited')
+    parser.add_argument('--latency', type=float, default=0.004, help='emulated output latency in seconds')
+    parser.add_argument('--echo-errors', type=float, default=0, help='emulated probability of losing a character')
+    parser.add_argument('--seed', type=int, default=0, help='seed for error injection')
+    parser.add_argument('--rx-fifo', type=int, help='emulated RX FIFO size, to provoke overruns')
+    parser.add_argument('--ram', type=lambda x: int(x, 0), default=0x81000000, help='scratch RAM address')
+    parser.add_argument('--size', type=lambda x: int(x, 0), default=16*KiB, help='size of block transfers')
+    parser.add_argument('--count', type=int, default=200, help='number of commands in command bursts')
+    parser.add_argument('--save', help='save results to a JSON file')
+    parser.add_argument('--compare', help='compare results against a JSON file saved earlier')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='slowdown that counts as a regression')
+    parser.add_argument('--metrics', action='store_true', help='print protocol metrics after the run')
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error(f'unknown benchmark {name}')
+
+    device = args.device
+    if not device and args.host:
+        monitor = subprocess.Popen([os.path.join(os.path.dirname(os.path.abspath(__file__)), 'monitor-host')],
+                                   stdout=subprocess.PIPE)
+        atexit.register(monitor.kill)
+        device = monitor.stdout.readline().decode().strip()
+    elif not device:
+        device, _ = emulator.start(baud=args.baud, latency=args.latency,
+                                   echo_errors=args.echo_errors, seed=args.seed, rx_fifo=args.rx_fifo)
+    l = CountingLolmon(device)
+    l.flush()
+
+    results = run(l, args.benchmarks or list(BENCHMARKS), args)
+    if args.metrics:
+        print(l.metrics.table())
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if not compare(results, baseline, args.tolerance):
+            sys.exit(1)
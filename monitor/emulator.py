@@ -0,0 +1,590 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: MIT
+# Software emulation of lolmon, served on a pseudo terminal, so that interact.py
+# can be used and measured without a board.
+#
+# Usage: python3 ./emulator.py [--baud 115200] [--latency 0.004] [--echo-errors 0.001]
+#        python3 -i ./interact.py /dev/pts/N
+
+import argparse, lzma, os, queue, random, select, struct, sys, threading, time, tty, zlib
+
+MiB = 1 << 20
+
+# Binary transfer framing, see monitor.c
+FRAME_MAX = 1024
+FRAME_ACK = 0x06
+FRAME_NAK = 0x15
+
+# Size of the UART FIFOs; output is passed to the host in pieces of this size
+UART_FIFO_MAX = 64
+
+# The UART, as far as the baud rate is concerned: 16550-style registers, 8 bytes apart
+UART_BASE = 0xbf201300
+UART_DLL = 0x00
+UART_DLM = 0x08
+UART_LCR = 0x18
+UART_LSR = 0x28
+UART_LCR_DLAB = 0x80
+UART_LSR_THRE = 0x20
+UART_LSR_TEMT = 0x40
+UART_CLOCK = 172800000
+
+# How long pb/ph/pw wait for a value, in seconds
+POLL_TIMEOUT = 1
+
+# Probability of losing a received character above the reliable baud rate
+OVERSPEED_ERRORS = 0.01
+
+# SPI flash, and how long it takes to access it through the ISP controller
+FLASH_SIZE = 16*MiB
+FLASH_SECTOR = 4096
+FLASH_READ_RATE = 1*MiB     # bytes per second
+FLASH_ERASE_TIME = 0.03     # per sector
+FLASH_PROGRAM_TIME = 0.001  # per 256-byte page
+
+class Timeout(Exception):
+    pass
+
+class UsageError(Exception):
+    pass
+
+class Memory:
+    """
+    RAM, visible at 0x80000000 (KSEG0) and 0xa0000000 (KSEG1).
+    Everything else is treated as MMIO registers that simply hold their value.
+    """
+    def __init__(self, ram_size=64*MiB):
+        self.ram = bytearray(ram_size)
+        self.mmio = {}
+
+    def ram_offset(self, addr, size):
+        offset = addr & 0x1fffffff
+        if addr & 0xc0000000 == 0x80000000 and offset + size <= len(self.ram):
+            return offset
+        return None
+
+    def read_bytes(self, addr, size):
+        offset = self.ram_offset(addr, size)
+        if offset is not None:
+            return bytes(self.ram[offset:offset+size])
+        return bytes(self.mmio.get(self.mmio_key(addr + i), 0) for i in range(size))
+
+    def write_bytes(self, addr, data):
+        offset = self.ram_offset(addr, len(data))
+        if offset is not None:
+            self.ram[offset:offset+len(data)] = data
+            return
+        for i, x in enumerate(data):
+            self.mmio[self.mmio_key(addr + i)] = x
+
+    def mmio_key(self, addr):
+        # While DLAB is set, the divisor latch takes the place of the UART's first two registers
+        if addr in (UART_BASE + UART_DLL, UART_BASE + UART_DLM) and self.dlab():
+            return ('DL', addr)
+        return addr
+
+    def dlab(self):
+        return self.mmio.get(UART_BASE + UART_LCR, 0) & UART_LCR_DLAB
+
+    def divisor(self):
+        return self.mmio.get(('DL', UART_BASE + UART_DLL), 0) | self.mmio.get(('DL', UART_BASE + UART_DLM), 0) << 8
+
+    def read(self, addr, size):
+        return int.from_bytes(self.read_bytes(addr, size), 'little')
+
+    def write(self, addr, size, value):
+        self.write_bytes(addr, (value & ((1 << 8 * size) - 1)).to_bytes(size, 'little'))
+
+class Emulator:
+    def __init__(self, fd, baud=115200, latency=0, echo_errors=0, seed=None, max_baud=None, rx_fifo=None,
+                 flash=None):
+        self.fd = fd
+        self.baud = baud                # simulated line speed, None/0 for unlimited
+        self.latency = latency          # delay before output reaches the host
+        self.echo_errors = echo_errors  # probability that a received character is lost
+        self.max_baud = max_baud        # fastest baud rate without extra errors
+        self.rx_fifo = rx_fifo          # characters buffered while a command runs, None for unlimited
+        self.random = random.Random(seed)
+        self.mem = Memory()
+        self.flash = bytearray(flash or b'') + b'\xff' * (FLASH_SIZE - len(flash or b''))
+        self.flash_erases = 0
+        self.cache_syncs = []           # the ranges of each sync and call, or None for all of RAM
+        self.uart_baud = baud or 115200
+        divisor = round(UART_CLOCK / (16 * self.uart_baud))
+        self.mem.write(UART_BASE + UART_LCR, 1, 0x03 | UART_LCR_DLAB)
+        self.mem.write(UART_BASE + UART_DLL, 1, divisor)
+        self.mem.write(UART_BASE + UART_DLM, 1, divisor >> 8)
+        self.mem.write(UART_BASE + UART_LCR, 1, 0x03)
+        self.bootscript = b''
+        self.rx = bytearray()
+        self.rx_clock = self.tx_clock = 0
+        self.txq = queue.Queue()
+        threading.Thread(target=self.write_loop, daemon=True).start()
+
+    # Console I/O
+
+    def throttle(self, clock, n):
+        # Advance a virtual line clock by n characters and wait for it to catch up
+        if not self.baud:
+            return clock
+        now = time.monotonic()
+        clock = max(clock, now) + n * 10 / self.baud
+        if clock - now > 0.001:
+            time.sleep(clock - now)
+        return clock
+
+    def update_uart(self):
+        # Follow changes of the baud rate divisor, once the divisor latch is closed again
+        if self.mem.dlab():
+            return
+        divisor = self.mem.divisor()
+        if divisor:
+            self.uart_baud = UART_CLOCK // (16 * divisor)
+            if self.baud:
+                self.baud = self.uart_baud
+
+    def error_rate(self):
+        if self.max_baud and self.uart_baud > self.max_baud:
+            return max(self.echo_errors, OVERSPEED_ERRORS)
+        return self.echo_errors
+
+    def write_loop(self):
+        while True:
+            t, data = self.txq.get()
+            delay = t + self.latency - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            for i in range(0, len(data), UART_FIFO_MAX):
+                chunk = data[i:i+UART_FIFO_MAX]
+                self.tx_clock = self.throttle(self.tx_clock, len(chunk))
+                os.write(self.fd, chunk)
+            self.txq.task_done()
+
+    def send(self, data):
+        if isinstance(data, str):
+            data = data.replace('\n', '\r\n').encode('ascii')
+        if self.mem.dlab():
+            # Output goes to the transmit register, which is DLL while DLAB is set
+            if data:
+                self.mem.write(UART_BASE + UART_DLL, 1, data[-1])
+            return
+        self.txq.put((time.monotonic(), bytes(data)))
+
+    def puts(self, s):
+        self.send(s + '\n')
+
+    def getc(self, timeout=None):
+        while not self.rx:
+            r, _, _ = select.select([self.fd], [], [], timeout)
+            if not r:
+                raise Timeout()
+            self.rx += os.read(self.fd, 4096)
+        ch = self.rx[0]
+        del self.rx[0]
+        self.rx_clock = self.throttle(self.rx_clock, 1)
+        return ch
+
+    def edit_line(self):
+        line = bytearray()
+        self.send('> ')
+        while True:
+            c = self.getc()
+            error_rate = self.error_rate()
+            if error_rate and self.random.random() < error_rate:
+                continue
+            if c in (0x08, 0x7f):
+                if line:
+                    del line[-1]
+                    self.send(b'\x08 \x08')
+            elif c == 0x15:
+                self.send(b'\x08 \x08' * len(line))
+                line.clear()
+            elif c in (0x0a, 0x0d):
+                self.send('\n')
+                return line.decode('ascii', errors='replace')
+            elif c >= 0x20 and len(line) < 127:
+                line.append(c)
+                self.send(bytes([c]))
+
+    def overrun(self):
+        # While a command ran, input piled up in the RX FIFO; whatever didn't fit is lost
+        if self.rx_fifo is None:
+            return
+        while select.select([self.fd], [], [], 0)[0]:
+            self.rx += os.read(self.fd, 4096)
+        del self.rx[self.rx_fifo:]
+
+    def run(self):
+        self.puts('Welcome to lolmon')
+        while True:
+            self.execute_line(self.edit_line())
+            self.overrun()
+
+    # Command interpreter
+
+    def execute_line(self, line):
+        for part in line.split('#')[0].split(';'):
+            argv = part.split(' ')
+            argv = [a for a in argv if a][:16]
+            if not argv:
+                return
+            if argv[0] not in self.commands:
+                self.puts(f'Unknown command {argv[0]}')
+                return
+            try:
+                self.commands[argv[0]][0](self, argv)
+            except UsageError:
+                self.puts('Usage error')
+            except ValueError:
+                pass
+            self.update_uart()
+
+    def source(self, script):
+        for line in script.replace(b'\r', b'\n').split(b'\n')[:-1]:
+            if len(line) >= 128:
+                self.puts(f'Line too long: {line[:127].decode("ascii", errors="replace")}')
+            else:
+                self.execute_line(line.decode('ascii', errors='replace'))
+
+    def parse_int(self, s, base=0):
+        try:
+            if base == 0:
+                return int(s[2:], 16) if s.startswith('0x') else int(s, 10)
+            return int(s, base)
+        except ValueError:
+            self.puts(f'Invalid number {s}')
+            raise
+
+    @staticmethod
+    def op_size(argv):
+        return {'b': 1, 'h': 2, 'w': 4}[argv[0][1]]
+
+    def cmd_help(self, argv):
+        for name in argv[1:]:
+            if name not in self.commands:
+                self.puts(f'Unknown command {name}')
+                return
+            _, arguments, description = self.commands[name]
+            self.puts(f'{name} - {description}')
+            self.puts(f'Usage: {name} {arguments}')
+        if len(argv) == 1:
+            for name, (_, _, description) in self.commands.items():
+                self.puts(f'{name} - {description}')
+
+    def cmd_echo(self, argv):
+        self.puts(''.join(a + ' ' for a in argv[1:]))
+
+    def cmd_read(self, argv):
+        size = self.op_size(argv)
+        per_line = 8 if size == 4 else 16
+        if len(argv) not in (2, 3):
+            raise UsageError()
+        elems = self.parse_int(argv[2]) if len(argv) == 3 else 1
+        addr = self.parse_int(argv[1], 16)
+        out = []
+        for i in range(elems):
+            if i % per_line == 0:
+                out.append(('\n' if i else '') + f'{addr:08x}:')
+            out.append(f' {self.mem.read(addr, size):0{2*size}x}')
+            addr += size
+        self.puts(''.join(out))
+
+    def cmd_write(self, argv):
+        size = self.op_size(argv)
+        if len(argv) < 3:
+            raise UsageError()
+        addr = self.parse_int(argv[1], 16)
+        for value in argv[2:]:
+            self.mem.write(addr, size, self.parse_int(value))
+            addr += size
+
+    def cmd_fill(self, argv):
+        size = self.op_size(argv)
+        if len(argv) not in (4, 5):
+            raise UsageError()
+        addr = self.parse_int(argv[1], 16)
+        count = self.parse_int(argv[2])
+        value = self.parse_int(argv[3])
+        step = self.parse_int(argv[4]) if len(argv) == 5 else 0
+        mask = (1 << 8 * size) - 1
+        self.mem.write_bytes(addr, b''.join(((value + i * step) & mask).to_bytes(size, 'little')
+                                            for i in range(count)))
+
+    def cmd_modify(self, argv):
+        size = self.op_size(argv)
+        if len(argv) != 4:
+            raise UsageError()
+        addr = self.parse_int(argv[1], 16)
+        mask = self.parse_int(argv[2])
+        value = self.parse_int(argv[3])
+        self.mem.write(addr, size, self.mem.read(addr, size) & ~mask | value & mask)
+
+    def read_register(self, addr, size):
+        # The line status register tells whether output is still on its way
+        if addr == UART_BASE + UART_LSR:
+            return UART_LSR_THRE | (0 if self.txq.unfinished_tasks else UART_LSR_TEMT)
+        return self.mem.read(addr, size)
+
+    def cmd_poll(self, argv):
+        size = self.op_size(argv)
+        if len(argv) != 4:
+            raise UsageError()
+        addr = self.parse_int(argv[1], 16)
+        mask = self.parse_int(argv[2])
+        value = self.parse_int(argv[3])
+        deadline = time.monotonic() + POLL_TIMEOUT
+        while self.read_register(addr, size) & mask != value & mask:
+            if time.monotonic() > deadline:
+                self.puts('Poll timeout')
+                return
+            time.sleep(0.001)
+
+    def cmd_copy(self, argv):
+        size = self.op_size(argv)
+        if len(argv) < 4:
+            raise UsageError()
+        src = self.parse_int(argv[1], 16)
+        dest = self.parse_int(argv[2], 16)
+        for i in range(self.parse_int(argv[3])):
+            self.mem.write(dest + i * size, size, self.mem.read(src + i * size, size))
+
+    def parse_ranges(self, argv):
+        if len(argv) % 2:
+            raise UsageError()
+        return [(self.parse_int(argv[i], 16), self.parse_int(argv[i + 1])) for i in range(0, len(argv), 2)]
+
+    def cmd_sync(self, argv):
+        self.cache_syncs.append(self.parse_ranges(argv[1:]) or None)
+
+    def cmd_call(self, argv):
+        if len(argv) < 2:
+            raise UsageError()
+        self.parse_int(argv[1], 16)
+        ranges = None
+        if '/' in argv:
+            ranges = self.parse_ranges(argv[argv.index('/') + 1:])
+        self.cache_syncs.append(ranges)
+        # The called function is assumed to return right away
+
+    def cmd_src(self, argv):
+        if len(argv) != 2:
+            raise UsageError()
+        addr = self.parse_int(argv[1], 16)
+        script = bytearray()
+        while (c := self.mem.read(addr + len(script), 1)) != 0:
+            script.append(c)
+        self.source(script)
+
+    def cmd_boot(self, argv):
+        if len(argv) != 1:
+            raise UsageError()
+        self.source(self.bootscript)
+
+    # Binary transfers
+
+    def recv(self, n):
+        return bytes(self.getc(0.1) for _ in range(n))
+
+    def recv_drain(self):
+        try:
+            while True:
+                self.getc(0.1)
+        except Timeout:
+            pass
+
+    def send_frame(self, payload):
+        self.send(struct.pack('<H', len(payload)) + payload + struct.pack('<I', zlib.crc32(payload)))
+
+    def recv_frame(self, addr, pos, length):
+        # The payload length, and whether it is new (see monitor.c), or None on error
+        size, = struct.unpack('<H', self.recv(2))
+        if size == 0:
+            return 0, False
+        offset, = struct.unpack('<I', self.recv(4))
+        if size > FRAME_MAX or offset > pos or size > length - offset:
+            return None
+        payload = self.recv(size)
+        crc, = struct.unpack('<I', self.recv(4))
+        if crc != zlib.crc32(payload, zlib.crc32(struct.pack('<I', offset))):
+            return None
+        if offset < pos:
+            return size, False
+        self.mem.write_bytes(addr + offset, payload)
+        return size, True
+
+    def cmd_bwrite(self, argv):
+        if len(argv) != 3:
+            raise UsageError()
+        addr = self.parse_int(argv[1], 16)
+        length = self.parse_int(argv[2])
+        pos = 0
+        self.send(bytes([FRAME_ACK]))
+        while True:
+            try:
+                frame = self.recv_frame(addr, pos, length)
+            except Timeout:
+                frame = None
+            if frame is None:
+                self.recv_drain()
+                self.send(bytes([FRAME_NAK]))
+            elif frame[0] == 0:
+                if pos < length:
+                    self.puts('Aborted')
+                return
+            else:
+                size, new = frame
+                if new:
+                    pos += size
+                self.send(bytes([FRAME_ACK]))
+
+    def cmd_bread(self, argv):
+        if len(argv) != 3:
+            raise UsageError()
+        addr = self.parse_int(argv[1], 16)
+        length = self.parse_int(argv[2])
+        pos = 0
+        self.send(bytes([FRAME_ACK]))
+        while pos < length:
+            size = min(length - pos, FRAME_MAX)
+            self.send_frame(self.mem.read_bytes(addr + pos, size))
+            try:
+                ack = self.getc(1)
+            except Timeout:
+                ack = None
+            if ack == FRAME_ACK:
+                pos += size
+            elif ack != FRAME_NAK:
+                self.recv_drain()
+                self.puts('Aborted')
+                return
+
+    def cmd_unlzma(self, argv):
+        if len(argv) != 4:
+            raise UsageError()
+        src = self.parse_int(argv[1], 16)
+        length = self.parse_int(argv[2])
+        dest = self.parse_int(argv[3], 16)
+        try:
+            data = lzma.decompress(self.mem.read_bytes(src, length), format=lzma.FORMAT_ALONE)
+        except lzma.LZMAError:
+            return self.puts('Corrupt LZMA data')
+        self.mem.write_bytes(dest, data)
+        self.puts(f'{len(data):08x} {zlib.crc32(data):08x}')
+
+    def cmd_crc(self, argv):
+        if len(argv) not in (3, 4):
+            raise UsageError()
+        addr = self.parse_int(argv[1], 16)
+        length = self.parse_int(argv[2])
+        block = self.parse_int(argv[3]) if len(argv) == 4 else 0
+        block = block or max(length, 1)
+        out = []
+        for i, offset in enumerate(range(0, length, block)):
+            if i % 8 == 0:
+                out.append(('\n' if i else '') + f'{addr + offset:08x}:')
+            out.append(f' {zlib.crc32(self.mem.read_bytes(addr + offset, min(length - offset, block))):08x}')
+        self.puts(''.join(out))
+
+    # SPI flash
+
+    def cmd_flash_read(self, argv):
+        if len(argv) != 4:
+            raise UsageError()
+        src = self.parse_int(argv[1], 16)
+        dest = self.parse_int(argv[2], 16)
+        length = self.parse_int(argv[3])
+        time.sleep(length / FLASH_READ_RATE)
+        self.mem.write_bytes(dest, self.flash[src:src+length])
+
+    def cmd_flash_write(self, argv):
+        if len(argv) != 4:
+            raise UsageError()
+        src = self.parse_int(argv[1], 16)
+        dest = self.parse_int(argv[2], 16)
+        length = self.parse_int(argv[3])
+        if dest % FLASH_SECTOR:
+            raise UsageError()
+        written = unchanged = 0
+        for i in range(0, length, FLASH_SECTOR):
+            data = self.mem.read_bytes(src + i, min(length - i, FLASH_SECTOR))
+            base = dest + i
+            time.sleep(len(data) / FLASH_READ_RATE)
+            if self.flash[base:base+len(data)] == data:
+                unchanged += 1
+                continue
+            sector = bytearray(self.flash[base:base+FLASH_SECTOR])
+            sector[:len(data)] = data
+            # Erase, program (which can only clear bits), and verify
+            self.flash[base:base+FLASH_SECTOR] = b'\xff' * FLASH_SECTOR
+            self.flash_erases += 1
+            for j, x in enumerate(sector):
+                self.flash[base + j] &= x
+            time.sleep(FLASH_ERASE_TIME + FLASH_SECTOR // 256 * FLASH_PROGRAM_TIME + FLASH_SECTOR / FLASH_READ_RATE)
+            if self.flash[base:base+FLASH_SECTOR] != sector:
+                self.puts(f'Verify failed at {base:08x}')
+                break
+            written += 1
+        self.puts(f'{written:08x} {unchanged:08x}')
+
+    commands = {
+        'help': (cmd_help, '[command]', 'Show help output for one or all commands'),
+        'echo': (cmd_echo, '[words]', 'Echo a few words'),
+        'rb':   (cmd_read, 'address [count]', 'Read one or more bytes'),
+        'rh':   (cmd_read, 'address [count]', 'Read one or more half-words (16-bit)'),
+        'rw':   (cmd_read, 'address [count]', 'Read one or more words (32-bit)'),
+        'wb':   (cmd_write, 'address values', 'Write one or more bytes'),
+        'wh':   (cmd_write, 'address values', 'Write one or more half-words (16-bit)'),
+        'ww':   (cmd_write, 'address values', 'Write one or more words (32-bit)'),
+        'fb':   (cmd_fill, 'address count value [step]', 'Fill bytes with a value, optionally incrementing'),
+        'fh':   (cmd_fill, 'address count value [step]', 'Fill half-words with a value, optionally incrementing'),
+        'fw':   (cmd_fill, 'address count value [step]', 'Fill words with a value, optionally incrementing'),
+        'mb':   (cmd_modify, 'address mask value', 'Modify the masked bits of a byte'),
+        'mh':   (cmd_modify, 'address mask value', 'Modify the masked bits of a half-word (16-bit)'),
+        'mw':   (cmd_modify, 'address mask value', 'Modify the masked bits of a word (32-bit)'),
+        'pb':   (cmd_poll, 'address mask value', 'Wait until the masked bits of a byte have a value'),
+        'ph':   (cmd_poll, 'address mask value', 'Wait until the masked bits of a half-word (16-bit) have a value'),
+        'pw':   (cmd_poll, 'address mask value', 'Wait until the masked bits of a word (32-bit) have a value'),
+        'bwr':  (cmd_bwrite, 'address length', 'Write binary data, received in frames'),
+        'brd':  (cmd_bread, 'address length', 'Read binary data, sent in frames'),
+        'unlz': (cmd_unlzma, 'source length destination', 'Decompress LZMA data'),
+        'crc':  (cmd_crc, 'address length [block]', 'Calculate the CRC32 of a range, or of each block in it'),
+        'cb':   (cmd_copy, 'source destination count', 'Copy one or more bytes'),
+        'ch':   (cmd_copy, 'source destination count', 'Copy one or more half-words (16-bit)'),
+        'cw':   (cmd_copy, 'source destination count', 'Copy one or more words (32-bit)'),
+        'sync': (cmd_sync, '[address length]...', 'Synchronize caches, for all of RAM or the given ranges'),
+        'call': (cmd_call, 'address [up to 3 args] [/ [address length]...]',
+                 'Call a function by address, after synchronizing caches'),
+        'src':  (cmd_src, 'address', 'Source/run script at address'),
+        'flrd': (cmd_flash_read, 'source destination length', 'Read from flash'),
+        'flwr': (cmd_flash_write, 'source destination length', 'Write data to flash; destination must be 4k-aligned'),
+        'boot': (cmd_boot, '', 'Continue with the usual boot flow'),
+    }
+
+def start(**kwargs):
+    """Start an emulator in a background thread, and return the name of its terminal"""
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    emulator = Emulator(master, **kwargs)
+    threading.Thread(target=emulator.run, daemon=True).start()
+    return os.ttyname(slave), emulator
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve an emulated lolmon on a pseudo terminal')
+    parser.add_argument('--baud', type=int, default=115200, help='simulated baud rate, 0 for unlimited')
+    parser.add_argument('--latency', type=float, default=0, help='output latency in seconds')
+    parser.add_argument('--echo-errors', type=float, default=0, help='probability of losing a received character')
+    parser.add_argument('--seed', type=int, help='seed for error injection')
+    parser.add_argument('--max-baud', type=int, help='baud rate above which characters start getting lost')
+    parser.add_argument('--rx-fifo', type=int, help='size of the RX FIFO, which overflows while a command runs')
+    parser.add_argument('--flash', help='initial contents of the SPI flash')
+    args = parser.parse_args()
+
+    flash = None
+    if args.flash:
+        with open(args.flash, 'rb') as f:
+            flash = f.read()
+
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    print(os.ttyname(slave), flush=True)
+    Emulator(master, args.baud, args.latency, args.echo_errors, args.seed, args.max_baud, args.rx_fifo, flash).run()
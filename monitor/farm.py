@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: MIT
+# Run the same job on several boards at once, with asyncio.
+#
+# Usage: python3 ./farm.py job.py /dev/ttyUSB0 /dev/ttyUSB1 ...
+#
+# job.py defines a coroutine that gets an AsyncLolmon and returns a result:
+#
+#   async def job(l):
+#       await l.write_file(0x81000000, 'vmlinuz-dtb')
+#       return hex(await l.read32(0x81000000))
+
+import argparse, asyncio, functools, runpy, sys, time
+from concurrent.futures import ThreadPoolExecutor
+import interact
+
+class AsyncLolmon:
+    """A Lolmon for asyncio. The Lolmon of each board runs in a thread of its
+    own, and each of its methods is available here as a coroutine that calls
+    it in that thread; calls to one board are run in order. Attributes that
+    aren't methods, such as metrics, are those of the Lolmon."""
+    def __init__(self, device):
+        self.l = interact.Lolmon(device)
+        self.thread = ThreadPoolExecutor(1, thread_name_prefix=self.l.device)
+
+    def close(self):
+        self.thread.shutdown()
+        self.l.s.close()
+
+    async def run(self, fn, *args, **kwargs):
+        """Run fn(lolmon, *args, **kwargs) in the board's thread, e.g. to use
+        a Block: await l.run(lambda l: UART(l, UART0_BASE).divisor())"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.thread, functools.partial(fn, self.l, *args, **kwargs))
+
+    def __getattr__(self, name):
+        attr = getattr(self.l, name)
+        if not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        async def method(*args, **kwargs):
+            return await self.run(lambda l: attr(*args, **kwargs))
+        return method
+
+
+class Result:
+    def __init__(self, device):
+        self.device = device
+        self.good = False
+        self.value = None
+        self.seconds = 0
+
+    def __str__(self):
+        status = 'ok' if self.good else 'FAILED'
+        return f'{self.device:20} {status:6} {self.seconds:8.2f} s  {self.value}'
+
+async def run_job(devices, job):
+    """Run job(l) for an AsyncLolmon on each device concurrently, and return
+    a Result per device. One board failing doesn't stop the others."""
+    async def run_one(device):
+        result = Result(device)
+        start = time.monotonic()
+        l = None
+        try:
+            l = AsyncLolmon(device)
+            await l.flush()
+            result.value = await job(l)
+            result.good = True
+        except Exception as e:
+            result.value = f'{type(e).__name__}: {e}'
+        finally:
+            if l:
+                l.close()
+        result.seconds = time.monotonic() - start
+        return result
+
+    return await asyncio.gather(*(run_one(d) for d in devices))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a job on several lolmon boards at once')
+    parser.add_argument('job', help='Python file that defines "async def job(l)"')
+    parser.add_argument('devices', nargs='+', help='serial ports of the boards')
+    args = parser.parse_args()
+
+    job = runpy.run_path(args.job)['job']
+    results = asyncio.run(run_job(args.devices, job))
+    for r in results:
+        print(r)
+    sys.exit(0 if all(r.good for r in results) else 1)
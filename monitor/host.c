@@ -0,0 +1,584 @@
+/* SPDX-License-Identifier: MIT */
+
+/*
+ * Host build of lolmon: monitor.c, compiled for the host with the accessors
+ * in host.h, and run against a simulated board. RAM is mapped at 0x80000000
+ * (and again at 0xa0000000), and the registers at 0xbf000000 are plain memory,
+ * except for the UART, which is connected to a pseudo terminal or to
+ * stdin/stdout, and the ISP controller, which is connected to a simulated SPI
+ * flash. This allows testing and profiling the real command parser and
+ * commands with interact.py, without a board.
+ *
+ * Usage: ./monitor-host [-f flash.bin]             serve on a pseudo terminal
+ *        ./monitor-host -s                         use stdin/stdout
+ *        ./monitor-host -b commands.txt [-n 1000]  benchmark the commands
+ */
+
+#define _GNU_SOURCE
+#include <errno.h>
+#include <fcntl.h>
+#include <poll.h>
+#include <signal.h>
+#include <stdbool.h>
+#include <stdint.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <sys/mman.h>
+#include <termios.h>
+#include <time.h>
+#include <unistd.h>
+
+#define MiB (1 << 20)
+
+#define RAM_SIZE (64 * MiB)
+#define MMIO_BASE 0xbf000000
+#define MMIO_SIZE (16 * MiB)
+
+#define UART_BASE 0xbf201300
+#define UART_DATA (UART_BASE + 0x00)
+#define UART_DLL  (UART_BASE + 0x00)
+#define UART_DLM  (UART_BASE + 0x08)
+#define UART_LCR  (UART_BASE + 0x18)
+#define UART_LSR  (UART_BASE + 0x28)
+#define UART_LCR_DLAB 0x80
+#define UART_LSR_DR   0x01	/* data ready */
+#define UART_LSR_THRE 0x20	/* transmit holding register empty */
+#define UART_LSR_TEMT 0x40	/* transmitter empty */
+#define UART_DIVISOR 94		/* 115200 baud */
+
+/*
+ * The monitor counts as waiting for input after this many status polls
+ * without input, and output is flushed then. While it keeps waiting, it
+ * sleeps for 1ms every POLLS_PER_WAIT polls, which keeps UART_RX_TIMEOUT at
+ * roughly 100ms without spinning all the time.
+ */
+#define POLLS_BEFORE_WAIT 16
+#define POLLS_PER_WAIT 10000
+
+#define ISP_BASE 0xbf002000
+#define ISP_SPI_WDATA		(ISP_BASE + 4 * 0x04)
+#define ISP_SPI_RDATA		(ISP_BASE + 4 * 0x05)
+#define ISP_SPI_CECLR		(ISP_BASE + 4 * 0x08)
+#define ISP_SPI_RDREQ		(ISP_BASE + 4 * 0x0c)
+#define ISP_SPI_RD_DATARDY	(ISP_BASE + 4 * 0x15)
+#define ISP_SPI_WR_DATARDY	(ISP_BASE + 4 * 0x16)
+
+#define SPI_PP   0x02
+#define SPI_READ 0x03
+#define SPI_RDSR 0x05
+#define SPI_WREN 0x06
+#define SPI_SE   0x20
+#define SPI_SR_WEL 0x02
+
+#define FLASH_SIZE (16 * MiB)
+#define FLASH_SECTOR 4096
+#define FLASH_PAGE 256
+
+void monitor_main(void);
+
+static int in_fd = 0, out_fd = 1;
+static uint8_t rx_buf[4096], tx_buf[4096];
+static size_t rx_pos, rx_len, tx_len;
+static unsigned long idle_polls;
+
+
+/* Plain memory */
+
+static uint32_t mem_read(unsigned long addr, int size)
+{
+	switch (size) {
+	case 1:
+		return *(volatile uint8_t *)addr;
+	case 2:
+		return *(volatile uint16_t *)addr;
+	default:
+		return *(volatile uint32_t *)addr;
+	}
+}
+
+static void mem_write(unsigned long addr, int size, uint32_t value)
+{
+	switch (size) {
+	case 1:
+		*(volatile uint8_t *)addr = value;
+		break;
+	case 2:
+		*(volatile uint16_t *)addr = value;
+		break;
+	default:
+		*(volatile uint32_t *)addr = value;
+		break;
+	}
+}
+
+static void map(unsigned long addr, size_t size, int flags, int fd)
+{
+	void *p = mmap((void *)addr, size, PROT_READ | PROT_WRITE, flags | MAP_FIXED_NOREPLACE, fd, 0);
+
+	if (p != (void *)addr) {
+		fprintf(stderr, "Can't map memory at %#lx\n", addr);
+		exit(1);
+	}
+}
+
+static void setup_memory(void)
+{
+	int fd = memfd_create("lolmon-ram", 0);
+
+	if (fd < 0 || ftruncate(fd, RAM_SIZE) < 0) {
+		perror("memfd_create");
+		exit(1);
+	}
+	map(0x80000000, RAM_SIZE, MAP_SHARED, fd);
+	map(0xa0000000, RAM_SIZE, MAP_SHARED, fd);
+	map(MMIO_BASE, MMIO_SIZE, MAP_PRIVATE | MAP_ANONYMOUS, -1);
+
+	mem_write(UART_DLL, 1, UART_DIVISOR & 0xff);
+	mem_write(UART_DLM, 1, UART_DIVISOR >> 8);
+	mem_write(UART_LCR, 1, 0x03);
+}
+
+
+/* Benchmark: Lines of a script are fed to the monitor, and the time until it
+   waits for input again, its output and the UART status polls are accounted
+   to the command verb */
+
+struct verb_stats {
+	char verb[8];
+	unsigned long lines, chars_in, chars_out, polls;
+	uint64_t ns;
+};
+
+static struct {
+	char *script, *line, *next;
+	unsigned long repeat;
+	bool active;
+	uint64_t start;
+	unsigned long chars_out, polls;
+	struct verb_stats stats[64];
+	size_t verbs;
+} bench;
+
+static uint64_t now_ns(void)
+{
+	struct timespec ts;
+
+	clock_gettime(CLOCK_MONOTONIC, &ts);
+	return ts.tv_sec * 1000000000ULL + ts.tv_nsec;
+}
+
+static struct verb_stats *bench_verb(const char *line, size_t len)
+{
+	char verb[8] = "(empty)";
+	size_t i = 0, n = 0;
+
+	while (i < len && line[i] == ' ')
+		i++;
+	if (i < len) {
+		while (i < len && line[i] != ' ' && line[i] != ';' && n < sizeof(verb) - 1)
+			verb[n++] = line[i++];
+		verb[n] = 0;
+	}
+
+	for (size_t v = 0; v < bench.verbs; v++)
+		if (!strcmp(bench.stats[v].verb, verb))
+			return &bench.stats[v];
+	if (bench.verbs == sizeof(bench.stats) / sizeof(bench.stats[0]))
+		return &bench.stats[bench.verbs - 1];
+	strcpy(bench.stats[bench.verbs].verb, verb);
+	return &bench.stats[bench.verbs++];
+}
+
+static void bench_report(void)
+{
+	struct verb_stats total = { .verb = "total" };
+
+	printf("%-8s %9s %9s %10s %10s %10s\n", "verb", "lines", "chars in", "chars out", "polls", "ns/line");
+	for (size_t v = 0; v <= bench.verbs; v++) {
+		struct verb_stats *s = v < bench.verbs ? &bench.stats[v] : &total;
+
+		if (!s->lines)
+			continue;
+		printf("%-8s %9lu %9.1f %10.1f %10.1f %10.0f\n", s->verb, s->lines,
+		       (double)s->chars_in / s->lines, (double)s->chars_out / s->lines,
+		       (double)s->polls / s->lines, (double)s->ns / s->lines);
+		total.lines += s->lines;
+		total.chars_in += s->chars_in;
+		total.chars_out += s->chars_out;
+		total.polls += s->polls;
+		total.ns += s->ns;
+	}
+}
+
+/* Called when the monitor waits for input: account the last line, and feed the next one */
+static bool bench_next_line(void)
+{
+	uint64_t now = now_ns();
+	size_t len;
+
+	if (bench.active) {
+		struct verb_stats *s;
+
+		len = bench.next - bench.line - 1;
+		s = bench_verb(bench.line, len);
+		s->lines++;
+		s->chars_in += len + 1;
+		s->chars_out += bench.chars_out;
+		s->polls += bench.polls;
+		s->ns += now - bench.start;
+	}
+
+	if (!bench.next || !*bench.next) {
+		if (bench.active && --bench.repeat == 0) {
+			bench_report();
+			exit(0);
+		}
+		bench.next = bench.script;
+	}
+
+	bench.line = bench.next;
+	len = strcspn(bench.line, "\n");
+	bench.next = bench.line + len + (bench.line[len] == '\n');
+	len = bench.next - bench.line;
+	if (len > sizeof(rx_buf))
+		len = sizeof(rx_buf);
+	memcpy(rx_buf, bench.line, len);
+	if (len && rx_buf[len - 1] == '\n')
+		rx_buf[len - 1] = '\r';
+	rx_pos = 0;
+	rx_len = len;
+	idle_polls = 0;
+
+	bench.active = true;
+	bench.chars_out = 0;
+	bench.polls = 0;
+	bench.start = now_ns();
+	return true;
+}
+
+static char *load_script(const char *path)
+{
+	FILE *f = fopen(path, "r");
+	char *script = NULL;
+	size_t size = 0;
+
+	if (!f) {
+		perror(path);
+		exit(1);
+	}
+	if (getdelim(&script, &size, 0, f) < 0 || !*script) {
+		fprintf(stderr, "%s is empty\n", path);
+		exit(1);
+	}
+	fclose(f);
+
+	/* Every line needs a line break, including the last one */
+	size = strlen(script);
+	if (script[size - 1] != '\n') {
+		script = realloc(script, size + 2);
+		strcpy(script + size, "\n");
+	}
+	return script;
+}
+
+
+/* UART */
+
+static void uart_flush(void)
+{
+	size_t pos = 0;
+
+	while (pos < tx_len) {
+		ssize_t n = write(out_fd, tx_buf + pos, tx_len - pos);
+
+		if (n < 0 && errno != EINTR)
+			exit(0);
+		if (n > 0)
+			pos += n;
+	}
+	tx_len = 0;
+}
+
+static void uart_tx(uint8_t ch)
+{
+	idle_polls = 0;
+	if (bench.script) {
+		bench.chars_out++;
+		return;
+	}
+
+	tx_buf[tx_len++] = ch;
+	if (tx_len == sizeof(tx_buf))
+		uart_flush();
+}
+
+/* Read available input, waiting for up to timeout milliseconds */
+static bool uart_fill(int timeout)
+{
+	struct pollfd pfd = { .fd = in_fd, .events = POLLIN };
+	ssize_t n;
+
+	if (poll(&pfd, 1, timeout) <= 0)
+		return false;
+
+	n = read(in_fd, rx_buf, sizeof(rx_buf));
+	if (n < 0 && (errno == EINTR || errno == EAGAIN))
+		return false;
+	if (n <= 0) {
+		/* End of input */
+		uart_flush();
+		exit(0);
+	}
+
+	rx_pos = 0;
+	rx_len = n;
+	idle_polls = 0;
+	return true;
+}
+
+static bool uart_rx_ready(void)
+{
+	if (rx_pos < rx_len)
+		return true;
+
+	idle_polls++;
+	if (idle_polls == POLLS_BEFORE_WAIT) {
+		uart_flush();
+		if (bench.script)
+			return bench_next_line();
+		return uart_fill(0);
+	}
+	if (idle_polls % POLLS_PER_WAIT == 0 && !bench.script)
+		return uart_fill(1);
+	return false;
+}
+
+/* Buffered output counts as still being sent, until polling flushes it */
+static uint32_t uart_lsr(void)
+{
+	uint32_t lsr = UART_LSR_THRE | (uart_rx_ready() ? UART_LSR_DR : 0);
+
+	return tx_len ? lsr : lsr | UART_LSR_TEMT;
+}
+
+
+/* SPI flash, as seen through the ISP controller. Writes take no time. */
+
+static uint8_t *flash;
+static struct {
+	uint8_t cmd, rdata;
+	unsigned bytes;
+	uint32_t addr;
+	bool wel;
+} spi;
+
+static void spi_tx(uint8_t byte)
+{
+	if (spi.bytes == 0) {
+		spi.cmd = byte;
+		spi.addr = 0;
+	} else if (spi.bytes <= 3) {
+		spi.addr = spi.addr << 8 | byte;
+	} else if (spi.cmd == SPI_PP && spi.wel) {
+		/* Programming can only clear bits, and wraps around within the page */
+		flash[spi.addr % FLASH_SIZE] &= byte;
+		spi.addr = (spi.addr & ~(FLASH_PAGE - 1)) | ((spi.addr + 1) & (FLASH_PAGE - 1));
+	}
+	spi.bytes++;
+}
+
+static void spi_rx(void)
+{
+	if (spi.cmd == SPI_READ && spi.bytes >= 4)
+		spi.rdata = flash[spi.addr++ % FLASH_SIZE];
+	else if (spi.cmd == SPI_RDSR)
+		spi.rdata = spi.wel ? SPI_SR_WEL : 0;
+	else
+		spi.rdata = 0xff;
+}
+
+static void spi_end(void)
+{
+	if (spi.cmd == SPI_WREN && spi.bytes == 1) {
+		spi.wel = true;
+	} else if (spi.cmd == SPI_SE && spi.bytes == 4 && spi.wel) {
+		memset(flash + (spi.addr & ~(FLASH_SECTOR - 1)) % FLASH_SIZE, 0xff, FLASH_SECTOR);
+		spi.wel = false;
+	} else if (spi.cmd == SPI_PP && spi.bytes >= 4) {
+		spi.wel = false;
+	}
+	spi.bytes = 0;
+	spi.cmd = 0;
+}
+
+static void load_flash(const char *path)
+{
+	flash = malloc(FLASH_SIZE);
+	memset(flash, 0xff, FLASH_SIZE);
+	if (path) {
+		FILE *f = fopen(path, "rb");
+
+		if (!f) {
+			perror(path);
+			exit(1);
+		}
+		if (fread(flash, 1, FLASH_SIZE, f) == 0 && ferror(f)) {
+			perror(path);
+			exit(1);
+		}
+		fclose(f);
+	}
+}
+
+
+/* Accessors for the simulated peripherals, see host.h */
+
+uint32_t host_read(unsigned long addr, int size)
+{
+	bool dlab = mem_read(UART_LCR, 1) & UART_LCR_DLAB;
+
+	switch (addr) {
+	case UART_LSR:
+		bench.polls++;
+		return uart_lsr();
+	case UART_DATA:
+		if (dlab)
+			break;
+		return uart_rx_ready() ? rx_buf[rx_pos++] : 0;
+	case ISP_SPI_RDATA:
+		return spi.rdata;
+	case ISP_SPI_RD_DATARDY:
+	case ISP_SPI_WR_DATARDY:
+		return 1;
+	}
+	return mem_read(addr, size);
+}
+
+void host_write(unsigned long addr, int size, uint32_t value)
+{
+	bool dlab = mem_read(UART_LCR, 1) & UART_LCR_DLAB;
+
+	switch (addr) {
+	case UART_DATA:
+		if (dlab)
+			break;
+		uart_tx(value);
+		return;
+	case ISP_SPI_WDATA:
+		spi_tx(value);
+		return;
+	case ISP_SPI_RDREQ:
+		spi_rx();
+		return;
+	case ISP_SPI_CECLR:
+		spi_end();
+		return;
+	}
+	mem_write(addr, size, value);
+}
+
+/* Replacements for the helpers in start.S. There is no MIPS code to run, so
+   called functions are assumed to return right away, as in the emulator. */
+
+void synci_line(unsigned long p)
+{
+	(void)p;
+}
+
+void do_call(uint32_t fn, uint32_t a1, uint32_t a2, uint32_t a3)
+{
+	(void)fn;
+	(void)a1;
+	(void)a2;
+	(void)a3;
+}
+
+
+/* Set up a pseudo terminal in raw mode, and print its name */
+static int open_pty(void)
+{
+	int master = posix_openpt(O_RDWR | O_NOCTTY), slave;
+	struct termios t;
+
+	if (master < 0 || grantpt(master) < 0 || unlockpt(master) < 0) {
+		perror("posix_openpt");
+		exit(1);
+	}
+
+	/* The slave stays open, so that the host can reconnect */
+	slave = open(ptsname(master), O_RDWR | O_NOCTTY);
+	if (slave < 0 || tcgetattr(slave, &t) < 0) {
+		perror(ptsname(master));
+		exit(1);
+	}
+	cfmakeraw(&t);
+	tcsetattr(slave, TCSANOW, &t);
+
+	printf("%s\n", ptsname(master));
+	fflush(stdout);
+	return master;
+}
+
+/* Accesses outside of RAM and registers would hang or crash the board; say where */
+static void bad_access(int sig, siginfo_t *info, void *context)
+{
+	(void)context;
+	uart_flush();
+	fprintf(stderr, "Bad access at %#lx, exiting\n", (unsigned long)info->si_addr);
+	signal(sig, SIG_DFL);
+	raise(sig);
+}
+
+static void usage(const char *name)
+{
+	fprintf(stderr, "Usage: %s [-s] [-f flash.bin] [-b commands.txt [-n repeat]]\n"
+			"  -s  use stdin/stdout instead of a pseudo terminal\n"
+			"  -f  initial contents of the SPI flash\n"
+			"  -b  benchmark: run the commands in a file, and print statistics per command\n"
+			"  -n  number of times to run the commands (default: 1000)\n", name);
+	exit(1);
+}
+
+int main(int argc, char **argv)
+{
+	const char *flash_path = NULL, *bench_path = NULL;
+	bool use_stdio = false;
+	int opt;
+
+	bench.repeat = 1000;
+	while ((opt = getopt(argc, argv, "sf:b:n:")) != -1) {
+		switch (opt) {
+		case 's':
+			use_stdio = true;
+			break;
+		case 'f':
+			flash_path = optarg;
+			break;
+		case 'b':
+			bench_path = optarg;
+			break;
+		case 'n':
+			bench.repeat = strtoul(optarg, NULL, 0);
+			break;
+		default:
+			usage(argv[0]);
+		}
+	}
+	if (optind != argc || !bench.repeat)
+		usage(argv[0]);
+
+	struct sigaction sa = { .sa_sigaction = bad_access, .sa_flags = SA_SIGINFO };
+	sigaction(SIGSEGV, &sa, NULL);
+	sigaction(SIGBUS, &sa, NULL);
+
+	setup_memory();
+	load_flash(flash_path);
+	if (bench_path)
+		bench.script = load_script(bench_path);
+	else if (!use_stdio)
+		in_fd = out_fd = open_pty();
+
+	monitor_main();
+	return 0;
+}
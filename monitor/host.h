@@ -0,0 +1,52 @@
+/* SPDX-License-Identifier: MIT */
+
+/*
+ * MMIO accessors for the host build of lolmon (see host.c). RAM and all other
+ * registers are plain memory, mapped at their usual addresses; accesses to
+ * the peripherals that host.c simulates (UART, ISP) are passed to it.
+ */
+
+#define HOST_PERIPHERAL(addr) \
+	(((addr) & ~0xffUL) == 0xbf201300 || ((addr) & ~0xffUL) == 0xbf002000)
+
+uint32_t host_read(unsigned long addr, int size);
+void host_write(unsigned long addr, int size, uint32_t value);
+
+static uint8_t read8(unsigned long addr)
+{
+	return HOST_PERIPHERAL(addr) ? host_read(addr, 1) : *(volatile uint8_t *)addr;
+}
+
+static uint16_t read16(unsigned long addr)
+{
+	return HOST_PERIPHERAL(addr) ? host_read(addr, 2) : *(volatile uint16_t *)addr;
+}
+
+static uint32_t read32(unsigned long addr)
+{
+	return HOST_PERIPHERAL(addr) ? host_read(addr, 4) : *(volatile uint32_t *)addr;
+}
+
+static void write8(unsigned long addr, uint8_t value)
+{
+	if (HOST_PERIPHERAL(addr))
+		host_write(addr, 1, value);
+	else
+		*(volatile uint8_t *)addr = value;
+}
+
+static void write16(unsigned long addr, uint16_t value)
+{
+	if (HOST_PERIPHERAL(addr))
+		host_write(addr, 2, value);
+	else
+		*(volatile uint16_t *)addr = value;
+}
+
+static void write32(unsigned long addr, uint32_t value)
+{
+	if (HOST_PERIPHERAL(addr))
+		host_write(addr, 4, value);
+	else
+		*(volatile uint32_t *)addr = value;
+}
@@ -1,8 +1,8 @@
 #!/usr/share/python3
 # SPDX-License-Identifier: MIT
-# Usage: python3 -i ./interact.py
+# Usage: python3 -i ./interact.py [device]
 
-import serial, time, re, struct, sys, random, socket, os
+import serial, time, re, struct, sys, random, socket, os, json, zlib, lzma, bisect, collections, contextlib, array, hashlib
 
 KiB = 1 << 10
 MiB = 1 << 20
@@ -60,22 +60,300 @@ def hexdump(data):
             print(line)
 
 
+# Binary transfer framing, see monitor.c
+FRAME_MAX = 1024
+FRAME_ACK = b'\x06'
+FRAME_NAK = b'\x15'
+
+def make_frame(offset, payload):
+    # A frame for bwr, with the offset of the payload within the transfer
+    header = struct.pack('<I', offset)
+    crc = zlib.crc32(payload, zlib.crc32(header))
+    return struct.pack('<H', len(payload)) + header + payload + struct.pack('<I', crc)
+
+def compress_lzma(data):
+    # LZMA "alone" format with the uncompressed length filled in, as in tools/lzma-compress.py
+    out = bytearray(lzma.compress(data, format=lzma.FORMAT_ALONE))
+    out[5:5+8] = struct.pack('<Q', len(data))
+    return bytes(out)
+
+def progress(what, done, total, start):
+    elapsed = max(time.monotonic() - start, 1e-6)
+    sys.stderr.write(f'\r{what}: {done}/{total} bytes, {done / elapsed:.0f} B/s')
+    if done == total:
+        sys.stderr.write('\n')
+    sys.stderr.flush()
+
 def error(s):
     sys.stderr.write(s)
     sys.stderr.write('\n')
     sys.stderr.flush()
 
+# Longest command line that the monitor accepts
+LINE_MAX = 127
+
+# Baud rates to try in negotiate_baud, and where the results are remembered
+BAUD_RATES = (1500000, 1000000, 921600, 460800, 230400, 115200)
+BAUD_CACHE = os.path.expanduser('~/.cache/lolmon-baud.json')
+UART0_BASE = 0xbf201300
+
+# Messages that indicate that the monitor couldn't execute a command
+MONITOR_ERRORS = (b'Usage error', b'Invalid number', b'Unknown command', b'Aborted', b'Corrupt LZMA data',
+                  b'Flash timeout', b'Verify failed')
+
+# RAM, as seen by the cache maintenance of sync and call
+RAM_SIZE = 64 * MiB
+CACHE_LINE = 32
+SYNC_RANGES = 7     # address/length pairs that fit into the monitor's 16 arguments
+CALL_RANGES = 4     # the same, after call, its address, four arguments, and '/'
+
+# SPI flash: erase granularity, and rough speeds for command timeouts
+FLASH_SECTOR = 4096
+FLASH_READ_RATE = 256 * KiB     # bytes per second, at least
+FLASH_SECTOR_TIME = 0.5         # seconds to erase, program and verify a sector, at most
+
+def open_serial(device):
+    return serial.Serial(device, baudrate=115200, timeout=0.2)
+
+class Metrics:
+    """Always-on counters of where the session time goes: latency histograms
+    per command verb, bytes on the wire, retries and timeouts."""
+
+    # Upper bounds of the latency histogram buckets, in seconds
+    BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, float('inf'))
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.start = time.monotonic()
+        self.histograms = {}
+        self.total_time = collections.Counter()
+        self.max_time = collections.Counter()
+        self.counters = collections.Counter()
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def record(self, verb, seconds):
+        histogram = self.histograms.setdefault(verb, [0] * len(self.BUCKETS))
+        histogram[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+        self.total_time[verb] += seconds
+        self.max_time[verb] = max(self.max_time[verb], seconds)
+
+    def percentile(self, verb, p):
+        # Upper bound of the bucket that contains the given percentile
+        histogram = self.histograms[verb]
+        rank = p / 100 * sum(histogram)
+        seen = 0
+        for bound, n in zip(self.BUCKETS, histogram):
+            seen += n
+            if seen >= rank:
+                return min(bound, self.max_time[verb])
+        return self.max_time[verb]
+
+    def as_dict(self):
+        elapsed = max(time.monotonic() - self.start, 1e-6)
+        c = self.counters
+        rx_payload = c['rx_payload']
+        commands = {}
+        for verb, histogram in sorted(self.histograms.items()):
+            n = sum(histogram)
+            commands[verb] = {
+                'count': n,
+                'total': self.total_time[verb],
+                'mean': self.total_time[verb] / n,
+                'p50': self.percentile(verb, 50),
+                'p90': self.percentile(verb, 90),
+                'max': self.max_time[verb],
+                'histogram': {f'<={bound}': count for bound, count in zip(self.BUCKETS, histogram) if count},
+            }
+        return {
+            'elapsed': elapsed,
+            'bytes': {
+                'tx_echoed': c['tx_echoed'],
+                'tx_payload': c['tx_payload'],
+                'rx_echo': c['rx_echo'],
+                'rx_payload': rx_payload,
+                'rx_other': c['rx'] - c['rx_echo'] - rx_payload,
+            },
+            'echo_retries': c['echo_retries'],
+            'frame_retries': c['frame_retries'],
+            'timeouts': c['timeouts'],
+            'prompt_timeouts': c['prompt_timeouts'],
+            'payload_bytes_per_s': (c['tx_payload'] + rx_payload) / elapsed,
+            'wire_bytes_per_s': (c['tx_echoed'] + c['tx_payload'] + c['rx']) / elapsed,
+            'commands': commands,
+        }
+
+    def json(self):
+        return json.dumps(self.as_dict(), indent=2)
+
+    def table(self):
+        d = self.as_dict()
+        lines = [f'{"verb":8} {"count":>7} {"total s":>9} {"mean ms":>9} {"p50 ms":>9} {"p90 ms":>9} {"max ms":>9}']
+        for verb, s in d['commands'].items():
+            lines.append(f'{verb or "(empty)":8} {s["count"]:7} {s["total"]:9.3f} {s["mean"]*1e3:9.2f} '
+                         f'{s["p50"]*1e3:9.2f} {s["p90"]*1e3:9.2f} {s["max"]*1e3:9.2f}')
+        b = d['bytes']
+        lines.append(f'sent {b["tx_echoed"]} echoed + {b["tx_payload"]} payload bytes, '
+                     f'received {b["rx_echo"]} echo + {b["rx_payload"]} payload + {b["rx_other"]} other bytes')
+        lines.append(f'{d["echo_retries"]} echo retries, {d["frame_retries"]} frame retries, '
+                     f'{d["timeouts"]} timeouts, {d["prompt_timeouts"]} prompt timeouts')
+        lines.append(f'{d["payload_bytes_per_s"]:.0f} payload B/s, {d["wire_bytes_per_s"]:.0f} wire B/s '
+                     f'over {d["elapsed"]:.1f} s')
+        return '\n'.join(lines)
+
+class EchoWindow:
+    """Adaptive limit on the number of characters typed ahead of their echo.
+
+    Like TCP congestion control, the window grows while echoes come back
+    intact and is halved on every echo error; it is shared by all commands.
+    The echo round trip time is tracked too, so that lost characters are
+    noticed sooner than after the fixed echo timeout.
+    """
+    def __init__(self, maximum, minimum=1):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.size = maximum
+        self.threshold = maximum
+        self.srtt = None
+        self.rttvar = 0
+        self.echoed = 0
+        self.errors = 0
+
+    def window(self):
+        return int(self.size)
+
+    def grow(self, n):
+        self.echoed += n
+        if self.size < self.threshold:
+            self.size += n                  # catch up quickly to the last good size
+        else:
+            self.size += n / (4 * self.size)  # then probe for more, one character per four windows
+        self.size = min(self.size, self.maximum)
+
+    def shrink(self):
+        self.errors += 1
+        self.threshold = max(self.minimum, self.size / 2)
+        self.size = self.threshold
+
+    def sample_rtt(self, rtt):
+        # Smoothed round trip time and its variation, as in RFC 6298
+        if self.srtt is None:
+            self.srtt, self.rttvar = rtt, rtt / 2
+        else:
+            self.rttvar += (abs(self.srtt - rtt) - self.rttvar) / 4
+            self.srtt += (rtt - self.srtt) / 8
+
+    def timeout(self, limit):
+        if self.srtt is None:
+            return limit
+        return min(limit, max(0.02, self.srtt + 4 * self.rttvar))
+
+    def stats(self):
+        return {
+            'window': self.window(),
+            'threshold': int(self.threshold),
+            'echoed': self.echoed,
+            'errors': self.errors,
+            'error_rate': self.errors / max(1, self.echoed),
+            'rtt': self.srtt,
+        }
+
+class DirtyRanges:
+    """RAM written since the last cache sync: sorted, merged [start, end)
+    ranges of KSEG0 addresses, rounded to cache lines. Writes through KSEG1
+    count as well, because the instruction cache may hold stale lines."""
+    def __init__(self):
+        self.ranges = []
+
+    def add(self, addr, size):
+        if addr & 0xc0000000 != 0x80000000 or size <= 0:
+            return
+        offset = addr & 0x1fffffff
+        start = offset & ~(CACHE_LINE - 1)
+        end = min((offset + size + CACHE_LINE - 1) & ~(CACHE_LINE - 1), RAM_SIZE)
+        if start >= end:
+            return
+        start |= 0x80000000
+        end |= 0x80000000
+        ranges = []
+        for s, e in self.ranges:
+            if e < start or s > end:
+                ranges.append((s, e))
+            else:
+                start, end = min(s, start), max(e, end)
+        ranges.append((start, end))
+        self.ranges = sorted(ranges)
+
+    def coalesce(self, n):
+        # At most n ranges, merged across the smallest gaps
+        ranges = list(self.ranges)
+        while len(ranges) > max(n, 1):
+            i = min(range(len(ranges) - 1), key=lambda i: ranges[i + 1][0] - ranges[i][1])
+            ranges[i:i+2] = [(ranges[i][0], ranges[i + 1][1])]
+        return ranges
+
+    def clear(self):
+        self.ranges = []
+
+class Command:
+    def __init__(self, cmd, check=True, raw=False, timeout=None, timed=True):
+        if isinstance(cmd, str):
+            cmd = cmd.encode('UTF-8')
+        assert not b'\n' in cmd
+        self.cmd = cmd
+        self.check = check
+        self.raw = raw          # the command does its own I/O after being entered
+        self.timeout = timeout  # overrides Lolmon.timeout for slow commands
+        self.timed = timed      # record the latency; raw commands until their echo is complete
+        self.sent = 0           # number of characters sent
+        self.echoed = 0         # number of characters whose echo has been checked
+        self.flight_start = None  # when the unechoed characters were sent, if measurable
+        self.started = None     # when the first character was sent
+        self.attempts = 0
+        self.entered = False
+        self.scanned = 0        # how far the answer has been searched for a prompt
+        self.done = False
+        self.good = False
+        self.answer = b''
+
+    def __str__(self):
+        return self.cmd.decode('UTF-8', errors='replace')
+
+    def verb(self):
+        return self.cmd.split(b' ')[0].decode('UTF-8', errors='replace')
+
 class Lolmon:
     def __init__(self, device):
-        self.device = device
-        self.s = serial.Serial(device, baudrate=115200, timeout=0.2)
+        # device is the name of a serial port, or an object that acts like one (see trace.py)
+        if isinstance(device, str):
+            self.device = device
+            self.s = open_serial(device)
+        else:
+            self.device = device.name
+            self.s = device
         self.prompt = b'> '
         self.debug = 0
         self.echo_attempts = 3
-        self.chunksize = 0x38
+        self.echo_window = EchoWindow(0x38)  # at most, stay below the size of the UART FIFO
+        self.metrics = Metrics()
+        self.frame_size = FRAME_MAX
+        self.frame_attempts = 5
+        self.commands = {}
+        self.timeout = 1
+        self.echo_timeout = 0.2
+        self.pending = collections.deque()
+        self.rxbuf = bytearray()
+        self.last_activity = time.monotonic()
+        self.batch_depth = 0
+        self.batched = []
+        self.dirty = DirtyRanges()  # RAM written since the last cache sync
+        self.scratch_addr = 0x82f00000  # free RAM for uploaded scripts
 
     def connection_test(self):
-        self.s.write(b'\n')
+        self.transmit(b'\n')
         time.sleep(0.2)
         answer = self.s.read_all()
         if (b'\r\n' + self.prompt) in answer:
@@ -86,84 +364,334 @@ class Lolmon:
             error(f'{prefix}: {s}')
         return s
 
+    def receive(self):
+        # Wait for data from the monitor, but return as soon as some has arrived
+        data = self.s.read(max(1, self.s.in_waiting))
+        if data:
+            self.metrics.count('rx', len(data))
+            self.rxbuf += self.debug_log('receive', data)
+            self.last_activity = time.monotonic()
+        return data != b''
+
     def read_until_prompt(self):
-        answer = bytearray()
-        timeout = 1
+        self.last_activity = time.monotonic()
         while True:
-            if self.s.readable():
-                answer += self.debug_log('until prompt', self.s.read_all())
-                if self.prompt in answer:
-                    return bytes(answer)[:-len(self.prompt)], True
-            else:
-                time.sleep(0.05)
-                timeout -= 0.05
-
-            if timeout < 0:
-                return bytes(answer), False
+            index = self.rxbuf.find(self.prompt)
+            if index >= 0:
+                answer = bytes(self.rxbuf[:index])
+                del self.rxbuf[:index + len(self.prompt)]
+                return answer, True
+            if not self.receive() and time.monotonic() - self.last_activity > self.timeout:
+                answer = bytes(self.rxbuf)
+                self.rxbuf.clear()
+                self.metrics.count('prompt_timeouts')
+                return answer, False
+
+    def note(self, text):
+        # Mark the start of a command in a session trace, if one is being recorded
+        note = getattr(self.s, 'note', None)
+        if note:
+            note(text)
+
+    def transmit(self, data, payload=False):
+        # Write to the port; typed characters come back as echo, payload doesn't
+        self.metrics.count('tx_payload' if payload else 'tx_echoed', len(data))
+        self.s.write(data)
+
+    def drain(self):
+        # Discard input until the line has been quiet for the serial timeout
+        self.rxbuf.clear()
+        while self.debug_log('flush', self.s.read(max(1, self.s.in_waiting))) != b'':
+            pass
 
     def flush(self):
-        while self.debug_log('flush', self.s.read_all()) != b'':
-            time.sleep(0.05)
+        self.pending.clear()
+        self.drain()
         self.run_command('')
 
-    def enter_with_echo(self, cmd, chunksize):
-        if isinstance(cmd, str):
-            cmd = cmd.encode('UTF-8')
-        assert not b'\n' in cmd
+    def clear_line(self):
+        # Clear the prompt (send Ctrl-U)
+        self.transmit(b'\025')
+        self.drain()
 
-        pos = 0
-        while pos < len(cmd):
-            chunk = cmd[pos:pos+chunksize]
-            assert len(chunk) >= 1
-            self.s.write(chunk)
-            echo = self.s.read(len(chunk))
-            if self.debug >= 2:
-                error(f'input {chunk} -> {echo}')
-            if echo != chunk:
-                error(f'Echo error! {chunk} -> {echo}')
-                error((echo + self.s.read_all()).decode('ascii'))
-                return False
-            pos += len(chunk)
-        return True
+    def enter_with_echo(self):
+        # Type ahead into the command that comes after those already entered
+        for c in self.pending:
+            if not c.entered:
+                break
+        else:
+            return
 
-    def run_command(self, cmd):
+        while True:
+            if c.echoed == len(c.cmd):
+                self.transmit(b'\n')
+                c.entered = True
+                self.last_activity = time.monotonic()
+                if c.raw:
+                    crlf = self.s.read(2)
+                    self.metrics.count('rx', len(crlf))
+                    self.finish(c, b'', crlf == b'\r\n')
+                return
+
+            window = self.echo_window.window() - (c.sent - c.echoed)
+            if c.sent == len(c.cmd) or window <= 0:
+                return
+            chunk = c.cmd[c.sent:c.sent+window]
+            self.transmit(chunk)
+            if c.started is None:
+                c.started = time.monotonic()
+                self.note(c.cmd)
+            if self.debug >= 2:
+                error(f'input {chunk}')
+            if c.sent == c.echoed:
+                # Only the echo of the current command measures the round trip time
+                c.flight_start = time.monotonic() if c is self.pending[0] else None
+                if c.flight_start:
+                    self.last_activity = c.flight_start
+            c.sent += len(chunk)
+
+    def echo_stats(self):
+        return self.echo_window.stats()
+
+    def echo_error(self, c, echo):
+        error(f'Echo error! {c.cmd[c.echoed:c.sent]} -> {bytes(echo)}')
+        self.clear_line()
+        # ... and retry
+        c.sent = c.echoed = 0
+        self.echo_window.shrink()
+        self.metrics.count('echo_retries')
+        c.attempts += 1
+        if c.attempts >= self.echo_attempts:
+            error(f'Giving up on command \'{c}\'')
+            self.finish(c, b'', False)
+
+    def finish(self, c, answer, good):
+        c.answer = answer
+        c.good = good
+        c.done = True
+        self.pending.remove(c)
+        if c.started is not None and c.timed:
+            self.metrics.record(c.verb(), time.monotonic() - c.started)
+        if c.check and any(e in answer for e in MONITOR_ERRORS):
+            error('Command \'%s\' failed:\n%s' % (c, answer.decode('UTF-8', errors='replace').strip()))
+
+    def process_rx(self):
+        # Match received data to the pending commands, in order
+        while self.pending and self.rxbuf:
+            c = self.pending[0]
+            if not c.entered:
+                expected = c.cmd[c.echoed:c.sent]
+                echo = self.rxbuf[:len(expected)]
+                if not expected or not expected.startswith(echo):
+                    self.echo_error(c, echo)
+                    return
+                c.echoed += len(echo)
+                del self.rxbuf[:len(echo)]
+                self.metrics.count('rx_echo', len(echo))
+                self.echo_window.grow(len(echo))
+                if c.echoed == c.sent and c.flight_start:
+                    self.echo_window.sample_rtt(time.monotonic() - c.flight_start)
+                    c.flight_start = None
+                self.enter_with_echo()
+            else:
+                if len(self.rxbuf) < 2:
+                    return
+                if self.rxbuf[2:].startswith(self.prompt):
+                    end = 2
+                else:
+                    index = self.rxbuf.find(b'\r\n' + self.prompt, max(2, c.scanned))
+                    if index < 0:
+                        c.scanned = max(2, len(self.rxbuf) - len(self.prompt) - 2)
+                        return
+                    end = index + 2
+                if self.rxbuf[:2] != b'\r\n':
+                    error(f'Command \'{c}\': unexpected response {bytes(self.rxbuf[:2])}')
+                answer = bytes(self.rxbuf[2:end])
+                del self.rxbuf[:end + len(self.prompt)]
+                self.metrics.count('rx_payload', len(answer))
+                self.finish(c, answer, True)
+
+    def handle_timeout(self):
+        c = self.pending[0]
+        if not c.entered:
+            self.echo_error(c, self.rxbuf)
+            return
+
+        answer = bytes(self.rxbuf[2:])
+        self.metrics.count('timeouts')
+        error('Command \'%s\' timed out:\n%s' % (c, answer.decode('UTF-8', errors='replace')))
+        self.finish(c, b'', False)
+        self.clear_line()
+        for c in self.pending:
+            c.sent = c.echoed = 0
+
+    def pump(self):
+        self.enter_with_echo()
+        if not self.pending:
+            return
+        if self.receive():
+            self.process_rx()
+            return
+
+        c = self.pending[0]
+        timeout = (c.timeout or self.timeout) if c.entered else self.echo_window.timeout(self.echo_timeout)
+        if time.monotonic() - self.last_activity > timeout:
+            self.handle_timeout()
+
+    def send_command(self, cmd, check=True, raw=False, timeout=None, timed=True):
+        """Send a command without waiting for it to complete.
+
+        The command is typed (and its echo checked) while the previous one
+        is still running, and its output is collected in the background.
+        If check is true, errors reported by the monitor are printed.
+        """
+        c = Command(cmd, check, raw, timeout, timed)
+        if self.debug:
+            error(':> %s' % c)
+        self.pending.append(c)
         try:
-            chunksize = self.chunksize
-            for _ in range(self.echo_attempts):
-                if self.debug:
-                    error(':> %s' % cmd)
-                good = self.enter_with_echo(cmd, chunksize)
-                if not good:
-                    # Clear the prompt (send Ctrl-U)
-                    self.s.write(b'\025')
-                    time.sleep(0.01)
-                    while self.s.read_all() != b'':
-                        time.sleep(0.01)
-                    # ... and retry
-                    chunksize = 1
-                    continue
-
-                self.s.write(b'\n')
-                assert self.s.read(2) == b'\r\n'
+            while not c.entered and not c.done:
+                self.pump()
+        except KeyboardInterrupt as e:
+            time.sleep(0.10)
+            self.flush()
+            raise e
+        return c
 
-                answer, good = self.read_until_prompt()
-                if not good:
-                    error('Command \'%s\' timed out:\n%s' % (cmd, answer.decode('UTF-8')))
-                    return b''
-                return answer
-            return b''
+    def wait(self, c=None):
+        """Wait until the given command, or all pending commands, are done."""
+        try:
+            while (c is None and self.pending) or (c is not None and not c.done):
+                self.pump()
         except KeyboardInterrupt as e:
             time.sleep(0.10)
             self.flush()
             raise e
 
+    def submit(self, cmd):
+        # Send a command whose output is not needed, or queue it while batching
+        if self.batch_depth:
+            self.batched.append(cmd)
+            return None
+        return self.send_command(cmd)
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Queue up commands that don't produce output, such as writes, and
+        send them together at the end of the with block (or before the next
+        command that does produce output, e.g. a read)."""
+        self.batch_depth += 1
+        try:
+            yield self
+        finally:
+            self.batch_depth -= 1
+            if self.batch_depth == 0:
+                self.flush_batch()
+
+    def batch_lines(self):
+        # Join the batched commands into as few lines as possible
+        lines = []
+        for cmd in self.batched:
+            if lines and len(lines[-1]) + 1 + len(cmd) <= LINE_MAX:
+                lines[-1] += ';' + cmd
+            else:
+                lines.append(cmd)
+        self.batched = []
+        return lines
+
+    def flush_batch(self):
+        if not self.batched:
+            return
+        lines = self.batch_lines()
+
+        # Several lines are uploaded in one go and run as a script
+        if len(lines) > 1 and self.has_command('bwr'):
+            script = ('\n'.join(lines) + '\n\0').encode('UTF-8')
+            if self.write_binary(self.scratch_addr, script):
+                self.send_command(f'src {self.scratch_addr:x}')
+                return
+            error('Script upload failed, sending the commands one by one')
+        for line in lines:
+            self.send_command(line)
+
+    def enter_command(self, cmd, timed=True):
+        # Enter a command that does its own I/O instead of being handled by run_command.
+        # Its latency is recorded up to the echo, unless the caller times the whole command.
+        self.flush_batch()
+        self.wait()
+        return self.send_command(cmd, False, True, timed=timed).good
+
+    def run_command(self, cmd, timeout=None):
+        self.flush_batch()
+        c = self.send_command(cmd, False, timeout=timeout)
+        self.wait(c)
+        return c.answer
+
+    def ping(self):
+        # Check whether the monitor answers with a prompt, after clearing the line
+        self.pending.clear()
+        self.transmit(b'\025')
+        self.drain()
+        self.transmit(b'\n')
+        _, good = self.read_until_prompt()
+        return good
+
+    def stress_test(self, count=16, words=12):
+        # Echo random text, and see whether all of it makes it there and back unscathed
+        chars = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789!$%&()*+,-./:<=>?@[]^_{|}~'
+        tests = []
+        for _ in range(count):
+            text = ' '.join(''.join(random.choices(chars, k=8)) for _ in range(words))
+            tests.append((self.send_command(f'echo {text}', False), f'{text} \r\n'.encode()))
+        self.wait()
+        return all(c.good and c.attempts == 0 and c.answer == expected for c, expected in tests)
+
+    def negotiate_baud(self, uart=None, rates=BAUD_RATES):
+        """Switch to the fastest baud rate at which the stress test passes.
+        The result is remembered per device, and tried first next time."""
+        uart = uart or UART(self, UART0_BASE)
+        base = self.s.baudrate
+        try:
+            with open(BAUD_CACHE) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            cache = {}
+
+        remembered = cache.get(self.device)
+        candidates = [r for r in sorted(rates, reverse=True) if r > base and r != remembered]
+        if remembered and remembered > base:
+            candidates.insert(0, remembered)
+
+        rate = base
+        for baud in candidates:
+            if uart.baud_rate_error(baud) > 0.025:
+                continue
+            if uart.set_baud_rate(baud) and self.stress_test():
+                rate = baud
+                break
+            error(f'{baud} baud is unreliable, stepping down')
+            # Switch back, no matter whether the board is still at the old rate or not
+            for host_baud in (baud, base, baud, base):
+                self.s.baudrate = host_baud
+                if uart.set_baud_rate(base):
+                    break
+            else:
+                raise IOError(f'Lost contact with the monitor after trying {baud} baud')
+
+        cache[self.device] = rate
+        os.makedirs(os.path.dirname(BAUD_CACHE), exist_ok=True)
+        with open(BAUD_CACHE, 'w') as f:
+            json.dump(cache, f, indent=2)
+        return rate
+
+    def has_command(self, name):
+        if name not in self.commands:
+            answer = self.run_command(f'help {name}')
+            self.commands[name] = answer != b'' and b'Unknown command' not in answer
+        return self.commands[name]
+
     def run_command_noreturn(self, cmd):
-        if self.debug:
-            error(':> %s' % cmd)
-        self.enter_with_echo(cmd, self.chunksize)
-        self.s.write(b'\n')
-        #assert self.s.read(2) == b'\r\n'
-        self.s.read(2)
+        self.enter_command(cmd)
 
     def writeX(self, cmd, size, addr, value):
         #print('poke %s %08x %s' % (cmd, addr, value))
@@ -175,43 +703,325 @@ class Lolmon:
             v = value
             while len(v) > 0:
                 line = f'{cmd} {addr:x}'; i = 0
-                while i < 14 and i < len(v) and len(line + f' {v[i]}') <= 128:
+                while i < 14 and i < len(v) and len(line + f' {v[i]}') <= LINE_MAX:
                     line += f' {v[i]}'
                     i += 1
-                self.run_command(line)
+                self.submit(line)
+                self.dirty.add(addr, i * size)
                 v = v[i:]
                 addr += i * size
         else:
-            self.run_command("%s %08x %#x" % (cmd, addr, value))
+            self.submit("%s %08x %#x" % (cmd, addr, value))
+            self.dirty.add(addr, size)
 
     def write8(self, addr, value):  return self.writeX('wb', 1, addr, value)
     def write16(self, addr, value): return self.writeX('wh', 2, addr, value)
     def write32(self, addr, value): return self.writeX('ww', 4, addr, value)
 
-    def write_file(self, addr, filename):
+    def read_reply(self, timeout=1):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            reply = self.s.read(1)
+            if reply:
+                self.metrics.count('rx', 1)
+                return reply
+        return b''
+
+    def write_binary(self, addr, data):
+        data = memoryview(data).cast('B')
+        start = time.monotonic()
+        self.dirty.add(addr, len(data))
+        try:
+            if not self.enter_command(f'bwr {addr:x} {len(data):#x}', timed=False):
+                return False
+            reply = self.read_reply()
+            if reply != FRAME_ACK:
+                answer, _ = self.read_until_prompt()
+                error(f'bwr not ready: {(reply + answer).decode("ascii", errors="replace")}')
+                return False
+
+            pos = 0
+            while pos < len(data):
+                chunk = data[pos:pos+self.frame_size]
+                frame = make_frame(pos, chunk)
+                for _ in range(self.frame_attempts):
+                    self.transmit(frame, True)
+                    reply = self.read_reply()
+                    if reply == FRAME_ACK:
+                        break
+                    self.metrics.count('frame_retries')
+                    error(f'Frame at {addr+pos:08x} not acknowledged ({reply}), retrying')
+                else:
+                    self.transmit(struct.pack('<H', 0), True)
+                    self.read_until_prompt()
+                    error(f'Giving up on bwr at {addr+pos:08x}')
+                    return False
+                pos += len(chunk)
+
+            # An empty frame ends the transfer, also if the last ACK got lost
+            self.transmit(struct.pack('<H', 0), True)
+            answer, good = self.read_until_prompt()
+            self.metrics.record('bwr', time.monotonic() - start)
+            if good and data and self.has_command('crc'):
+                remote = self.checksums(addr, len(data), max(len(data), 1))
+                if remote != [zlib.crc32(data)]:
+                    error(f'bwr at {addr:08x}: CRC mismatch after the transfer')
+                    return False
+            return good
+        except KeyboardInterrupt as e:
+            time.sleep(0.10)
+            self.flush()
+            raise e
+
+    def write_bytes(self, addr, data):
+        if self.has_command('bwr'):
+            if self.write_binary(addr, data):
+                return
+            error('Binary write failed, falling back to wb')
+        self.write8(addr, data)
+
+    def write_compressed(self, addr, data, staging=None):
+        # Upload data LZMA-compressed and unpack it on the board. The compressed
+        # stream is staged right behind the destination, unless told otherwise.
+        packed = compress_lzma(data)
+        self.dirty.add(addr, len(data))
+        if staging is None:
+            staging = (addr + len(data) + 0xfff) & ~0xfff
+        self.write_bytes(staging, packed)
+        answer = self.run_command(f'unlz {staging:x} {len(packed):#x} {addr:x}',
+                                  timeout=1 + len(data) / MiB)
+        expected = b'%08x %08x' % (len(data), zlib.crc32(data))
+        if expected not in answer:
+            error(f'Decompression failed: {answer.decode("ascii", errors="replace").strip()}')
+            return False
+        return True
+
+    def write_file(self, addr, filename, compress=False):
         with open(filename, 'rb') as f:
             data = f.read()
             f.close()
-            self.write8(addr, data)
+            if compress and self.has_command('unlz'):
+                if self.write_compressed(addr, data):
+                    return
+                error('Falling back to an uncompressed write')
+            self.write_bytes(addr, data)
+
+    def checksums(self, addr, size, block):
+        # CRC32 of each block of a range, calculated on the board
+        answer = self.run_command(f'crc {addr:x} {size:#x} {block:#x}', timeout=1 + size / MiB)
+        return self.parse_r_output(answer)
+
+    def diff_blocks(self, addr, data, block=4096):
+        # Find the runs of blocks whose contents on the board differ from data,
+        # as (offset, length) pairs. Without the crc command, everything differs.
+        if not data or not self.has_command('crc'):
+            return [(0, len(data))] if data else []
+        remote = self.checksums(addr, len(data), block)
+        runs = []
+        for i, offset in enumerate(range(0, len(data), block)):
+            chunk = data[offset:offset+block]
+            if i < len(remote) and remote[i] == zlib.crc32(chunk):
+                continue
+            if runs and runs[-1][0] + runs[-1][1] == offset:
+                runs[-1] = (runs[-1][0], runs[-1][1] + len(chunk))
+            else:
+                runs.append((offset, len(chunk)))
+        return runs
+
+    def sync_file(self, addr, filename, block=4096):
+        # Like write_file, but only upload the blocks that changed since the last time
+        with open(filename, 'rb') as f:
+            data = f.read()
+        sent = 0
+        for offset, length in self.diff_blocks(addr, data, block):
+            self.write_bytes(addr + offset, data[offset:offset+length])
+            sent += length
+        return sent
+
+    def verify(self, addr, filename):
+        with open(filename, 'rb') as f:
+            data = f.read()
+        if self.has_command('crc'):
+            return self.checksums(addr, len(data), max(len(data), 1)) == [zlib.crc32(data)]
+        return self.read_bytes(addr, len(data)) == data
+
+    def flash_read(self, memaddr, flashaddr, size):
+        self.dirty.add(memaddr, size)
+        self.run_command(f'flrd {flashaddr:x} {memaddr:x} {size:#x}', timeout=1 + size / FLASH_READ_RATE)
 
     def flash(self, memaddr, flashaddr, size):
-        self.run_command("fl %08x %08x %#x" % (memaddr, flashaddr, size))
+        # Write to flash, sector by sector. Sectors that already contain the
+        # data are skipped; returns the numbers of sectors written and unchanged.
+        sectors = (size + FLASH_SECTOR - 1) // FLASH_SECTOR
+        answer = self.run_command(f'flwr {memaddr:x} {flashaddr:x} {size:#x}',
+                                  timeout=1 + sectors * FLASH_SECTOR_TIME)
+        m = re.search(rb'^([0-9a-f]{8}) ([0-9a-f]{8})', answer, re.M)
+        if not m or any(e in answer for e in MONITOR_ERRORS):
+            error(f'Flash write failed: {answer.decode("ascii", errors="replace").strip()}')
+            return None
+        return int(m.group(1), 16), int(m.group(2), 16)
+
+    def program_flash(self, image, flashaddr=0, staging=0x81000000):
+        # Bring the flash up to date with image (data or a filename), by reading
+        # the flash into RAM at staging, and comparing checksums of each sector.
+        # Only the sectors that differ are uploaded, erased and programmed.
+        if isinstance(image, str):
+            with open(image, 'rb') as f:
+                image = f.read()
+        assert flashaddr % FLASH_SECTOR == 0
+        if not self.has_command('flwr'):
+            error('This monitor has no flash commands')
+            return False
+
+        self.flash_read(staging, flashaddr, len(image))
+        runs = self.diff_blocks(staging, image, FLASH_SECTOR)
+        written = 0
+        for offset, length in runs:
+            self.write_bytes(staging + offset, image[offset:offset+length])
+            result = self.flash(staging + offset, flashaddr + offset, length)
+            if result is None:
+                return False
+            written += result[0]
+
+        # flwr verifies each sector as it goes; check the whole runs once more
+        for offset, length in runs:
+            self.flash_read(staging + offset, flashaddr + offset, length)
+            if self.diff_blocks(staging + offset, image[offset:offset+length], FLASH_SECTOR):
+                error(f'Flash contents at {flashaddr + offset:#x} differ after programming')
+                return False
+        sectors = (len(image) + FLASH_SECTOR - 1) // FLASH_SECTOR
+        print(f'{written} of {sectors} flash sectors programmed')
+        return True
+
+    def read_flash_block(self, staging, flashaddr, size):
+        # Read a piece of flash through RAM, checked end to end against a CRC
+        # calculated on the board. Returns None if it doesn't match.
+        self.flash_read(staging, flashaddr, size)
+        remote = self.checksums(staging, size, size)
+        data = self.read_bytes(staging, size)
+        return bytes(data) if remote == [zlib.crc32(data)] else None
+
+    def dump_flash(self, path, size=16*MiB, staging=0x81000000, block=64*KiB, attempts=3):
+        # Read the whole flash into path. Blocks that are done are recorded with
+        # their CRC in path.progress, so that an interrupted dump resumes where
+        # it stopped; bad blocks are retried. Returns the SHA256 of the image.
+        if not self.has_command('flrd'):
+            error('This monitor has no flash commands')
+            return None
+        progress_path = path + '.progress'
+        done = {}
+        try:
+            with open(progress_path) as f:
+                state = json.load(f)
+            if state['size'] == size and state['block'] == block:
+                done = {int(index): crc for index, crc in state['done'].items()}
+        except (OSError, ValueError, KeyError):
+            pass
+
+        def save_progress():
+            with open(progress_path + '.tmp', 'w') as f:
+                json.dump({'size': size, 'block': block, 'done': done}, f)
+            os.replace(progress_path + '.tmp', progress_path)
+
+        with open(path, 'r+b' if os.path.exists(path) else 'w+b') as f:
+            f.truncate(size)    # sparse, until the blocks are filled in
+            for index, crc in list(done.items()):
+                f.seek(index * block)
+                if zlib.crc32(f.read(block)) != crc:
+                    del done[index]
+
+            todo = [i for i in range((size + block - 1) // block) if i not in done]
+            start = time.monotonic()
+            for attempt in range(attempts):
+                failed = []
+                for index in todo:
+                    offset = index * block
+                    data = self.read_flash_block(staging, offset, min(block, size - offset))
+                    if data is None:
+                        error(f'Bad block at {offset:#x}')
+                        failed.append(index)
+                        continue
+                    f.seek(offset)
+                    f.write(data)
+                    done[index] = zlib.crc32(data)
+                    save_progress()
+                    progress('flash', min(len(done) * block, size), size, start)
+                todo = failed
+                if not todo:
+                    break
+            if todo:
+                error(f'Giving up on {len(todo)} blocks; run dump_flash again to retry them')
+                return None
+
+            f.seek(0)
+            sha256 = hashlib.sha256(f.read()).hexdigest()
+        os.remove(progress_path)
+        print(f'{path}: SHA256 {sha256}')
+        return sha256
+
+    def make_fill(cmd, size, wr):
+        # Fill count elements with value, value + step, ...; on the board if possible
+        def fn(self, addr, value, count, step=0):
+            if self.has_command(cmd):
+                self.submit('%s %08x %d %#x %#x' % (cmd, addr, count, value, step))
+                self.dirty.add(addr, count * size)
+            else:
+                mask = BIT(8 * size) - 1
+                wr(self, addr, [(value + i * step) & mask for i in range(count)])
+        return fn
+
+    fill8 = make_fill('fb', 1, write8)
+    fill16 = make_fill('fh', 2, write16)
+    fill32 = make_fill('fw', 4, write32)
 
     def memset(self, addr, value, size):
         value16 = value << 8 | value
         value32 = value16 << 16 | value16
         while size > 0:
             if addr & 3 != 0 or size < 4:
-                n = size & 3 or 1
-                self.write8(addr, [value] * n)
+                n = min(-addr & 3 or size, size)
+                self.fill8(addr, value, n)
                 addr += n
                 size -= n
             else:
                 n = size // 4
-                self.write32(addr, [value32] * n)
+                self.fill32(addr, value32, n)
                 addr += n * 4
                 size -= n * 4
 
+    # Test patterns: words containing their own address, or counting up from zero
+    PATTERNS = {
+        'address': lambda addr: (addr, 4),
+        'increment': lambda addr: (0, 1),
+    }
+
+    def fill_pattern(self, addr, size, pattern='address'):
+        start, step = self.PATTERNS[pattern](addr)
+        self.fill32(addr, start, size // 4, step)
+
+    @classmethod
+    def pattern_data(cls, addr, size, pattern='address'):
+        start, step = cls.PATTERNS[pattern](addr)
+        words = array.array('I', ((start + i * step) & MASK(32) for i in range(size // 4)))
+        if sys.byteorder != 'little':
+            words.byteswap()
+        return words.tobytes()
+
+    def ram_test(self, addr, size, pattern='address'):
+        size &= ~3
+        self.fill_pattern(addr, size, pattern)
+        expected = self.pattern_data(addr, size, pattern)
+        # Only read back the blocks whose checksums are off, to find the bad word
+        for start, length in self.diff_blocks(addr, expected):
+            data = self.read_bytes(addr + start, length)
+            for offset in range(start, start + length, 4):
+                got = data[offset-start:offset-start+4]
+                if got != expected[offset:offset+4]:
+                    error(f'RAM test failed at {addr + offset:08x}: '
+                          f'{from_le32(got):08x} != {from_le32(expected[offset:offset+4]):08x}')
+                    return False
+        return True
+
     def parse_r_output(self, s):
         array = []
         s = s.decode('UTF-8')
@@ -229,27 +1039,116 @@ class Lolmon:
         elif size==1: return bytes(a)
         else:         return a
 
+    def read_exact(self, buf, timeout=1):
+        pos = 0
+        deadline = time.monotonic() + timeout
+        while pos < len(buf) and time.monotonic() < deadline:
+            n = self.s.readinto(buf[pos:])
+            self.metrics.count('rx', n)
+            pos += n
+        return pos == len(buf)
+
+    def read_binary(self, addr, buf, show_progress=False):
+        buf = memoryview(buf).cast('B')
+        header = memoryview(bytearray(2))
+        trailer = memoryview(bytearray(4))
+        start = time.monotonic()
+        try:
+            if not self.enter_command(f'brd {addr:x} {len(buf):#x}', timed=False):
+                return False
+            reply = self.read_reply()
+            if reply != FRAME_ACK:
+                answer, _ = self.read_until_prompt()
+                error(f'brd not ready: {(reply + answer).decode("ascii", errors="replace")}')
+                return False
+
+            pos = 0
+            failures = 0
+            start = time.monotonic()
+            while pos < len(buf):
+                size = min(len(buf) - pos, FRAME_MAX)
+                frame = buf[pos:pos+size]
+                if (self.read_exact(header) and struct.unpack('<H', header)[0] == size and
+                        self.read_exact(frame) and self.read_exact(trailer) and
+                        struct.unpack('<I', trailer)[0] == zlib.crc32(frame)):
+                    self.transmit(FRAME_ACK, True)
+                    self.metrics.count('rx_payload', size)
+                    pos += size
+                    failures = 0
+                    if show_progress:
+                        progress('brd', pos, len(buf), start)
+                    continue
+
+                self.metrics.count('frame_retries')
+                self.drain()
+                failures += 1
+                if failures >= self.frame_attempts:
+                    # Anything but ACK or NAK makes brd give up
+                    self.transmit(b'\0', True)
+                    self.read_until_prompt()
+                    self.flush()
+                    error(f'Giving up on brd at {addr+pos:08x}')
+                    return False
+                error(f'Bad frame at {addr+pos:08x}, retrying')
+                self.transmit(FRAME_NAK, True)
+
+            answer, good = self.read_until_prompt()
+            self.metrics.record('brd', time.monotonic() - start)
+            return good
+        except KeyboardInterrupt as e:
+            time.sleep(0.10)
+            self.flush()
+            raise e
+
+    def read_bytes(self, addr, n, show_progress=False):
+        buf = bytearray(n)
+        if self.has_command('brd'):
+            if self.read_binary(addr, buf, show_progress):
+                return buf
+            error('Binary read failed, falling back to rb')
+        return bytearray(self.read8(addr, n)) if n != 1 else bytearray([self.read8(addr)])
+
+    def read_file(self, addr, n, filename, show_progress=True):
+        data = self.read_bytes(addr, n, show_progress)
+        with open(filename, 'wb') as f:
+            f.write(data)
+            f.close()
+
     def read8(self, addr, num=1):  return self.readX('rb', 1, addr, num)
     def read16(self, addr, num=1): return self.readX('rh', 2, addr, num)
     def read32(self, addr, num=1): return self.readX('rw', 4, addr, num)
 
-    def copyX(self, cmd, dest, src, num):
-        self.run_command("%s %08x %08x %d" % (cmd, src, dest, num))
+    def copyX(self, cmd, size, dest, src, num):
+        self.submit("%s %08x %08x %d" % (cmd, src, dest, num))
+        self.dirty.add(dest, num * size)
+
+    def copy8(self, dest, src, num):  self.copyX('cb', 1, dest, src, num)
+    def copy16(self, dest, src, num): self.copyX('ch', 2, dest, src, num)
+    def copy32(self, dest, src, num): self.copyX('cw', 4, dest, src, num)
+
+    def make_modify(cmd, size, rd, wr):
+        # Read-modify-write, done by the monitor if it can
+        def fn(self, addr, mask, value):
+            if self.has_command(cmd):
+                self.submit('%s %08x %#x %#x' % (cmd, addr, mask, value & mask))
+                self.dirty.add(addr, size)
+            else:
+                x = rd(self, addr)
+                wr(self, addr, x & ~mask | value & mask)
+        return fn
 
-    def copy8(self, dest, src, num):  self.copyX('cb', dest, src, num)
-    def copy16(self, dest, src, num): self.copyX('ch', dest, src, num)
-    def copy32(self, dest, src, num): self.copyX('cw', dest, src, num)
+    modify8 = make_modify('mb', 1, read8, write8)
+    modify16 = make_modify('mh', 2, read16, write16)
+    modify32 = make_modify('mw', 4, read32, write32)
 
-    def make_setclr(rd, wr):
+    def make_setclr(modify):
         def fn(self, addr, bit, value):
-            x = rd(self, addr)
-            if value: wr(self, addr, x |  (1 << bit))
-            else:     wr(self, addr, x & ~(1 << bit))
+            modify(self, addr, 1 << bit, -1 if value else 0)
         return fn
 
-    setclr8 = make_setclr(read8, write8)
-    setclr16 = make_setclr(read16, write16)
-    setclr32 = make_setclr(read32, write32)
+    setclr8 = make_setclr(modify8)
+    setclr16 = make_setclr(modify16)
+    setclr32 = make_setclr(modify32)
 
     def make_dump(cmd):
         def fn(self, addr, length):
@@ -285,43 +1184,206 @@ class Lolmon:
         self.write16(self.riu_addr(offset + 2), (value >> 16) & 0xffff)
 
 
-    def call(self, addr, a=0, b=0, c=0, d=0):
-        self.run_command_noreturn('call %x %d %d %d %d' % (addr, a, b, c, d))
+    def riu_modify8(self, offset, mask, value):  return self.modify8 (self.riu_addr(offset), mask, value)
+    def riu_modify16(self, offset, mask, value): return self.modify16(self.riu_addr(offset), mask, value)
+    def riu_modify32(self, offset, mask, value):
+        self.modify16(self.riu_addr(offset + 0), (mask >>  0) & 0xffff, (value >>  0) & 0xffff)
+        self.modify16(self.riu_addr(offset + 2), (mask >> 16) & 0xffff, (value >> 16) & 0xffff)
+
+
+    def sync_line(self, prefix, n):
+        # prefix and the dirty ranges, merged into fewer ones if the line gets too long
+        for k in range(n, 0, -1):
+            line = prefix + ''.join(f' {s:x} {e - s:#x}' for s, e in self.dirty.coalesce(k))
+            if len(line) <= LINE_MAX:
+                return line
+        return None
+
+    def sync(self, full=False):
+        """Synchronize the caches for the RAM written since the last sync
+        (through write*, copy*, fill*, memset, write_file and the like), or
+        for all of RAM. Commands sent with run_command aren't tracked."""
+        if full:
+            self.run_command('sync')
+        elif self.dirty.ranges:
+            self.run_command(self.sync_line('sync', SYNC_RANGES) or 'sync')
+        self.dirty.clear()
+
+    def call_line(self, addr, a, b, c, d, full_sync, sync):
+        # The call command, with the ranges to synchronize before. Without
+        # tracked ranges, all of RAM is synchronized: it may still have been
+        # written by commands that aren't tracked. A lone '/' skips the sync.
+        line = 'call %x %d %d %d %d' % (addr, a, b, c, d)
+        if not sync:
+            line += ' /'
+        elif not full_sync and self.dirty.ranges:
+            line = self.sync_line(line + ' /', CALL_RANGES) or line
+        self.dirty.clear()
+        return line
+
+    def call(self, addr, a=0, b=0, c=0, d=0, full_sync=False, sync=True):
+        self.run_command_noreturn(self.call_line(addr, a, b, c, d, full_sync, sync))
 
     def call_linux_and_run_microcom(self, addr):
         self.call(addr, 0, 0xffffffff, 0)
         os.system(f'busybox microcom -s {self.s.baudrate} /dev/ttyUSB0')
 
+# Shadow cache policies for Block registers
+CACHEABLE  = 'cacheable'    # reads are served from the shadow copy once known
+WRITE_ONLY = 'write-only'   # reads are served from what was last written
+VOLATILE   = 'volatile'     # never cached, e.g. status registers
+
+class Shadow:
+    """Write-through shadow copy of a block's registers, byte by byte"""
+    def __init__(self, default=CACHEABLE):
+        self.default = default
+        self.regions = []
+        self.values = {}
+        self.hits = 0
+        self.misses = 0
+
+    def add_region(self, start, size, policy):
+        self.regions.append((start, start + size, policy))
+
+    def policy(self, offset):
+        for start, end, policy in reversed(self.regions):
+            if start <= offset < end:
+                return policy
+        return self.default
+
+    def lookup(self, offset, size):
+        if self.policy(offset) == VOLATILE:
+            return None
+        value = 0
+        for i in range(size):
+            if offset + i not in self.values:
+                self.misses += 1
+                return None
+            value |= self.values[offset + i] << (8 * i)
+        self.hits += 1
+        return value
+
+    def update(self, offset, size, value, written):
+        policy = self.policy(offset)
+        if policy == VOLATILE or (policy == WRITE_ONLY and not written):
+            return
+        for i in range(size):
+            self.values[offset + i] = value >> (8 * i) & 0xff
+
+    def invalidate(self, offset=None, size=1):
+        if offset is None:
+            self.values.clear()
+            return
+        for i in range(size):
+            self.values.pop(offset + i, None)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'cached': len(self.values)}
+
 class Block:
+    # Shadow cache policies, as (offset, size, policy), in normal and RIU
+    # notation, and the policy for everything else
+    shadow_regions = []
+    riu_shadow_regions = []
+    shadow_default = CACHEABLE
+
     def __init__(self, lolmon, base=None):
         self.l = lolmon
+        self.shadow = None
         if base:
             self.base = base
             if base in range(0xbf000000, 0xc0000000):
                 self.riu_base = (base - 0xbf000000) // 2
 
-    def read8(self, offset): return self.l.read8(self.base + offset)
-    def read16(self, offset): return self.l.read16(self.base + offset)
-    def read32(self, offset): return self.l.read32(self.base + offset)
-
-    def write8(self, offset, value): return self.l.write8(self.base + offset, value)
-    def write16(self, offset, value): return self.l.write16(self.base + offset, value)
-    def write32(self, offset, value): return self.l.write32(self.base + offset, value)
-
-    def setclr8(self, offset, bit, value): return self.l.setclr8(self.base + offset, bit, value)
-    def setclr16(self, offset, bit, value): return self.l.setclr16(self.base + offset, bit, value)
-    def setclr32(self, offset, bit, value): return self.l.setclr32(self.base + offset, bit, value)
+    def enable_shadow(self, default=None):
+        """Keep a shadow copy of the registers, so that reading back values
+        that were written before (including read-modify-write) doesn't take
+        a trip to the board. Registers that change by themselves need a
+        VOLATILE region, see shadow_regions, or a VOLATILE default."""
+        self.shadow = Shadow(default or self.shadow_default)
+        for offset, size, policy in self.shadow_regions:
+            self.shadow.add_region(offset, size, policy)
+        for offset, size, policy in self.riu_shadow_regions:
+            for o in range(offset & ~1, offset + size, 2):
+                self.shadow.add_region(self.riu_offset(o), 2, policy)
+
+    def disable_shadow(self):
+        self.shadow = None
+
+    def invalidate(self, offset=None, size=1):
+        if self.shadow:
+            self.shadow.invalidate(offset, size)
+
+    def shadow_stats(self):
+        return self.shadow.stats() if self.shadow else None
+
+    def cached_read(self, offset, size, rd):
+        if self.shadow:
+            value = self.shadow.lookup(offset, size)
+            if value is not None:
+                return value
+        value = rd(self.base + offset)
+        if self.shadow and isinstance(value, int):
+            self.shadow.update(offset, size, value, False)
+        return value
+
+    def write_through(self, offset, size, value, wr):
+        if self.shadow:
+            values = list(value) if hasattr(value, '__iter__') else [value]
+            for i, v in enumerate(values):
+                self.shadow.update(offset + i * size, size, v, True)
+        return wr(self.base + offset, value)
+
+    def modify_through(self, offset, size, mask, value, md, wr):
+        if self.shadow:
+            old = self.shadow.lookup(offset, size)
+            if old is not None:
+                return self.write_through(offset, size, old & ~mask | value & mask, wr)
+            self.shadow.invalidate(offset, size)
+        return md(self.base + offset, mask, value)
+
+    def read8(self, offset): return self.cached_read(offset, 1, self.l.read8)
+    def read16(self, offset): return self.cached_read(offset, 2, self.l.read16)
+    def read32(self, offset): return self.cached_read(offset, 4, self.l.read32)
+
+    def write8(self, offset, value): return self.write_through(offset, 1, value, self.l.write8)
+    def write16(self, offset, value): return self.write_through(offset, 2, value, self.l.write16)
+    def write32(self, offset, value): return self.write_through(offset, 4, value, self.l.write32)
+
+    def modify8(self, offset, mask, value): return self.modify_through(offset, 1, mask, value, self.l.modify8, self.l.write8)
+    def modify16(self, offset, mask, value): return self.modify_through(offset, 2, mask, value, self.l.modify16, self.l.write16)
+    def modify32(self, offset, mask, value): return self.modify_through(offset, 4, mask, value, self.l.modify32, self.l.write32)
+
+    def setclr8(self, offset, bit, value): return self.modify8(offset, 1 << bit, -1 if value else 0)
+    def setclr16(self, offset, bit, value): return self.modify16(offset, 1 << bit, -1 if value else 0)
+    def setclr32(self, offset, bit, value): return self.modify32(offset, 1 << bit, -1 if value else 0)
+
+    def batch(self): return self.l.batch()
 
     def dump(self):
         self.l.dump32(self.base, 0x40)
 
-    def riu_read8(self, offset): return self.l.riu_read8(self.riu_base + offset)
-    def riu_read16(self, offset): return self.l.riu_read16(self.riu_base + offset)
-    def riu_read32(self, offset): return self.l.riu_read32(self.riu_base + offset)
+    # RIU accessors, see Lolmon.riu_addr
+    def riu_offset(self, offset): return self.l.riu_addr(self.riu_base + offset) - self.base
+
+    def riu_read8(self, offset): return self.read8(self.riu_offset(offset))
+    def riu_read16(self, offset): return self.read16(self.riu_offset(offset))
+    def riu_read32(self, offset):
+        lo = self.riu_read16(offset)
+        hi = self.riu_read16(offset + 2)
+        return lo | (hi << 16)
+
+    def riu_write8(self, offset, value): return self.write8(self.riu_offset(offset), value)
+    def riu_write16(self, offset, value): return self.write16(self.riu_offset(offset), value)
+    def riu_write32(self, offset, value):
+        self.riu_write16(offset + 0, (value >>  0) & 0xffff)
+        self.riu_write16(offset + 2, (value >> 16) & 0xffff)
 
-    def riu_write8(self, offset, value): return self.l.riu_write8(self.riu_base + offset, value)
-    def riu_write16(self, offset, value): return self.l.riu_write16(self.riu_base + offset, value)
-    def riu_write32(self, offset, value): return self.l.riu_write32(self.riu_base + offset, value)
+    def riu_modify8(self, offset, mask, value): return self.modify8(self.riu_offset(offset), mask, value)
+    def riu_modify16(self, offset, mask, value): return self.modify16(self.riu_offset(offset), mask, value)
+    def riu_modify32(self, offset, mask, value):
+        self.riu_modify16(offset + 0, (mask >>  0) & 0xffff, (value >>  0) & 0xffff)
+        self.riu_modify16(offset + 2, (mask >> 16) & 0xffff, (value >> 16) & 0xffff)
 
 
 class EMAC(Block):
@@ -349,12 +1411,21 @@ class EMAC(Block):
     CTL_WES = BIT(7)
     CTL_BP  = BIT(8)
 
+    # Status registers change by themselves
+    riu_shadow_regions = [
+        (SR,  4, VOLATILE),
+        (TSR, 4, VOLATILE),
+        (RSR, 4, VOLATILE),
+        (ISR, 4, VOLATILE),
+        (IMR, 4, VOLATILE),
+    ]
+
     def read_macaddr(self, offset):
         lo = self.riu_read32(offset)
         hi = self.riu_read32(offset + 4)
         return f'{lo:x}{hi:x}'
 
-    def init(self):
+    def init(self, ephy):
         self.mystery_init_sequence()
         self.riu_write32(0x100, 0xf051)
         self.riu_read32(self.CTL)
@@ -387,58 +1458,61 @@ class EMAC(Block):
         self.riu_write32(self.TAR, addr & 0x03ffffff)
         self.riu_write32(self.TCR, size)
 
-    @staticmethod
-    def mystery_init_sequence():
+    def mystery_init_sequence(self):
         """
         A series of magic writes that successfully brings the Ethernet link up.
         Ripped from vendor firmware, but it's a series of uncopyrightable facts. ;)
         """
-        uVar1 = l.riu_read8(0x121f60);
-        l.riu_write8(0x121f60,uVar1 & 0xfc | 2);
-        l.riu_write8(0x103364,0x10);
-        l.riu_write8(0x121f23,8);
-        l.riu_write8(0x121f24,8);
-        l.riu_write8(0x121f25,0);
-        uVar1 = l.riu_read8(0xe60);
-        l.riu_write8(0xe60,uVar1 & 0xfe);
-        l.riu_write8(0x324f,2);
-        l.riu_write8(0x3251,1);
-        l.riu_write8(0x3277,0x18);
-        l.riu_write8(0x3172,0x80);
-        l.riu_write8(0x32fc,0);
-        l.riu_write8(0x32fd,0);
-        l.riu_write8(0x32b7,7);
-        l.riu_write8(0x32cb,0x11);
-        l.riu_write8(0x32cc,0x80);
-        l.riu_write8(0x32cd,0xd1);
-        l.riu_write8(0x32d4,0);
-        l.riu_write8(0x32b9,0x40);
-        l.riu_write8(0x32bb,5);
-        l.riu_write8(0x32ea,0x46);
-        l.riu_write8(0x33a1,0);
-        l.riu_write8(0x333a,3);
-        l.riu_write8(0x333b,0);
-        l.riu_write8(0x33c5,0);
-        l.riu_write8(0x3330,0x43);
-        l.riu_write8(0x3339,0x41);
-        l.riu_write8(0x33e8,6);
-        l.riu_write8(0x312b,0);
-        l.riu_write8(0x33e8,0);
-        l.riu_write8(0x312b,0);
-        l.riu_write8(0x33e8,6);
-        l.riu_write8(0x31aa,0x1c);
-        l.riu_write8(0x31ac,0x1c);
-        l.riu_write8(0x31ad,0x1c);
-        l.riu_write8(0x31ae,0x1c);
-        l.riu_write8(0x31af,0x1c);
-        l.riu_write8(0x33e8,0);
-        l.riu_write8(0x33e8,0);
-        l.riu_write8(0x31ab,0x28);
+        with self.l.batch():
+            self.l.riu_modify8(0x121f60,0x03,2);
+            self.l.riu_write8(0x103364,0x10);
+            self.l.riu_write8(0x121f23,8);
+            self.l.riu_write8(0x121f24,8);
+            self.l.riu_write8(0x121f25,0);
+            self.l.riu_modify8(0xe60,0x01,0);
+            self.l.riu_write8(0x324f,2);
+            self.l.riu_write8(0x3251,1);
+            self.l.riu_write8(0x3277,0x18);
+            self.l.riu_write8(0x3172,0x80);
+            self.l.riu_write8(0x32fc,0);
+            self.l.riu_write8(0x32fd,0);
+            self.l.riu_write8(0x32b7,7);
+            self.l.riu_write8(0x32cb,0x11);
+            self.l.riu_write8(0x32cc,0x80);
+            self.l.riu_write8(0x32cd,0xd1);
+            self.l.riu_write8(0x32d4,0);
+            self.l.riu_write8(0x32b9,0x40);
+            self.l.riu_write8(0x32bb,5);
+            self.l.riu_write8(0x32ea,0x46);
+            self.l.riu_write8(0x33a1,0);
+            self.l.riu_write8(0x333a,3);
+            self.l.riu_write8(0x333b,0);
+            self.l.riu_write8(0x33c5,0);
+            self.l.riu_write8(0x3330,0x43);
+            self.l.riu_write8(0x3339,0x41);
+            self.l.riu_write8(0x33e8,6);
+            self.l.riu_write8(0x312b,0);
+            self.l.riu_write8(0x33e8,0);
+            self.l.riu_write8(0x312b,0);
+            self.l.riu_write8(0x33e8,6);
+            self.l.riu_write8(0x31aa,0x1c);
+            self.l.riu_write8(0x31ac,0x1c);
+            self.l.riu_write8(0x31ad,0x1c);
+            self.l.riu_write8(0x31ae,0x1c);
+            self.l.riu_write8(0x31af,0x1c);
+            self.l.riu_write8(0x33e8,0);
+            self.l.riu_write8(0x33e8,0);
+            self.l.riu_write8(0x31ab,0x28);
 
 class EPHY(Block):
+    # MDIO registers are mostly status, or have self-clearing bits like
+    # BMCR; only the advertisement register (ANAR) is plain control
+    shadow_default = VOLATILE
+    shadow_regions = [(4 * 4, 2, CACHEABLE)]
+
     # MDIO read/write
     def read(self, offset):
-        self.write16(4, self.read16(4) | 4)
+        self.modify16(4, 4, 4)
         return self.read16(4 * offset)
 
     def write(self, offset, value):
@@ -446,7 +1520,7 @@ class EPHY(Block):
 
     def dump(self):
         for j in range(0, 32, 8):
-            print('  '.join([hex(ephy.read(j+i)).rjust(6, ' ') for i in range(8)]))
+            print('  '.join([hex(self.read(j+i)).rjust(6, ' ') for i in range(8)]))
 
     def check(self):
         self.write(0, 0x2100)
@@ -456,7 +1530,7 @@ class EPHY(Block):
         self.link()
 
     def link(self):
-        print(f'link? {ephy.read(1) & 4}')
+        print(f'link? {self.read(1) & 4}')
 
 class Pinmux(Block):
     # RIU offset 2
@@ -469,14 +1543,63 @@ class Pinmux(Block):
     #   - 0xfff0 -> ok
     #   - 0xf -> writing anything but 0x4 breaks uart
     def dump(self):
-        l.dump16(self.base, 0x100)
+        self.l.dump16(self.base, 0x100)
 
 
-UART = Block
+class UART(Block):
+    # 16550-style registers, 8 bytes apart
+    DLL = 0x00
+    DLM = 0x08
+    LCR = 0x18
+    LSR = 0x28
+    LCR_DLAB = 0x80
+    LSR_TEMT = 0x40
 
-l = Lolmon('/dev/ttyUSB0')
-l.connection_test()
-pinmux = Pinmux(l, 0xbf203c00)
-uart0 = UART(l, 0xbf201300)
-emac = EMAC(l, 0xbf243600)
-ephy = EPHY(l, 0xbf006200)
+    def __init__(self, lolmon, base=None):
+        super().__init__(lolmon, base)
+        self.clock = None
+
+    def divisor(self):
+        # Output while DLAB is set would go to DLL, so the divisor latch is
+        # only copied to RAM, and read from there once LCR is restored
+        lcr = self.read16(self.LCR)
+        scratch = self.l.scratch_addr
+        self.l.run_command(f'wh {self.base + self.LCR:x} {lcr | self.LCR_DLAB:#x}; '
+                           f'cb {self.base + self.DLL:x} {scratch:x} 1; '
+                           f'cb {self.base + self.DLM:x} {scratch + 1:x} 1; '
+                           f'wh {self.base + self.LCR:x} {lcr:#x}')
+        dll, dlm = self.l.read8(scratch, 2)
+        return dlm << 8 | dll
+
+    def get_clock(self):
+        # Estimate the UART clock from the divisor for the baud rate that works right now
+        if self.clock is None:
+            self.clock = self.divisor() * 16 * self.l.s.baudrate
+        return self.clock
+
+    def baud_rate_error(self, baud):
+        divisor = max(1, round(self.get_clock() / (16 * baud)))
+        return abs(self.get_clock() / (16 * divisor) - baud) / baud
+
+    def set_baud_rate(self, baud):
+        """Program the divisor for a new baud rate, follow on the host side,
+        and return whether the monitor still answers."""
+        divisor = max(1, round(self.get_clock() / (16 * baud)))
+        lcr = self.read16(self.LCR)
+        # Wait until the UART has sent the line feed at the old rate
+        self.l.enter_command(f'ph {self.base + self.LSR:x} {self.LSR_TEMT:#x} {self.LSR_TEMT:#x}; '
+                             f'wh {self.base + self.LCR:x} {lcr | self.LCR_DLAB:#x}; '
+                             f'wh {self.base + self.DLL:x} {divisor & 0xff:#x}; '
+                             f'wh {self.base + self.DLM:x} {divisor >> 8:#x}; '
+                             f'wh {self.base + self.LCR:x} {lcr:#x}')
+        time.sleep(0.05)
+        self.l.s.baudrate = baud
+        return self.l.ping()
+
+if __name__ == '__main__':
+    l = Lolmon(sys.argv[1] if len(sys.argv) > 1 else '/dev/ttyUSB0')
+    l.connection_test()
+    pinmux = Pinmux(l, 0xbf203c00)
+    uart0 = UART(l, UART0_BASE)
+    emac = EMAC(l, 0xbf243600)
+    ephy = EPHY(l, 0xbf006200)
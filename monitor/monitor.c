@@ -14,6 +14,9 @@
 
 /* MMIO accessors */
 
+#ifdef HOST
+#include "host.h"
+#else
 static uint8_t  read8(unsigned long addr)  { return *(volatile uint8_t *)addr; }
 static uint16_t read16(unsigned long addr) { return *(volatile uint16_t *)addr; }
 static uint32_t read32(unsigned long addr) { return *(volatile uint32_t *)addr; }
@@ -21,12 +24,14 @@ static uint32_t read32(unsigned long addr) { return *(volatile uint32_t *)addr;
 static void write8(unsigned long addr, uint8_t value)   { *(volatile uint8_t *)addr = value; }
 static void write16(unsigned long addr, uint16_t value) { *(volatile uint16_t *)addr = value; }
 static void write32(unsigned long addr, uint32_t value) { *(volatile uint32_t *)addr = value; }
+#endif
 
 
 /* UART driver */
 
 #define UART_BASE 0xbf201300
 #define UART_FIFO_MAX 64
+#define UART_RX_TIMEOUT 1000000 /* polls, roughly 100ms */
 
 static int uart_can_tx(void)
 {
@@ -38,11 +43,27 @@ static int uart_can_rx(void)
         return !!(read16(UART_BASE + 0x28) & 1);
 }
 
+/*
+ * Send length characters. Whenever the TX FIFO is empty, UART_FIFO_MAX
+ * characters fit into it, so the status is only checked once per burst.
+ */
+static void uart_tx_burst(const char *buf, size_t length)
+{
+        while (length) {
+                size_t n = min(length, (size_t)UART_FIFO_MAX);
+
+                while (!uart_can_tx())
+                        ;
+                for (size_t i = 0; i < n; i++)
+                        write32(UART_BASE + 0, buf[i]);
+                buf += n;
+                length -= n;
+        }
+}
+
 static void uart_tx(char ch)
 {
-        while (!uart_can_tx())
-                ;
-        write32(UART_BASE + 0, ch);
+        uart_tx_burst(&ch, 1);
 }
 
 static char uart_rx(void)
@@ -52,54 +73,118 @@ static char uart_rx(void)
         return read32(UART_BASE + 0);
 }
 
+/* Receive a character, unless none arrives within UART_RX_TIMEOUT polls */
+static bool uart_rx_timeout(uint8_t *ch)
+{
+        for (uint32_t i = 0; i < UART_RX_TIMEOUT; i++) {
+                if (uart_can_rx()) {
+                        *ch = read32(UART_BASE + 0);
+                        return true;
+                }
+        }
+
+        return false;
+}
+
 
 /* Console I/O functions */
 
-/* Print one character. LF is converted to CRLF. */
-static int putchar(int c)
+/*
+ * Output buffer: characters are collected on the stack, and sent in bursts
+ * of UART_FIFO_MAX. Set len to 0 before use, and call out_flush at the end.
+ */
+struct out {
+	size_t len;
+	char buf[UART_FIFO_MAX];
+};
+
+static void out_flush(struct out *o)
+{
+	uart_tx_burst(o->buf, o->len);
+	o->len = 0;
+}
+
+/* Add a byte, as is. */
+static void out_byte(struct out *o, uint8_t byte)
+{
+	if (o->len == sizeof(o->buf))
+		out_flush(o);
+	o->buf[o->len++] = byte;
+}
+
+/* Add a character. LF is converted to CRLF. */
+static void out_char(struct out *o, char c)
 {
 	if (c == '\n')
-		uart_tx('\r');
-	uart_tx(c);
-	return c;
+		out_byte(o, '\r');
+	out_byte(o, c);
 }
 
-/* Print a string. */
-static void putstr(const char *s)
+static void out_str(struct out *o, const char *s)
 {
 	for (const char *p = s; *p; p++)
-		putchar(*p);
+		out_char(o, *p);
 }
 
-/* Print a line. CRLF is added at the end. */
-static int puts(const char *s)
+/* Add a number in hex, with the given number of digits. */
+static void out_hex(struct out *o, uint32_t x, int digits)
 {
-	putstr(s);
-	putchar('\n');
-	return 0;
+	static const char hex[16] = "0123456789abcdef";
+
+	for (int shift = 4 * (digits - 1); shift >= 0; shift -= 4)
+		out_byte(o, hex[(x >> shift) & 15]);
 }
 
-/* Print a 8-bit number in hex. */
-static void put_hex8(uint8_t x)
+/* Add a little-endian number of up to four bytes. */
+static void out_le(struct out *o, uint32_t x, size_t bytes)
 {
-	static const char hex[16] = "0123456789abcdef";
+	for (size_t i = 0; i < bytes; i++)
+		out_byte(o, x >> (8 * i));
+}
 
-	putchar(hex[x >> 4]);
-	putchar(hex[x & 15]);
+/* Print one character. LF is converted to CRLF. */
+static int putchar(int c)
+{
+	if (c == '\n')
+		uart_tx_burst("\r\n", 2);
+	else
+		uart_tx(c);
+	return c;
 }
 
-/* Print a 16-bit number in hex. */
-static void put_hex16(uint16_t x)
+/* Print a string. */
+static void putstr(const char *s)
 {
-	put_hex8(x >> 8);
-	put_hex8(x & 255);
+	struct out o;
+
+	o.len = 0;
+	out_str(&o, s);
+	out_flush(&o);
 }
 
-/* Print a 32-bit number in hex. */
-static void put_hex32(uint32_t x)
+/* Print a line. CRLF is added at the end. */
+static int puts(const char *s)
 {
-	put_hex16(x >> 16);
-	put_hex16(x & 65535);
+	struct out o;
+
+	o.len = 0;
+	out_str(&o, s);
+	out_char(&o, '\n');
+	out_flush(&o);
+	return 0;
+}
+
+/* Print two 32-bit numbers in hex, as a line. */
+static void put_hex32_pair(uint32_t a, uint32_t b)
+{
+	struct out o;
+
+	o.len = 0;
+	out_hex(&o, a, 8);
+	out_byte(&o, ' ');
+	out_hex(&o, b, 8);
+	out_char(&o, '\n');
+	out_flush(&o);
 }
 
 /* Get a character from the UART */
@@ -185,6 +270,588 @@ static bool parse_int(const char *s, uint32_t base, uint32_t *result)
 }
 
 
+/* Binary transfers */
+
+/*
+ * Binary data is sent in frames of the following form, all numbers being
+ * little-endian:
+ *
+ *   u16 length, length bytes of payload, u32 CRC32 of the payload    (brd)
+ *   u16 length, u32 offset, length bytes of payload,
+ *   u32 CRC32 of the offset and payload                              (bwr)
+ *
+ * The receiver of a frame answers with ACK if the CRC matches, and with NAK
+ * otherwise. A frame of length zero aborts the transfer. In bwr, the offset
+ * of the payload within the transfer tells a frame that the host sends again,
+ * because our ACK got lost, from the next one: it is acknowledged again, but
+ * not stored. For the same reason, bwr only ends with a frame of length zero
+ * from the host, which is an abort only if data is missing.
+ */
+#define FRAME_MAX 1024
+#define FRAME_ACK 0x06
+#define FRAME_NAK 0x15
+#define FRAME_ACK_TIMEOUTS 10
+
+static const uint32_t crc32_table[16] = {
+	0x00000000, 0x1db71064, 0x3b6e20c8, 0x26d930ac,
+	0x76dc4190, 0x6b6b51f4, 0x4db26158, 0x5005713c,
+	0xedb88320, 0xf00f9344, 0xd6d6a3e8, 0xcb61b38c,
+	0x9b64c2b0, 0x86d3d2d4, 0xa00ae278, 0xbdbdf21c,
+};
+
+/* Update a CRC32 (as in zlib) with one byte. Start with ~0, end with ~crc. */
+static uint32_t crc32_update(uint32_t crc, uint8_t byte)
+{
+	crc ^= byte;
+	crc = (crc >> 4) ^ crc32_table[crc & 15];
+	crc = (crc >> 4) ^ crc32_table[crc & 15];
+	return crc;
+}
+
+/* Calculate the CRC32 of length bytes at addr */
+static uint32_t crc32_range(unsigned long addr, uint32_t length)
+{
+	uint32_t crc = ~0U;
+
+	for (uint32_t i = 0; i < length; i++)
+		crc = crc32_update(crc, read8(addr + i));
+	return ~crc;
+}
+
+/* Receive a little-endian number of up to four bytes */
+static bool recv_le(uint32_t *result, size_t bytes)
+{
+	uint32_t x = 0;
+	uint8_t ch;
+
+	for (size_t i = 0; i < bytes; i++) {
+		if (!uart_rx_timeout(&ch))
+			return false;
+		x |= (uint32_t)ch << (8 * i);
+	}
+
+	*result = x;
+	return true;
+}
+
+/* Discard received data until the line is idle, to get back in sync */
+static void recv_drain(void)
+{
+	uint8_t ch;
+
+	while (uart_rx_timeout(&ch))
+		;
+}
+
+/*
+ * Receive one frame of a transfer of length bytes to addr, of which pos bytes
+ * have been received so far, and advance pos by the new bytes. Returns the
+ * payload length, 0 if the transfer was aborted, or -1 on error.
+ */
+static int recv_frame(unsigned long addr, uint32_t *pos, uint32_t length)
+{
+	uint32_t size, offset, crc = ~0U, expected;
+	bool again;
+	uint8_t ch;
+
+	if (!recv_le(&size, 2))
+		return -1;
+	if (size == 0)
+		return 0;
+	if (!recv_le(&offset, 4))
+		return -1;
+	if (size > FRAME_MAX || offset > *pos || size > length - offset)
+		return -1;
+
+	/* A frame before pos was stored already, so it is only checked */
+	again = offset < *pos;
+	for (int i = 0; i < 4; i++)
+		crc = crc32_update(crc, offset >> (8 * i));
+	for (uint32_t i = 0; i < size; i++) {
+		if (!uart_rx_timeout(&ch))
+			return -1;
+		if (!again)
+			write8(addr + offset + i, ch);
+		crc = crc32_update(crc, ch);
+	}
+
+	if (!recv_le(&expected, 4) || expected != ~crc)
+		return -1;
+
+	if (!again)
+		*pos += size;
+	return size;
+}
+
+/* Send one frame of length bytes, read from addr */
+static void send_frame(unsigned long addr, uint32_t length)
+{
+	uint32_t crc = ~0U;
+	struct out o;
+
+	o.len = 0;
+	out_le(&o, length, 2);
+	for (uint32_t i = 0; i < length; i++) {
+		uint8_t ch = read8(addr + i);
+
+		out_byte(&o, ch);
+		crc = crc32_update(crc, ch);
+	}
+	out_le(&o, ~crc, 4);
+	out_flush(&o);
+}
+
+/* Wait for the host to acknowledge a frame. Returns the answer, or 0 on timeout. */
+static uint8_t recv_ack(void)
+{
+	uint8_t ch;
+
+	for (int i = 0; i < FRAME_ACK_TIMEOUTS; i++)
+		if (uart_rx_timeout(&ch))
+			return ch;
+
+	return 0;
+}
+
+
+/* LZMA decompression */
+
+/*
+ * A small decoder for LZMA-alone streams (.lzma, as written by
+ * tools/lzma-compress.py), following the LZMA specification. The output
+ * buffer doubles as the dictionary, so no window needs to be allocated.
+ */
+#define LZMA_HEADER_SIZE 13
+#define LZMA_PROB_BITS 11
+#define LZMA_PROB_INIT (1 << (LZMA_PROB_BITS - 1))
+#define LZMA_MOVE_BITS 5
+#define LZMA_STATES 12
+#define LZMA_POS_STATES_MAX 16
+#define LZMA_LC_LP_MAX 3
+#define LZMA_END_POS_MODEL 14
+#define LZMA_FULL_DISTANCES 128
+#define LZMA_ALIGN_BITS 4
+#define LZMA_MATCH_MIN_LEN 2
+
+struct lzma_rc {
+	const uint8_t *in, *end;
+	uint32_t range, code;
+	bool error;
+};
+
+struct lzma_len_probs {
+	uint16_t choice, choice2;
+	uint16_t low[LZMA_POS_STATES_MAX][1 << 3];
+	uint16_t mid[LZMA_POS_STATES_MAX][1 << 3];
+	uint16_t high[1 << 8];
+};
+
+struct lzma_probs {
+	uint16_t is_match[LZMA_STATES][LZMA_POS_STATES_MAX];
+	uint16_t is_rep[LZMA_STATES];
+	uint16_t is_rep_g0[LZMA_STATES];
+	uint16_t is_rep_g1[LZMA_STATES];
+	uint16_t is_rep_g2[LZMA_STATES];
+	uint16_t is_rep0_long[LZMA_STATES][LZMA_POS_STATES_MAX];
+	uint16_t pos_slot[4][1 << 6];
+	uint16_t pos[1 + LZMA_FULL_DISTANCES - LZMA_END_POS_MODEL];
+	uint16_t align[1 << LZMA_ALIGN_BITS];
+	struct lzma_len_probs len, rep_len;
+	uint16_t literal[0x300 << LZMA_LC_LP_MAX];
+};
+
+static uint8_t lzma_rc_byte(struct lzma_rc *rc)
+{
+	if (rc->in == rc->end) {
+		rc->error = true;
+		return 0;
+	}
+	return *rc->in++;
+}
+
+static void lzma_rc_normalize(struct lzma_rc *rc)
+{
+	if (rc->range < (1U << 24)) {
+		rc->range <<= 8;
+		rc->code = (rc->code << 8) | lzma_rc_byte(rc);
+	}
+}
+
+static uint32_t lzma_bit(struct lzma_rc *rc, uint16_t *prob)
+{
+	uint32_t bound = (rc->range >> LZMA_PROB_BITS) * *prob;
+	uint32_t bit;
+
+	if (rc->code < bound) {
+		*prob += ((1 << LZMA_PROB_BITS) - *prob) >> LZMA_MOVE_BITS;
+		rc->range = bound;
+		bit = 0;
+	} else {
+		*prob -= *prob >> LZMA_MOVE_BITS;
+		rc->code -= bound;
+		rc->range -= bound;
+		bit = 1;
+	}
+	lzma_rc_normalize(rc);
+	return bit;
+}
+
+static uint32_t lzma_direct_bits(struct lzma_rc *rc, int bits)
+{
+	uint32_t result = 0;
+
+	while (bits--) {
+		rc->range >>= 1;
+		result <<= 1;
+		if (rc->code >= rc->range) {
+			rc->code -= rc->range;
+			result |= 1;
+		}
+		lzma_rc_normalize(rc);
+	}
+	return result;
+}
+
+static uint32_t lzma_bittree(struct lzma_rc *rc, uint16_t *probs, int bits)
+{
+	uint32_t m = 1;
+
+	for (int i = 0; i < bits; i++)
+		m = (m << 1) | lzma_bit(rc, &probs[m]);
+	return m - (1 << bits);
+}
+
+static uint32_t lzma_bittree_reverse(struct lzma_rc *rc, uint16_t *probs, int bits)
+{
+	uint32_t m = 1, symbol = 0;
+
+	for (int i = 0; i < bits; i++) {
+		uint32_t bit = lzma_bit(rc, &probs[m]);
+
+		m = (m << 1) | bit;
+		symbol |= bit << i;
+	}
+	return symbol;
+}
+
+static uint32_t lzma_len(struct lzma_rc *rc, struct lzma_len_probs *p, uint32_t pos_state)
+{
+	if (!lzma_bit(rc, &p->choice))
+		return lzma_bittree(rc, p->low[pos_state], 3);
+	if (!lzma_bit(rc, &p->choice2))
+		return 8 + lzma_bittree(rc, p->mid[pos_state], 3);
+	return 16 + lzma_bittree(rc, p->high, 8);
+}
+
+static uint32_t lzma_distance(struct lzma_rc *rc, struct lzma_probs *p, uint32_t len)
+{
+	uint32_t slot = lzma_bittree(rc, p->pos_slot[min(len, 3)], 6);
+	uint32_t bits, dist;
+
+	if (slot < 4)
+		return slot;
+
+	bits = (slot >> 1) - 1;
+	dist = (2 | (slot & 1)) << bits;
+	if (slot < LZMA_END_POS_MODEL)
+		return dist + lzma_bittree_reverse(rc, p->pos + dist - slot, bits);
+
+	dist += lzma_direct_bits(rc, bits - LZMA_ALIGN_BITS) << LZMA_ALIGN_BITS;
+	return dist + lzma_bittree_reverse(rc, p->align, LZMA_ALIGN_BITS);
+}
+
+/*
+ * Decompress an LZMA-alone stream of in_len bytes to out. Returns the number
+ * of bytes written, or -1 if the stream is corrupt or uses unsupported
+ * parameters.
+ */
+static long lzma_decompress(const uint8_t *in, uint32_t in_len, uint8_t *out)
+{
+	/* About 14 KiB, too much for the stack; see monitor.ld */
+	static struct lzma_probs p;
+	struct lzma_rc rc = { in + LZMA_HEADER_SIZE, in + in_len, ~0U, 0, false };
+	uint32_t lc, lp, pb, size = ~0U, pos = 0, state = 0;
+	uint32_t rep0 = 0, rep1 = 0, rep2 = 0, rep3 = 0;
+
+	if (in_len < LZMA_HEADER_SIZE + 5 || in[0] >= 9 * 5 * 5)
+		return -1;
+	lc = in[0] % 9;
+	lp = in[0] / 9 % 5;
+	pb = in[0] / 45;
+	if (lc + lp > LZMA_LC_LP_MAX)
+		return -1;
+
+	/* The 64-bit size is either all ones (unknown, ends with a marker) or fits 32 bits */
+	if ((in[9] | in[10] | in[11] | in[12]) == 0)
+		size = in[5] | in[6] << 8 | in[7] << 16 | (uint32_t)in[8] << 24;
+	else if ((in[9] & in[10] & in[11] & in[12]) != 0xff)
+		return -1;
+
+	for (uint16_t *prob = (uint16_t *)&p; prob < (uint16_t *)(&p + 1); prob++)
+		*prob = LZMA_PROB_INIT;
+
+	if (lzma_rc_byte(&rc) != 0)
+		return -1;
+	for (int i = 0; i < 4; i++)
+		rc.code = (rc.code << 8) | lzma_rc_byte(&rc);
+
+	while (pos < size && !rc.error) {
+		uint32_t pos_state = pos & ((1 << pb) - 1);
+		uint32_t len;
+
+		if (!lzma_bit(&rc, &p.is_match[state][pos_state])) {
+			uint8_t prev = pos ? out[pos - 1] : 0;
+			uint16_t *probs = &p.literal[0x300 * (((pos & ((1 << lp) - 1)) << lc) + (prev >> (8 - lc)))];
+			uint32_t symbol = 1;
+
+			if (state >= 7) {
+				uint32_t match = out[pos - rep0 - 1];
+
+				do {
+					uint32_t match_bit = (match >> 7) & 1;
+					uint32_t bit;
+
+					match <<= 1;
+					bit = lzma_bit(&rc, &probs[((1 + match_bit) << 8) + symbol]);
+					symbol = (symbol << 1) | bit;
+					if (bit != match_bit)
+						break;
+				} while (symbol < 0x100);
+			}
+			while (symbol < 0x100)
+				symbol = (symbol << 1) | lzma_bit(&rc, &probs[symbol]);
+
+			out[pos++] = symbol;
+			state = state < 4 ? 0 : state < 10 ? state - 3 : state - 6;
+			continue;
+		}
+
+		if (lzma_bit(&rc, &p.is_rep[state])) {
+			if (pos == 0)
+				return -1;
+			if (!lzma_bit(&rc, &p.is_rep_g0[state])) {
+				if (!lzma_bit(&rc, &p.is_rep0_long[state][pos_state])) {
+					out[pos] = out[pos - rep0 - 1];
+					pos++;
+					state = state < 7 ? 9 : 11;
+					continue;
+				}
+			} else {
+				uint32_t dist;
+
+				if (!lzma_bit(&rc, &p.is_rep_g1[state])) {
+					dist = rep1;
+				} else {
+					if (!lzma_bit(&rc, &p.is_rep_g2[state])) {
+						dist = rep2;
+					} else {
+						dist = rep3;
+						rep3 = rep2;
+					}
+					rep2 = rep1;
+				}
+				rep1 = rep0;
+				rep0 = dist;
+			}
+			len = lzma_len(&rc, &p.rep_len, pos_state);
+			state = state < 7 ? 8 : 11;
+		} else {
+			rep3 = rep2;
+			rep2 = rep1;
+			rep1 = rep0;
+			len = lzma_len(&rc, &p.len, pos_state);
+			state = state < 7 ? 7 : 10;
+			rep0 = lzma_distance(&rc, &p, len);
+			if (rep0 == ~0U)
+				break; /* end marker */
+			if (rep0 >= pos)
+				return -1;
+		}
+
+		len += LZMA_MATCH_MIN_LEN;
+		if (len > size - pos)
+			return -1;
+		while (len--) {
+			out[pos] = out[pos - rep0 - 1];
+			pos++;
+		}
+	}
+
+	if (rc.error || (size != ~0U && pos != size))
+		return -1;
+	return pos;
+}
+
+
+/* SPI flash, through the ISP (in-system programming) controller */
+
+#define ISP_BASE 0xbf002000
+#define ISP_REG(n) (ISP_BASE + 4 * (n))
+#define ISP_PASSWORD		ISP_REG(0x00)
+#define ISP_SPI_WDATA		ISP_REG(0x04)
+#define ISP_SPI_RDATA		ISP_REG(0x05)
+#define ISP_SPI_CECLR		ISP_REG(0x08)
+#define ISP_SPI_RDREQ		ISP_REG(0x0c)
+#define ISP_SPI_RD_DATARDY	ISP_REG(0x15)
+#define ISP_SPI_WR_DATARDY	ISP_REG(0x16)
+#define ISP_PASSWORD_ENTER 0xaaaa
+#define ISP_PASSWORD_EXIT  0x5555
+#define ISP_TIMEOUT 100000 /* polls */
+
+#define SPI_PP   0x02	/* page program */
+#define SPI_READ 0x03
+#define SPI_RDSR 0x05	/* read status register */
+#define SPI_WREN 0x06	/* write enable */
+#define SPI_SE   0x20	/* 4k sector erase */
+#define SPI_SR_WIP 0x01	/* write in progress */
+
+#define FLASH_SECTOR 4096
+#define FLASH_PAGE 256
+#define FLASH_BUSY_TIMEOUT 100000 /* status polls, at least a second */
+
+static bool isp_wait(unsigned long reg)
+{
+	for (uint32_t i = 0; i < ISP_TIMEOUT; i++)
+		if (read16(reg) & 1)
+			return true;
+	return false;
+}
+
+static bool spi_tx(uint8_t byte)
+{
+	write16(ISP_SPI_WDATA, byte);
+	return isp_wait(ISP_SPI_WR_DATARDY);
+}
+
+static bool spi_rx(uint8_t *byte)
+{
+	write16(ISP_SPI_RDREQ, 1);
+	if (!isp_wait(ISP_SPI_RD_DATARDY))
+		return false;
+	*byte = read16(ISP_SPI_RDATA);
+	return true;
+}
+
+/* Deselect the flash chip, which ends the current command */
+static void spi_end(void)
+{
+	write16(ISP_SPI_CECLR, 1);
+}
+
+/* Start a command with a 24-bit address */
+static bool flash_start(uint8_t cmd, uint32_t addr)
+{
+	return spi_tx(cmd) && spi_tx(addr >> 16) && spi_tx(addr >> 8) && spi_tx(addr);
+}
+
+static bool flash_wait_idle(void)
+{
+	for (uint32_t i = 0; i < FLASH_BUSY_TIMEOUT; i++) {
+		uint8_t status;
+		bool ok = spi_tx(SPI_RDSR) && spi_rx(&status);
+
+		spi_end();
+		if (!ok)
+			return false;
+		if (!(status & SPI_SR_WIP))
+			return true;
+	}
+	return false;
+}
+
+static bool flash_write_enable(void)
+{
+	bool ok = spi_tx(SPI_WREN);
+
+	spi_end();
+	return ok;
+}
+
+static bool flash_read(uint32_t src, uint8_t *dest, uint32_t length)
+{
+	bool ok = flash_start(SPI_READ, src);
+
+	for (uint32_t i = 0; ok && i < length; i++)
+		ok = spi_rx(&dest[i]);
+	spi_end();
+	return ok;
+}
+
+/* Compare flash contents with memory; *same is only valid if true is returned */
+static bool flash_compare(uint32_t addr, const uint8_t *data, uint32_t length, bool *same)
+{
+	bool ok = flash_start(SPI_READ, addr);
+
+	*same = true;
+	for (uint32_t i = 0; ok && i < length && *same; i++) {
+		uint8_t byte;
+
+		ok = spi_rx(&byte);
+		*same = byte == data[i];
+	}
+	spi_end();
+	return ok;
+}
+
+static bool flash_erase_sector(uint32_t addr)
+{
+	bool ok = flash_write_enable() && flash_start(SPI_SE, addr);
+
+	spi_end();
+	return ok && flash_wait_idle();
+}
+
+static bool flash_program(uint32_t dest, const uint8_t *src, uint32_t length)
+{
+	while (length) {
+		/* A page program must not cross a page boundary */
+		uint32_t n = min(length, FLASH_PAGE - dest % FLASH_PAGE);
+		bool ok = flash_write_enable() && flash_start(SPI_PP, dest);
+
+		for (uint32_t i = 0; ok && i < n; i++)
+			ok = spi_tx(src[i]);
+		spi_end();
+		if (!ok || !flash_wait_idle())
+			return false;
+
+		dest += n;
+		src += n;
+		length -= n;
+	}
+	return true;
+}
+
+/*
+ * Write one sector: The parts of it that aren't overwritten are preserved,
+ * and sectors that already contain the data are left alone. Returns 1 if
+ * the sector was written, 0 if it was unchanged, -1 on a timeout, and -2 if
+ * the written data doesn't verify.
+ */
+static int flash_write_sector(uint32_t dest, const uint8_t *src, uint32_t length)
+{
+	static uint8_t sector[FLASH_SECTOR];	/* off the stack, see monitor.ld */
+	uint32_t base = dest & ~(FLASH_SECTOR - 1), offset = dest - base;
+	bool same;
+
+	if (!flash_compare(dest, src, length, &same))
+		return -1;
+	if (same)
+		return 0;
+
+	if (!flash_read(base, sector, FLASH_SECTOR))
+		return -1;
+	memcpy(sector + offset, src, length);
+
+	if (!flash_erase_sector(base) || !flash_program(base, sector, FLASH_SECTOR))
+		return -1;
+	if (!flash_compare(base, sector, FLASH_SECTOR, &same))
+		return -1;
+	if (!same)
+		return -2;
+	return 1;
+}
+
+
 /* Command interpreter */
 
 struct command {
@@ -203,17 +870,22 @@ struct command {
 
 static void cmd_echo(int argc, char **argv)
 {
+	struct out o;
+
+	o.len = 0;
 	for (int i = 1; i < argc; i++) {
-		putstr(argv[i]);
-		putchar(' ');
+		out_str(&o, argv[i]);
+		out_char(&o, ' ');
 	}
-	putchar('\n');
+	out_char(&o, '\n');
+	out_flush(&o);
 }
 
 static void cmd_read(int argc, char **argv)
 {
-	size_t elems_per_line, increment, elems, addr, pos = 0;
+	uint32_t elems_per_line, increment, elems, addr, pos = 0;
 	char op = argv[0][1];
+	struct out o;
 
 	switch (argc) {
 	case 2:
@@ -248,45 +920,45 @@ static void cmd_read(int argc, char **argv)
 	if (!parse_int(argv[1], 16, &addr))
 		return;
 
+	o.len = 0;
 	for (size_t i = 0; i < elems; i++) {
 		uint32_t value;
 
 		/* Beginning of the line */
 		if (pos == 0) {
 			if (i)
-				putchar('\n');
-			put_hex32(addr);
-			putstr(": ");
+				out_char(&o, '\n');
+			out_hex(&o, addr, 8);
+			out_str(&o, ": ");
 		} else {
-			putchar(' ');
+			out_byte(&o, ' ');
 		}
 
 		switch (op) {
 		case 'b':
 			value = read8(addr);
-			put_hex8(value);
 			break;
 		case 'h':
 			value = read16(addr);
-			put_hex16(value);
 			break;
 		case 'w':
 			value = read32(addr);
-			put_hex32(value);
 			break;
 		}
+		out_hex(&o, value, 2 * increment);
 
 		addr += increment;
 		if (++pos == elems_per_line)
 			pos = 0;
 	}
 
-	putchar('\n');
+	out_char(&o, '\n');
+	out_flush(&o);
 }
 
 static void cmd_write(int argc, char **argv)
 {
-	size_t increment, addr;
+	uint32_t increment, addr;
 	char op = argv[0][1];
 
 	if (argc < 3) {
@@ -333,9 +1005,348 @@ static void cmd_write(int argc, char **argv)
 	}
 }
 
+static void cmd_fill(int argc, char **argv)
+{
+	uint32_t addr, count, value, step = 0;
+	size_t increment;
+	char op = argv[0][1];
+
+	if (argc != 4 && argc != 5) {
+		puts("Usage error");
+		return;
+	}
+
+	switch (op) {
+	case 'b':
+		increment = 1;
+		break;
+	case 'h':
+		increment = 2;
+		break;
+	case 'w':
+		increment = 4;
+		break;
+	default:
+		return;
+	}
+
+	if (!parse_int(argv[1], 16, &addr))
+		return;
+	if (!parse_int(argv[2], 0, &count))
+		return;
+	if (!parse_int(argv[3], 0, &value))
+		return;
+	if (argc == 5 && !parse_int(argv[4], 0, &step))
+		return;
+
+	for (size_t i = 0; i < count; i++) {
+		switch (op) {
+		case 'b':
+			write8(addr, value);
+			break;
+		case 'h':
+			write16(addr, value);
+			break;
+		case 'w':
+			write32(addr, value);
+			break;
+		}
+
+		value += step;
+		addr += increment;
+	}
+}
+
+static void cmd_modify(int argc, char **argv)
+{
+	uint32_t addr, mask, value;
+	char op = argv[0][1];
+
+	if (argc != 4) {
+		puts("Usage error");
+		return;
+	}
+
+	if (!parse_int(argv[1], 16, &addr))
+		return;
+	if (!parse_int(argv[2], 0, &mask))
+		return;
+	if (!parse_int(argv[3], 0, &value))
+		return;
+
+	value &= mask;
+
+	switch (op) {
+	case 'b':
+		write8(addr, (read8(addr) & ~mask) | value);
+		break;
+	case 'h':
+		write16(addr, (read16(addr) & ~mask) | value);
+		break;
+	case 'w':
+		write32(addr, (read32(addr) & ~mask) | value);
+		break;
+	}
+}
+
+#define POLL_TIMEOUT 10000000 /* polls, roughly a second */
+
+static void cmd_poll(int argc, char **argv)
+{
+	uint32_t addr, mask, value, x = 0;
+	char op = argv[0][1];
+
+	if (argc != 4) {
+		puts("Usage error");
+		return;
+	}
+
+	if (!parse_int(argv[1], 16, &addr))
+		return;
+	if (!parse_int(argv[2], 0, &mask))
+		return;
+	if (!parse_int(argv[3], 0, &value))
+		return;
+
+	value &= mask;
+
+	for (uint32_t i = 0; i < POLL_TIMEOUT; i++) {
+		switch (op) {
+		case 'b':
+			x = read8(addr);
+			break;
+		case 'h':
+			x = read16(addr);
+			break;
+		case 'w':
+			x = read32(addr);
+			break;
+		}
+		if ((x & mask) == value)
+			return;
+	}
+
+	puts("Poll timeout");
+}
+
+static void cmd_bwrite(int argc, char **argv)
+{
+	uint32_t addr, length, pos = 0;
+
+	if (argc != 3) {
+		puts("Usage error");
+		return;
+	}
+
+	if (!parse_int(argv[1], 16, &addr))
+		return;
+	if (!parse_int(argv[2], 0, &length))
+		return;
+
+	/* Tell the host that we're ready for the first frame */
+	uart_tx(FRAME_ACK);
+
+	for (;;) {
+		int res = recv_frame(addr, &pos, length);
+
+		if (res == 0) {
+			if (pos < length)
+				puts("Aborted");
+			return;
+		} else if (res < 0) {
+			recv_drain();
+			uart_tx(FRAME_NAK);
+		} else {
+			uart_tx(FRAME_ACK);
+		}
+	}
+}
+
+static void cmd_bread(int argc, char **argv)
+{
+	uint32_t addr, length, pos = 0;
+
+	if (argc != 3) {
+		puts("Usage error");
+		return;
+	}
+
+	if (!parse_int(argv[1], 16, &addr))
+		return;
+	if (!parse_int(argv[2], 0, &length))
+		return;
+
+	uart_tx(FRAME_ACK);
+
+	while (pos < length) {
+		uint32_t size = min(length - pos, FRAME_MAX);
+
+		send_frame(addr + pos, size);
+
+		switch (recv_ack()) {
+		case FRAME_ACK:
+			pos += size;
+			break;
+		case FRAME_NAK:
+			break;
+		default:
+			recv_drain();
+			puts("Aborted");
+			return;
+		}
+	}
+}
+
+static void cmd_unlzma(int argc, char **argv)
+{
+	uint32_t src, length, dest;
+	long size;
+
+	if (argc != 4) {
+		puts("Usage error");
+		return;
+	}
+
+	if (!parse_int(argv[1], 16, &src))
+		return;
+	if (!parse_int(argv[2], 0, &length))
+		return;
+	if (!parse_int(argv[3], 16, &dest))
+		return;
+
+	size = lzma_decompress((const uint8_t *)src, length, (uint8_t *)dest);
+	if (size < 0) {
+		puts("Corrupt LZMA data");
+		return;
+	}
+
+	/* Report the size and CRC32 of the output, for verification by the host */
+	put_hex32_pair(size, crc32_range(dest, size));
+}
+
+static void cmd_crc(int argc, char **argv)
+{
+	uint32_t addr, length, block, pos = 0;
+	struct out o;
+
+	switch (argc) {
+	case 3:
+		block = 0;
+		break;
+	case 4:
+		if (!parse_int(argv[3], 0, &block))
+			return;
+		break;
+	default:
+		puts("Usage error");
+		return;
+	}
+
+	if (!parse_int(argv[1], 16, &addr))
+		return;
+	if (!parse_int(argv[2], 0, &length))
+		return;
+	if (block == 0)
+		block = max(length, 1U);
+
+	/* One CRC32 per block, in the same layout as the output of rw */
+	o.len = 0;
+	for (uint32_t i = 0; i < length; i += block) {
+		if (pos == 0) {
+			if (i)
+				out_char(&o, '\n');
+			out_hex(&o, addr + i, 8);
+			out_str(&o, ": ");
+		} else {
+			out_byte(&o, ' ');
+		}
+
+		out_hex(&o, crc32_range(addr + i, min(length - i, block)), 8);
+
+		if (++pos == 8)
+			pos = 0;
+	}
+
+	out_char(&o, '\n');
+	out_flush(&o);
+}
+
+static void cmd_flash_read(int argc, char **argv)
+{
+	uint32_t src, dest, length;
+	bool ok;
+
+	if (argc != 4) {
+		puts("Usage error");
+		return;
+	}
+
+	if (!parse_int(argv[1], 16, &src))
+		return;
+	if (!parse_int(argv[2], 16, &dest))
+		return;
+	if (!parse_int(argv[3], 0, &length))
+		return;
+
+	write16(ISP_PASSWORD, ISP_PASSWORD_ENTER);
+	ok = flash_read(src, (uint8_t *)dest, length);
+	write16(ISP_PASSWORD, ISP_PASSWORD_EXIT);
+	if (!ok)
+		puts("Flash timeout");
+}
+
+static void cmd_flash_write(int argc, char **argv)
+{
+	uint32_t src, dest, length, written = 0, unchanged = 0;
+
+	if (argc != 4) {
+		puts("Usage error");
+		return;
+	}
+
+	if (!parse_int(argv[1], 16, &src))
+		return;
+	if (!parse_int(argv[2], 16, &dest))
+		return;
+	if (!parse_int(argv[3], 0, &length))
+		return;
+	if (dest % FLASH_SECTOR) {
+		puts("Usage error");
+		return;
+	}
+
+	write16(ISP_PASSWORD, ISP_PASSWORD_ENTER);
+	for (uint32_t i = 0; i < length; i += FLASH_SECTOR) {
+		int res = flash_write_sector(dest + i, (const uint8_t *)src + i,
+					     min(length - i, (uint32_t)FLASH_SECTOR));
+
+		if (res == -1) {
+			puts("Flash timeout");
+			break;
+		} else if (res == -2) {
+			struct out o;
+
+			o.len = 0;
+			out_str(&o, "Verify failed at ");
+			out_hex(&o, dest + i, 8);
+			out_char(&o, '\n');
+			out_flush(&o);
+			break;
+		}
+		if (res)
+			written++;
+		else
+			unchanged++;
+	}
+	write16(ISP_PASSWORD, ISP_PASSWORD_EXIT);
+
+	/* Report the number of sectors written and unchanged */
+	put_hex32_pair(written, unchanged);
+}
+
 static void cmd_copy(int argc, char **argv)
 {
-	size_t increment, src, dest, count;
+	uint32_t increment, src, dest, count;
 	char op = argv[0][1];
 
 	if (argc < 3) {
@@ -398,11 +1409,32 @@ static void cache_flush_range(unsigned long addr, size_t len)
 		synci_line_p(p);
 }
 
+/* Flush the ranges given as address/length pairs, or all of RAM if there are none */
+static bool cache_flush_ranges(int argc, char **argv)
+{
+	uint32_t addr, length;
+
+	if (argc % 2) {
+		puts("Usage error");
+		return false;
+	}
+
+	if (argc == 0) {
+		cache_flush_range(0x80000000, 64 * MiB);
+		return true;
+	}
+
+	for (int i = 0; i < argc; i += 2) {
+		if (!parse_int(argv[i], 16, &addr) || !parse_int(argv[i + 1], 0, &length))
+			return false;
+		cache_flush_range(addr, length);
+	}
+	return true;
+}
+
 static void cmd_sync(int argc, char **argv)
 {
-	(void)argc;
-	(void)argv;
-	cache_flush_range(0x80000000, 64 * MiB);
+	cache_flush_ranges(argc - 1, argv + 1);
 }
 
 /* MIPS relocations are weird... */
@@ -410,8 +1442,8 @@ extern char do_call[1];
 static void (* do_call_p)(uint32_t fn, uint32_t a1, uint32_t a2, uint32_t a3) = (void *)do_call;
 static void cmd_call(int argc, char **argv)
 {
-	uint32_t fn, args[3];
-	int i;
+	uint32_t fn, args[3] = { 0, 0, 0 };
+	int i, nargs;
 
 	if (argc < 2) {
 		puts("Usage error");
@@ -421,13 +1453,18 @@ static void cmd_call(int argc, char **argv)
 	if (!parse_int(argv[1], 16, &fn))
 		return;
 
-	for (i = 0; i < 3 && 2 + i < argc; i++) {
-		args[i] = 0;
-		if (2 + i < argc)
-			parse_int(argv[2 + i], 0, &args[i]);
-	}
+	/* Arguments may be followed by a slash and the ranges to synchronize */
+	for (nargs = 2; nargs < argc; nargs++)
+		if (argv[nargs][0] == '/' && !argv[nargs][1])
+			break;
+
+	for (i = 0; i < 3 && 2 + i < nargs; i++)
+		parse_int(argv[2 + i], 0, &args[i]);
 
-	cache_flush_range(0x80000000, 64 * MiB);
+	if (nargs == argc)
+		cache_flush_range(0x80000000, 64 * MiB);
+	else if (nargs + 1 < argc && !cache_flush_ranges(argc - nargs - 1, argv + nargs + 1))
+		return;
 
 	do_call_p(fn, args[0], args[1], args[2]);
 }
@@ -475,12 +1512,27 @@ static const struct command commands[] = {
 	{ "wb", "address values", "Write one or more bytes", cmd_write },
 	{ "wh", "address values", "Write one or more half-words (16-bit)", cmd_write },
 	{ "ww", "address values", "Write one or more words (32-bit)", cmd_write },
+	{ "fb", "address count value [step]", "Fill bytes with a value, optionally incrementing", cmd_fill },
+	{ "fh", "address count value [step]", "Fill half-words with a value, optionally incrementing", cmd_fill },
+	{ "fw", "address count value [step]", "Fill words with a value, optionally incrementing", cmd_fill },
+	{ "mb", "address mask value", "Modify the masked bits of a byte", cmd_modify },
+	{ "mh", "address mask value", "Modify the masked bits of a half-word (16-bit)", cmd_modify },
+	{ "mw", "address mask value", "Modify the masked bits of a word (32-bit)", cmd_modify },
+	{ "pb", "address mask value", "Wait until the masked bits of a byte have a value", cmd_poll },
+	{ "ph", "address mask value", "Wait until the masked bits of a half-word (16-bit) have a value", cmd_poll },
+	{ "pw", "address mask value", "Wait until the masked bits of a word (32-bit) have a value", cmd_poll },
+	{ "bwr", "address length", "Write binary data, received in frames", cmd_bwrite },
+	{ "brd", "address length", "Read binary data, sent in frames", cmd_bread },
+	{ "unlz", "source length destination", "Decompress LZMA data", cmd_unlzma },
+	{ "crc", "address length [block]", "Calculate the CRC32 of a range, or of each block in it", cmd_crc },
 	{ "cb", "source destination count", "Copy one or more bytes", cmd_copy },
 	{ "ch", "source destination count", "Copy one or more half-words (16-bit)", cmd_copy },
 	{ "cw", "source destination count", "Copy one or more words (32-bit)", cmd_copy },
-	{ "sync", "", "Synchronize caches", cmd_sync },
-	{ "call", "address [up to 3 args]", "Call a function by address", cmd_call },
+	{ "sync", "[address length]...", "Synchronize caches, for all of RAM or the given ranges", cmd_sync },
+	{ "call", "address [up to 3 args] [/ [address length]...]", "Call a function by address, after synchronizing caches", cmd_call },
 	{ "src", "address", "Source/run script at address", cmd_src },
+	{ "flrd", "source destination length", "Read from flash", cmd_flash_read },
+	{ "flwr", "source destination length", "Write data to flash; destination must be 4k-aligned", cmd_flash_write },
 	{ "boot", "", "Continue with the usual boot flow", cmd_boot },
 };
 
@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: MIT
+# Record serial sessions with lolmon to compact binary traces, and replay them
+# to the unchanged Lolmon API, without a board.
+#
+# Usage: python3 ./trace.py summary session.trace
+#        python3 ./trace.py dump session.trace
+#
+# From Python:
+#
+#   l = interact.Lolmon(trace.record('/dev/ttyUSB0', 'session.trace'))
+#   ...
+#   l.s.close()
+#   l = interact.Lolmon(trace.ReplaySerial('session.trace', realtime=True))
+
+import argparse, bisect, collections, sys, time
+import interact
+
+# A trace starts with MAGIC, followed by events: a kind byte, the time since
+# the previous event in microseconds and the length of the data (both as
+# LEB128 varints), and the data.
+MAGIC = b'LOLTRACE1\n'
+TX, RX, NOTE, BAUD = range(4)
+KINDS = {TX: 'tx', RX: 'rx', NOTE: 'note', BAUD: 'baud'}
+
+class TraceError(Exception):
+    pass
+
+class ReplayDivergence(Exception):
+    """The host sent something else than in the recorded session"""
+    pass
+
+def varint(x):
+    out = bytearray()
+    while x >= 0x80:
+        out.append(x & 0x7f | 0x80)
+        x >>= 7
+    out.append(x)
+    return out
+
+def read_varint(data, pos):
+    x = shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        x |= (b & 0x7f) << shift
+        shift += 7
+        if b < 0x80:
+            return x, pos
+
+def load(path):
+    """Read a trace, as a list of (seconds since the start, kind, data)"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    if not data.startswith(MAGIC):
+        raise TraceError(f'{path} is not a lolmon trace')
+
+    events = []
+    pos = len(MAGIC)
+    t = 0
+    try:
+        while pos < len(data):
+            kind = data[pos]
+            delta, pos = read_varint(data, pos + 1)
+            length, pos = read_varint(data, pos)
+            if pos + length > len(data):
+                break
+            t += delta
+            events.append((t / 1e6, kind, data[pos:pos+length]))
+            pos += length
+    except IndexError:
+        pass    # cut off in the middle of an event, e.g. by a crash while recording
+    return events
+
+
+class RecordingSerial:
+    """Wraps a serial port and records everything that goes over it"""
+    def __init__(self, port, path):
+        self.port = port
+        self.name = port.name
+        self.f = open(path, 'wb')
+        self.f.write(MAGIC)
+        self.last = time.monotonic()
+        self.event(BAUD, str(port.baudrate).encode())
+
+    def event(self, kind, data):
+        delta = round((time.monotonic() - self.last) * 1e6)
+        self.last += delta / 1e6
+        self.f.write(bytes([kind]) + varint(delta) + varint(len(data)) + data)
+
+    def note(self, text):
+        self.event(NOTE, bytes(text))
+
+    @property
+    def baudrate(self):
+        return self.port.baudrate
+
+    @baudrate.setter
+    def baudrate(self, baud):
+        self.event(BAUD, str(baud).encode())
+        self.port.baudrate = baud
+
+    @property
+    def timeout(self):
+        return self.port.timeout
+
+    @timeout.setter
+    def timeout(self, timeout):
+        self.port.timeout = timeout
+
+    @property
+    def in_waiting(self):
+        return self.port.in_waiting
+
+    def write(self, data):
+        self.event(TX, bytes(data))
+        return self.port.write(data)
+
+    def read(self, n=1):
+        data = self.port.read(n)
+        if data:
+            self.event(RX, data)
+        return data
+
+    def readinto(self, buf):
+        n = self.port.readinto(buf)
+        if n:
+            self.event(RX, bytes(buf[:n]))
+        return n
+
+    def read_all(self):
+        data = self.port.read_all()
+        if data:
+            self.event(RX, data)
+        return data
+
+    def fileno(self):
+        return self.port.fileno()
+
+    def close(self):
+        self.port.close()
+        self.f.close()
+
+def record(device, path):
+    """Open a serial port like Lolmon does, and record the session to path"""
+    return RecordingSerial(interact.open_serial(device), path)
+
+
+class ReplaySerial:
+    """Serves a recorded session to Lolmon in place of a serial port.
+
+    Received data is handed out once the host has sent everything that
+    preceded it in the recording: right away, or after the recorded delay
+    with realtime=True. What the host sends is checked against the
+    recording, so that a changed script shows up as a ReplayDivergence.
+    Sessions with random content (e.g. Lolmon.stress_test) can't be replayed.
+    """
+    def __init__(self, path, realtime=False, timeout=0.2):
+        self.name = path
+        self.realtime = realtime
+        self.timeout = timeout
+        self.baudrate = None
+
+        # Each received piece of data waits for the bytes sent before it
+        tx = bytearray()
+        self.rx = []    # (bytes sent before, recorded delay, data)
+        last = 0
+        for t, kind, data in load(path):
+            if kind == TX:
+                tx += data
+            elif kind == RX:
+                self.rx.append((len(tx), t - last, data))
+            elif kind == BAUD and self.baudrate is None:
+                self.baudrate = int(data)
+            if kind in (TX, RX):
+                last = t
+        self.tx = bytes(tx)
+        self.baudrate = self.baudrate or 115200
+
+        self.tx_pos = 0
+        self.tx_times = [(0, time.monotonic())]     # (bytes sent so far, when)
+        self.rx_index = 0
+        self.rx_offset = 0
+        self.rx_due = None
+        self.last_due = time.monotonic()
+
+    def done(self):
+        """Whether the whole session has been replayed"""
+        return self.tx_pos == len(self.tx) and self.rx_index == len(self.rx)
+
+    def due(self):
+        # When the next received data is due, or None if the host has yet to send what preceded it
+        if self.rx_index == len(self.rx):
+            return None
+        gate, delay, _ = self.rx[self.rx_index]
+        if gate > self.tx_pos:
+            return None
+        if not self.realtime:
+            return 0
+        if self.rx_due is None:
+            sent = self.tx_times[bisect.bisect_left(self.tx_times, (gate,))][1]
+            self.rx_due = max(sent, self.last_due) + delay
+        return self.rx_due
+
+    def take(self, n):
+        out = bytearray()
+        now = time.monotonic()
+        while len(out) < n:
+            due = self.due()
+            if due is None or due > now:
+                break
+            data = self.rx[self.rx_index][2]
+            chunk = data[self.rx_offset:self.rx_offset + n - len(out)]
+            out += chunk
+            self.rx_offset += len(chunk)
+            if self.rx_offset == len(data):
+                self.rx_index += 1
+                self.rx_offset = 0
+                self.last_due = max(self.last_due, due)
+                self.rx_due = None
+        return bytes(out)
+
+    @property
+    def in_waiting(self):
+        # Only the next piece of received data counts, which is enough of a hint
+        due = self.due()
+        if due is None or due > time.monotonic():
+            return 0
+        return len(self.rx[self.rx_index][2]) - self.rx_offset
+
+    def write(self, data):
+        data = bytes(data)
+        expected = self.tx[self.tx_pos:self.tx_pos + len(data)]
+        if data != expected:
+            raise ReplayDivergence(f'At byte {self.tx_pos} sent: expected {expected!r}, got {data!r}')
+        self.tx_pos += len(data)
+        self.tx_times.append((self.tx_pos, time.monotonic()))
+        return len(data)
+
+    def read(self, n=1):
+        deadline = time.monotonic() + (self.timeout or 0)
+        out = bytearray()
+        while True:
+            out += self.take(n - len(out))
+            now = time.monotonic()
+            if len(out) == n or now >= deadline:
+                return bytes(out)
+            due = self.due()
+            if due is None:
+                # Nothing arrives before the host sends more; only wait out the timeout for real
+                if self.realtime:
+                    time.sleep(deadline - now)
+                return bytes(out)
+            time.sleep(max(0, min(due, deadline) - now))
+
+    def readinto(self, buf):
+        data = self.read(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+    def read_all(self):
+        return self.take(self.in_waiting)
+
+    def fileno(self):
+        raise TraceError('Replayed sessions have no file descriptor')
+
+    def close(self):
+        pass
+
+
+def summarize(events):
+    """Split the session time per command verb into serial wait (the gaps
+    before data was received) and host time (the gaps before data was sent)"""
+    stats = collections.defaultdict(collections.Counter)
+    verb = '(start)'
+    last = 0
+    for t, kind, data in events:
+        s = stats[verb]
+        if kind == RX:
+            s['wait'] += t - last
+            s['rx'] += len(data)
+        else:
+            s['host'] += t - last
+        if kind == TX:
+            s['tx'] += len(data)
+        if kind == NOTE:
+            verb = data.split(b' ')[0].decode('UTF-8', errors='replace') or '(empty)'
+            stats[verb]['count'] += 1
+        last = t
+    return stats
+
+def print_summary(events):
+    stats = summarize(events)
+    print(f'{"verb":8} {"count":>7} {"wait s":>9} {"host s":>9} {"tx bytes":>10} {"rx bytes":>10}')
+    for verb, s in sorted(stats.items(), key=lambda item: -(item[1]['wait'] + item[1]['host'])):
+        print(f'{verb:8} {s["count"]:7} {s["wait"]:9.3f} {s["host"]:9.3f} {s["tx"]:10} {s["rx"]:10}')
+    wait = sum(s['wait'] for s in stats.values())
+    host = sum(s['host'] for s in stats.values())
+    total = max(wait + host, 1e-9)
+    print(f'{total:.3f} s in total: {wait:.3f} s ({wait / total:.0%}) waiting for serial data, '
+          f'{host:.3f} s ({host / total:.0%}) on the host side')
+
+def print_events(events):
+    for t, kind, data in events:
+        print(f'{t:12.6f} {KINDS.get(kind, kind):4} {data!r}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Inspect recorded lolmon sessions')
+    parser.add_argument('action', choices=['summary', 'dump'], help='what to show')
+    parser.add_argument('trace', help='trace file')
+    args = parser.parse_args()
+
+    events = load(args.trace)
+    if args.action == 'summary':
+        print_summary(events)
+    else:
+        print_events(events)
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: MIT
+# Build all modified flash images from a flash dump in one go: boot2 is
+# extracted and patched once, each program is compressed once, and each
+# image is a (reflinked, where possible) copy of the dump with only the boot2
+# slots rewritten. Outputs whose inputs haven't changed are skipped.
+import argparse, fcntl, hashlib, importlib, json, mmap, os, shutil, sys
+from concurrent.futures import ThreadPoolExecutor
+
+extract_boot2 = importlib.import_module('extract-boot2')
+inject_boot2 = importlib.import_module('inject-boot2')
+patch_ecos = importlib.import_module('patch-ecos')
+MAIN, RECOVERY = inject_boot2.MAIN, inject_boot2.RECOVERY
+
+FICLONE = 0x40049409
+STATE = '.build-flash.json'
+
+# Output: (dependencies, a program, or the programs to put into a copy of the dump)
+OUTPUTS = {
+    'boot2-ecos.bin':            (['dump'], 'boot2'),
+    'boot2-ecos-mon.bin':        (['dump', 'monitor'], 'ecos-mon'),
+    'flash-mon.bin':             (['dump', 'monitor'], {MAIN: 'monitor'}),
+    'flash-ecos-mon.bin':        (['dump', 'monitor'], {MAIN: 'ecos-mon'}),
+    'flash-ecos-mon-double.bin': (['dump', 'monitor'], {MAIN: 'ecos-mon', RECOVERY: 'ecos-mon'}),
+}
+
+def uses(name):
+    """The programs that an output consists of"""
+    contents = OUTPUTS[name][1]
+    return {contents} if isinstance(contents, str) else set(contents.values())
+
+def file_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+def tools_hash():
+    # Changes to the tools themselves invalidate all outputs
+    h = hashlib.sha256()
+    for module in (sys.modules[__name__], extract_boot2, inject_boot2, patch_ecos):
+        with open(module.__file__, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+def copy_file(src, dest):
+    """Copy src (an open file) to dest: as a reflink where the filesystem
+    supports it, otherwise with copy_file_range, which keeps the copy in
+    the kernel, or a plain copy"""
+    with open(dest, 'wb') as d:
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, src.fileno())
+            return
+        except OSError:
+            pass
+        size = os.fstat(src.fileno()).st_size
+        try:
+            pos = 0
+            while pos < size:
+                n = os.copy_file_range(src.fileno(), d.fileno(), size - pos, pos, pos)
+                if n == 0:
+                    break
+                pos += n
+            return
+        except (OSError, AttributeError):
+            pass
+        src.seek(0)
+        d.seek(0)
+        d.truncate()
+        shutil.copyfileobj(src, d)
+
+def build(args):
+    os.makedirs(args.output, exist_ok=True)
+    state_path = os.path.join(args.output, STATE)
+    try:
+        with open(state_path) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        state = {}
+
+    with open(args.dump, 'rb') as dump, \
+         mmap.mmap(dump.fileno(), 0, access=mmap.ACCESS_READ) as m, \
+         open(args.monitor, 'rb') as f:
+        monitor = f.read()
+        tools = tools_hash()
+        hashes = dict(dump=file_hash(m), monitor=file_hash(monitor))
+        keys = {name: file_hash(json.dumps([tools] + [hashes[d] for d in deps]).encode())
+                for name, (deps, _) in OUTPUTS.items()}
+        outdated = [name for name in OUTPUTS
+                    if state.get(name) != keys[name] or not os.path.exists(os.path.join(args.output, name))]
+        for name in OUTPUTS:
+            if name not in outdated:
+                os.utime(os.path.join(args.output, name))    # so that make sees them as up to date
+        if not outdated:
+            print('All outputs are up to date.')
+            return
+
+        # Extract and patch only what the outdated outputs need. Outputs that
+        # don't depend on a program that failed are built all the same.
+        needed = set().union(*(uses(name) for name in outdated))
+        programs = {'monitor': monitor}
+        if needed & {'boot2', 'ecos-mon'}:
+            try:
+                programs['boot2'] = b''.join(extract_boot2.decompress(m, MAIN))
+            except (extract_boot2.ExtractError, ValueError) as e:
+                print(f'Error: extracting boot2: {e}')
+        if 'ecos-mon' in needed and 'boot2' in programs:
+            ecos_mon = bytearray(programs['boot2'])
+            try:
+                patch_ecos.patch_ecos(ecos_mon, monitor)
+                programs['ecos-mon'] = bytes(ecos_mon)
+            except ValueError as e:
+                print(f'Error: patching eCos: {e}')
+        failed = [name for name in outdated if not uses(name) <= programs.keys()]
+        outdated = [name for name in outdated if name not in failed]
+
+        compress = {p for name in outdated if isinstance(OUTPUTS[name][1], dict)
+                      for p in OUTPUTS[name][1].values()}
+        with ThreadPoolExecutor(max(1, len(compress))) as pool:
+            compressed = dict(zip(compress, pool.map(lambda p: inject_boot2.compress_cached(programs[p]), compress)))
+        for p in compress:
+            inject_boot2.check_fits(p, compressed[p])
+
+        for name in outdated:
+            path = os.path.join(args.output, name)
+            contents = OUTPUTS[name][1]
+            if isinstance(contents, str):
+                with open(path + '.tmp', 'wb') as f:
+                    f.write(programs[contents])
+            else:
+                copy_file(dump, path + '.tmp')
+                with open(path + '.tmp', 'rb+') as f:
+                    for offset, p in contents.items():
+                        inject_boot2.inject(f, offset, p, programs[p], compressed[p])
+            os.replace(path + '.tmp', path)
+            print(f'Built {name}')
+
+            state[name] = keys[name]
+            with open(state_path, 'w') as f:
+                json.dump(state, f, indent=1)
+
+    if failed:
+        print(f'Not built: {", ".join(failed)}')
+        sys.exit(1)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build all modified flash images from a flash dump')
+    parser.add_argument('dump', help='original flash dump')
+    parser.add_argument('monitor', help='monitor program')
+    parser.add_argument('--output', '-o', default='.', help='output directory')
+    args = parser.parse_args()
+    try:
+        build(args)
+    except (extract_boot2.ExtractError, ValueError) as e:
+        print(f'Error: {e}')
+        sys.exit(1)
@@ -1,50 +1,252 @@
 #!/usr/bin/env python3
 # SPDX-License-Identifier: MIT
-import sys, argparse
+# Decode rb/rh/rw output from lolmon, as captured from the console, into a
+# binary file. The capture is streamed in blocks; runs of consecutive lines
+# are converted with one bytes.fromhex call, and the output file is mapped
+# into memory. Gaps and conflicting overlaps are reported on stderr.
+import sys, argparse, array, bisect, collections, mmap, re
+from concurrent.futures import ProcessPoolExecutor
 
-def decode(args):
-    if args.file:   i = open(args.file, 'rb')
-    else:           i = sys.stdin.buffer.raw
-    if args.output: o = open(args.output, 'wb')
-    else:           o = sys.stdout.buffer.raw
+BLOCK_SIZE = 4 << 20
+COMMAND = re.compile(r'^> r([bhw]) ([0-9a-fA-F]+)')
+LINE = re.compile(rb'^([0-9a-fA-F]{8}): ([0-9a-fA-F ]+)\r?$', re.M)
+ARRAY_TYPE = {2: 'H', 4: 'I'}
+
+def unswap(data, width):
+    # Values are printed most significant digit first, but stored little-endian
+    if width in ARRAY_TYPE:
+        a = array.array(ARRAY_TYPE[width], data)
+        a.byteswap()
+        data = a.tobytes()
+    return data
+
+def decode_block(block):
+    """Decode a block of complete lines into a list of (address, data) runs"""
+    runs = []
+    start = end = width = None
+    texts = []
+
+    def finish():
+        if texts:
+            try:
+                runs.append((start, unswap(bytes.fromhex(b' '.join(texts).decode()), width)))
+            except ValueError:
+                # A mangled line somewhere in the run; decode line by line to skip it
+                a = start
+                for t in texts:
+                    try:
+                        runs.append((a, unswap(bytes.fromhex(t.decode()), width)))
+                    except ValueError:
+                        pass
+                    a += (len(t) + 1) // (width * 2 + 1) * width
+        texts.clear()
+
+    for addr, text in LINE.findall(block):
+        addr = int(addr, 16)
+        text = text.rstrip()
+        w = text.find(b' ')
+        w = len(text) if w < 0 else w
+        if w not in (2, 4, 8) or (len(text) + 1) % (w + 1):
+            continue
+        w //= 2
+        if addr != end or w != width:
+            finish()
+            start = addr
+            width = w
+            end = addr
+        texts.append(text)
+        end += (len(text) + 1) // (w * 2 + 1) * w
+    finish()
+    return runs
+
+def read_blocks(i):
+    rest = b''
+    while True:
+        block = i.read(BLOCK_SIZE)
+        if not block:
+            break
+        block = rest + block
+        cut = block.rfind(b'\n') + 1
+        rest = block[cut:]
+        if cut:
+            yield block[:cut]
+    if rest:
+        yield rest
+
+
+class Coverage:
+    """Sorted, merged list of [start, end) ranges that have been written"""
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+
+    def add(self, start, end):
+        # Returns the parts of [start, end) that were already covered
+        i = bisect.bisect_left(self.ends, start)
+        j = i
+        overlaps = []
+        new_start, new_end = start, end
+        while j < len(self.starts) and self.starts[j] <= end:
+            s, e = self.starts[j], self.ends[j]
+            if s < end and e > start:
+                overlaps.append((max(s, start), min(e, end)))
+            new_start = min(new_start, s)
+            new_end = max(new_end, e)
+            j += 1
+        self.starts[i:j] = [new_start]
+        self.ends[i:j] = [new_end]
+        return overlaps
+
+    def gaps(self, start, end):
+        pos = start
+        for s, e in zip(self.starts, self.ends):
+            if s > pos:
+                yield pos, min(s, end)
+            pos = max(pos, e)
+            if pos >= end:
+                return
+        if pos < end:
+            yield pos, end
+
+
+class Image:
+    """The output, memory-mapped if it is a file, and grown as needed"""
+    def __init__(self, f, size=0):
+        self.f = f
+        self.size = 0
+        self.end = 0
+        self.buf = None
+        if f is None:
+            self.buf = bytearray()
+        self.grow(size)
 
-    base = 0x80000180
-    seen_command = False
+    def grow(self, size):
+        if size <= self.size:
+            return
+        size = max(size, 2 * self.size)
+        if self.f is None:
+            self.buf += bytes(size - self.size)
+        else:
+            if self.buf is not None:
+                self.buf.close()
+            self.f.truncate(size)
+            self.buf = mmap.mmap(self.f.fileno(), size)
+        self.size = size
 
-    program = bytearray()
+    def write(self, offset, data):
+        self.grow(offset + len(data))
+        self.buf[offset:offset+len(data)] = data
+        self.end = max(self.end, offset + len(data))
+
+    def close(self, length):
+        if self.f is None:
+            out = sys.stdout.buffer
+            out.write(memoryview(self.buf)[:length])
+            out.flush()
+            return
+        if self.buf is None:
+            # Nothing was ever written, so nothing is mapped
+            self.f.truncate(length)
+            self.f.close()
+            return
+        self.buf.flush()
+        self.buf.close()
+        self.f.truncate(length)
+        self.f.close()
+
+
+def read_header(i):
+    # Skip the boot log up to the first rb/rh/rw command, noting the
+    # uncompressed program length (unOrgLen) along the way
     length = None
     for line in i:
         line = line.decode('ascii', errors='replace').strip()
-        if seen_command:
-            try:
-                addr, data = line.split(':')
-                addr = int(addr, 16)
-            except:
-                continue
-            if addr < base:
-                continue
-
-            for i, x in enumerate(data.strip().split(' ')):
-                a = addr + 4*i
-                x = int(x, 16)
-                program[a-base:a-base+4] = x.to_bytes(4, 'little')
-
+        m = COMMAND.match(line)
+        if m:
+            return int(m.group(2), 16), length
         elif 'unOrgLen:' in line:
             length = int(line.split(':')[3].split('<')[0])
-            program = bytearray(length)
+    return None, length
 
-        elif line.startswith('> rw'):
-            seen_command = True
+def hexrange(start, end):
+    return f'{start:08x}-{end:08x} ({end - start} bytes)'
 
-    if length:
-        o.write(program[:length])
+def decode(args):
+    if args.file:   i = open(args.file, 'rb')
+    else:           i = sys.stdin.buffer
+    if args.output: o = open(args.output, 'w+b')
+    else:           o = None
+
+    command_base, length = read_header(i)
+    if command_base is None:
+        print('No rb/rh/rw command found', file=sys.stderr)
+        sys.exit(1)
+    base = args.base if args.base is not None else command_base
+    if args.length is not None:
+        length = args.length
+    limit = base + length if length else 1 << 32
+
+    image = Image(o, length or 0)
+    coverage = Coverage()
+    conflicts = []
+    overlapping = ignored = 0
+
+    def apply(runs):
+        nonlocal overlapping, ignored
+        for addr, data in runs:
+            end = addr + len(data)
+            if addr < base or end > limit:
+                # Clip to the program
+                start, stop = max(addr, base), min(end, limit)
+                ignored += len(data) - max(0, stop - start)
+                if start >= stop:
+                    continue
+                data = data[start-addr:stop-addr]
+                addr, end = start, stop
+            for s, e in coverage.add(addr, end):
+                overlapping += e - s
+                if image.buf[s-base:e-base] != data[s-addr:e-addr]:
+                    conflicts.append((s, e))
+            image.write(addr - base, data)
+
+    if args.jobs > 1:
+        # Keep only a few blocks in flight, rather than reading all of the input
+        with ProcessPoolExecutor(args.jobs) as pool:
+            queue = collections.deque()
+            for block in read_blocks(i):
+                queue.append(pool.submit(decode_block, block))
+                if len(queue) > 2 * args.jobs:
+                    apply(queue.popleft().result())
+            while queue:
+                apply(queue.popleft().result())
     else:
-        o.write(program)
-    o.flush()
+        for block in read_blocks(i):
+            apply(decode_block(block))
+
+    end = base + (length or image.end)
+    if not image.end:
+        print('No data found after the rb/rh/rw command', file=sys.stderr)
+    for s, e in coverage.gaps(base, end):
+        print(f'Gap: {hexrange(s, e)}', file=sys.stderr)
+    for s, e in conflicts:
+        print(f'Conflicting data: {hexrange(s, e)}', file=sys.stderr)
+    if overlapping:
+        print(f'{overlapping} bytes were dumped more than once, {len(conflicts)} conflicting range(s)', file=sys.stderr)
+    if ignored:
+        print(f'Ignored {ignored} bytes outside of {hexrange(base, end)}', file=sys.stderr)
+
+    image.close(end - base)
+    if not image.end:
+        sys.exit(1)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Decode hexdump output from lolmon')
-    parser.add_argument('file', help='hexdump file')
-    parser.add_argument('--output', '-o', help='hexdump file')
+    parser.add_argument('file', help='hexdump file', nargs='?')
+    parser.add_argument('--output', '-o', help='output file (default: stdout)')
+    parser.add_argument('--base', '-b', type=lambda x: int(x, 16),
+                        help='address of the first output byte (default: from the first rb/rh/rw command)')
+    parser.add_argument('--length', '-l', type=lambda x: int(x, 0),
+                        help='length of the output (default: from unOrgLen, or up to the last byte dumped)')
+    parser.add_argument('--jobs', '-j', type=int, default=1, help='decode with a pool of this many processes')
     args = parser.parse_args()
     decode(args)
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 # SPDX-License-Identifier: MIT
-import argparse, hashlib, sys, os
+import argparse, hashlib, mmap, re, sys, os
+import sigcache
 
 class Blob:
     def __init__(self, offset, size, name):
@@ -37,29 +38,129 @@ BLOBS = {
     ]
 }
 
+# Images of other firmware revisions are scanned for the blobs, by signatures
+# of the blobs in the image above: the first and last bytes of each blob, with
+# its size and hash. The start of a blob is found by its first bytes, and its
+# end by its last bytes, so blobs that changed in size are found as well.
+# Blobs whose last bytes occur earlier in them get no tail, and are assumed
+# to have the known size.
+# SIGNATURES is generated from the known image with --signatures. Scan results
+# are cached per image in CACHE, along with signatures learned from the known
+# image on this machine, which are used for blobs that SIGNATURES lacks.
+SIGNATURE_LENGTH = 64
+SIGNATURES = {
+}
+CACHE = os.path.expanduser('~/.cache/msd7t75-blobs.json')
+
+def learn(data, blobs):
+    signatures = {}
+    for b in blobs:
+        blob = data[b.offset:b.offset+b.size]
+        head = bytes(blob[:SIGNATURE_LENGTH])
+        if data.find(head) != b.offset or data.find(head, b.offset + 1) >= 0:
+            print(f'Warning: the beginning of {b.name} is not unique, not using it as a signature', file=sys.stderr)
+            continue
+        signature = dict(head=head.hex(), size=b.size, sha256=hashlib.sha256(blob).hexdigest())
+        # scan() takes the first occurrence of the tail as the end, so it has to be that
+        tail = bytes(blob[-SIGNATURE_LENGTH:])
+        if data.find(tail, b.offset) == b.offset + b.size - len(tail):
+            signature['tail'] = tail.hex()
+        else:
+            print(f'Warning: the end of {b.name} occurs earlier in it, using its size instead', file=sys.stderr)
+        signatures[b.name] = signature
+    return signatures
+
+def scan(data, signatures):
+    """Find blobs by their signatures, in one pass over the data"""
+    by_head = {bytes.fromhex(s['head']): name for name, s in signatures.items()}
+    pattern = re.compile(b'|'.join(re.escape(head) for head in by_head))
+    blobs = []
+    found = set()
+    for m in pattern.finditer(data):
+        name = by_head[m.group()]
+        if name in found:
+            print(f'Warning: {name} found again at {m.start():08x}, ignoring')
+            continue
+        found.add(name)
+        s = signatures[name]
+
+        # The blob ends with the first occurrence of its last bytes, within twice the known size
+        tail = bytes.fromhex(s.get('tail', ''))
+        end = data.find(tail, m.start() + max(len(m.group()) - len(tail), 0), m.start() + 2 * s['size']) if tail else -1
+        if end >= 0:
+            size = end + len(tail) - m.start()
+        else:
+            size = min(s['size'], len(data) - m.start())
+            if tail:
+                print(f'Warning: the end of {name} at {m.start():08x} was not found, assuming the known size')
+        if size != s['size']:
+            print(f'Note: {name} at {m.start():08x} is {size} bytes, the known version {s["size"]}')
+        elif hashlib.sha256(data[m.start():m.start()+size]).hexdigest() != s['sha256']:
+            print(f'Warning: {name} at {m.start():08x} differs from the known version')
+        blobs.append(Blob(m.start(), size, name))
+    for name in signatures.keys() - found:
+        print(f'Warning: {name} not found')
+    return blobs
+
+def print_signatures(args):
+    with open(args.file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        sha256 = hashlib.sha256(m).hexdigest()
+        if sha256 not in BLOBS:
+            print(f'Error: {args.file} is not a known image (SHA256 hash {sha256})', file=sys.stderr)
+            sys.exit(1)
+        signatures = learn(m, BLOBS[sha256])
+    print('SIGNATURES = {')
+    for name, s in signatures.items():
+        print(f"    {name!r}: dict(size={s['size']}, sha256={s['sha256']!r},")
+        print(f"        head={s['head']!r}" + (f",\n        tail={s['tail']!r})," if 'tail' in s else '),'))
+    print('}')
+
 def extract(args):
     os.makedirs(args.output, exist_ok=True)
+    cache = sigcache.load(CACHE)
 
-    with open(args.file, 'rb') as f:
-        data = f.read()
-        sha256 = hashlib.sha256(data).digest().hex()
+    with open(args.file, 'rb') as f, \
+         mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m, memoryview(m) as data:
+        sha256 = hashlib.sha256(data).hexdigest()
 
-    if sha256 not in BLOBS:
-        print(f'Unknown input file (SHA256 hash {sha256})')
-        sys.exit(1)
+        if sha256 in BLOBS:
+            blobs = BLOBS[sha256]
+            if not all(b.name in SIGNATURES or b.name in cache['signatures'] for b in blobs):
+                cache['signatures'] = learn(m, blobs)
+                sigcache.save(CACHE, cache)
+        if args.scan or sha256 not in BLOBS:
+            signatures = {**cache['signatures'], **SIGNATURES}
+            if sha256 in cache['images'] and not args.scan:
+                blobs = [Blob(*b) for b in cache['images'][sha256]]
+            elif signatures:
+                print(f'Unknown input file (SHA256 hash {sha256}), scanning for blobs')
+                blobs = scan(m, signatures)
+                cache['images'][sha256] = [(b.offset, b.size, b.name) for b in blobs]
+                sigcache.save(CACHE, cache)
+            else:
+                print(f'Unknown input file (SHA256 hash {sha256}), and no signatures to scan for. '
+                      'Generate them from the known image with --signatures, and add them to SIGNATURES.')
+                sys.exit(1)
 
-    blobs = BLOBS[sha256]
-    print(f'Found {len(blobs)} blobs.')
+        print(f'Found {len(blobs)} blobs.')
 
-    for b in blobs:
-        print(f'Extracting {b.offset:08x}:{b.size:08x} {b.name}.')
-        with open(f'{args.output}/{b.name}', 'wb') as f:
-            f.write(data[b.offset:b.offset+b.size])
-            f.close()
+        for b in blobs:
+            print(f'Extracting {b.offset:08x}:{b.size:08x} {b.name}.')
+            with open(f'{args.output}/{b.name}', 'wb') as f:
+                f.write(data[b.offset:b.offset+b.size])
+                f.close()
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Extract blobs (peripheral firmware) from the Irdeto application image')
     parser.add_argument('file', help='application image file')
-    parser.add_argument('--output', '-o', help='output directory', required=True)
+    parser.add_argument('--output', '-o', help='output directory')
+    parser.add_argument('--scan', action='store_true', help='scan for blobs even if the image is known')
+    parser.add_argument('--signatures', action='store_true',
+                        help='print the signatures of the blobs in the known image, for SIGNATURES')
     args = parser.parse_args()
-    extract(args)
+    if args.signatures:
+        print_signatures(args)
+    elif args.output:
+        extract(args)
+    else:
+        parser.error('the output directory is required')
@@ -1,25 +1,111 @@
 #!/usr/bin/env python3
 # SPDX-License-Identifier: MIT
-import argparse, lzma
+import argparse, hashlib, importlib, lzma, mmap, sys
+from contextlib import nullcontext
+
+# The header format is defined along with the code that writes it
+Header = importlib.import_module('inject-boot2').Header
+ECOS_SHA256 = importlib.import_module('patch-ecos').ECOS_SHA256
+
+MAIN = 0x20000
+RECOVERY = 0x720000
+CHUNK_SIZE = 256 << 10
+
+class ExtractError(Exception):
+    pass
+
+def decompress(data, offset):
+    """Decompress the copy of boot2 at offset in chunks, bounded by its header.
+    The header is followed by 0x100 bytes of padding, and then the LZMA stream;
+    the sizes in the header include the 0x100 bytes."""
+    header = Header.parse(data[offset:offset+Header.sizeof()])
+    pos = offset + 0x100
+    end = offset + header.comp_size
+    size = header.uncomp_size - 0x100
+    if end > len(data):
+        raise ExtractError(f'boot2 @ {offset:#x}: compressed size {header.comp_size:#x} exceeds the image')
+
+    d = lzma.LZMADecompressor(format=lzma.FORMAT_ALONE)
+    total = 0
+    try:
+        while not d.eof:
+            if d.needs_input:
+                if pos == end:
+                    raise ExtractError(f'boot2 @ {offset:#x}: LZMA stream exceeds compressed size {header.comp_size:#x}')
+                chunk = data[pos:min(pos+CHUNK_SIZE, end)]
+                pos += len(chunk)
+            else:
+                chunk = b''
+            out = d.decompress(chunk, max_length=CHUNK_SIZE)
+            total += len(out)
+            if total > size:
+                raise ExtractError(f'boot2 @ {offset:#x}: more than {size:#x} bytes, as given in the header')
+            yield out
+    except lzma.LZMAError as e:
+        raise ExtractError(f'boot2 @ {offset:#x}: {e}')
+    if total != size:
+        print(f'Warning: boot2 @ {offset:#x} is {total:#x} bytes, but the header says {size:#x}')
 
 def extract(args):
-    with open(args.image, 'rb') as f:
-        data = f.read()
-    a = lzma.decompress(data[0x20100:])
-    b = lzma.decompress(data[0x720100:])
+    with open(args.image, 'rb') as f, \
+         mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data, \
+         open(args.main, 'wb') as a, \
+         (open(args.recovery, 'wb') if args.recovery else nullcontext()) as b:
+        main = decompress(data, MAIN)
+        recovery = decompress(data, RECOVERY)
 
-    if not args.recovery and a != b:
-        print('Warning: main and recovery copies of boot2 are different! Extracting main only.')
+        # Decompress both copies in lockstep, comparing until the first difference.
+        # Without an output file for the recovery copy, it is not needed after that.
+        def next_recovery():
+            try:
+                other = next(recovery, None)
+            except ExtractError as e:
+                if b:
+                    raise
+                print(f'Warning: {e}')
+                return None
+            if other is not None and b:
+                b.write(other)
+            return other
 
-    with open(args.main, 'wb') as f:
-        f.write(a)
-        f.close()
+        pa, pb = bytearray(), bytearray()   # output of each copy, not yet compared
+        compared = 0
+        same = True
+        sha256 = hashlib.sha256()
+        for out in main:
+            a.write(out)
+            sha256.update(out)
+            if not same:
+                continue
+            pa += out
+            while len(pb) < len(pa):
+                other = next_recovery()
+                if other is None:
+                    break
+                pb += other
+            n = min(len(pa), len(pb))
+            if pa[:n] != pb[:n]:
+                compared += next(i for i in range(n) if pa[i] != pb[i])
+                same = False
+            elif n < len(pa):
+                compared += n
+                same = False
+            else:
+                del pa[:n], pb[:n]
+                compared += n
+        if same and (pb or next_recovery() is not None):
+            same = False
 
-    if args.recovery:
-        with open(args.recovery, 'wb') as f:
-            f.write(b)
-            f.close()
+        if sha256.hexdigest() == ECOS_SHA256:
+            print('boot2 is the known eCos image, which patch-ecos.py can patch.')
 
+        if not same and not b:
+            print(f'Warning: main and recovery copies of boot2 are different (from offset {compared:#x})! Extracting main only.')
+        elif not same:
+            print(f'Note: main and recovery copies of boot2 are different (from offset {compared:#x})')
+        if b:
+            for other in recovery:
+                b.write(other)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Extract boot2')
@@ -27,4 +113,8 @@ if __name__ == '__main__':
     parser.add_argument('main', help='filename of resulting program (main @ 0x20100)')
     parser.add_argument('recovery', help='filename of resulting program (recovery @ 0x720100)', nargs='?')
     args = parser.parse_args()
-    extract(args)
+    try:
+        extract(args)
+    except ExtractError as e:
+        print(f'Error: {e}')
+        sys.exit(1)
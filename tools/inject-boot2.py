@@ -1,14 +1,21 @@
 #!/usr/bin/env python3
 # SPDX-License-Identifier: MIT
-import argparse, lzma, struct
+import argparse, hashlib, json, lzma, os, struct, sys, tempfile, time
+from concurrent.futures import ThreadPoolExecutor
 from construct import *
 
 KiB = 1 << 10
 MiB = 1 << 20
 
-def compress_lzma(data):
+MAIN = 0x20000
+RECOVERY = 0x720000
+SLOT_SIZE = RECOVERY - MAIN
+FILTERS = [dict(id=lzma.FILTER_LZMA1, dict_size=1*MiB)]
+CACHE_DIR = os.path.expanduser('~/.cache/msd7t75-lzma')
+CACHE_SIZE = 64 * MiB  # least recently used entries are removed beyond this
+
+def compress_lzma(data, filters=FILTERS):
     # Compress data in LZMA "alone" format, and manually patch the uncompressed-length field
-    filters = [dict(id=lzma.FILTER_LZMA1, dict_size=1*MiB)]
     l = lzma.LZMACompressor(format=lzma.FORMAT_ALONE, filters=filters)
     out = l.compress(data)
     out += l.flush()
@@ -32,10 +39,94 @@ def human_size(size):
     b = ['B', 'KiB', 'MiB', 'GiB'][scale]
     return f'{round(size, 1)} {b}'
 
-def inject(f, offset, program):
-    with open(program, 'rb') as p:
-        uncompressed = p.read()
-        compressed = compress_lzma(uncompressed)
+def cache_path(data, filters):
+    key = hashlib.sha256(json.dumps(filters, sort_keys=True).encode() + data).hexdigest()
+    return os.path.join(CACHE_DIR, key + '.lzma')
+
+def read_cache(data, filters):
+    path = cache_path(data, filters)
+    try:
+        with open(path, 'rb') as f:
+            out = f.read()
+    except FileNotFoundError:
+        return None
+    # The modification time is the last use, for prune_cache
+    os.utime(path)
+    return out
+
+def prune_cache(max_size=CACHE_SIZE):
+    # Remove the least recently used entries, until the rest fits into max_size
+    entries = []
+    for entry in os.scandir(CACHE_DIR):
+        if entry.name.endswith('.lzma'):
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+def compress_cached(data, filters=FILTERS):
+    """compress_lzma, with the result cached on disk by input and filter settings"""
+    out = read_cache(data, filters)
+    if out is not None:
+        return out
+
+    out = compress_lzma(data, filters)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    # A temporary file per process, so that concurrent runs don't write into each other's
+    fd, tmp = tempfile.mkstemp(dir=CACHE_DIR, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(out)
+    os.replace(tmp, cache_path(data, filters))
+    prune_cache()
+    return out
+
+def candidate_filters():
+    # The dictionary size stays at 1 MiB, which the bootloader is known to
+    # handle. With it fixed, preset 9 only differs from 6 in the dictionary
+    # size, so only 6 and its extreme variant are worth trying.
+    for preset in (6, 6 | lzma.PRESET_EXTREME):
+        for lc, lp, pb in ((3, 0, 2), (0, 2, 2), (1, 2, 2)):
+            yield [dict(id=lzma.FILTER_LZMA1, preset=preset, dict_size=1*MiB, lc=lc, lp=lp, pb=pb)]
+
+def compress_smallest(data, name):
+    """Try several presets and literal/position settings, and return the smallest result"""
+    def attempt(filters):
+        out = read_cache(data, filters)
+        if out is not None:
+            return filters, out, None
+        start = time.monotonic()
+        out = compress_cached(data, filters)
+        return filters, out, time.monotonic() - start
+
+    with ThreadPoolExecutor(os.cpu_count()) as pool:
+        results = list(pool.map(attempt, candidate_filters()))
+
+    print(f'Compressing {name}: {human_size(len(data))}')
+    for filters, out, seconds in results:
+        fl = filters[0]
+        extreme = 'e' if fl['preset'] & lzma.PRESET_EXTREME else ''
+        took = 'cached' if seconds is None else f'in {seconds:6.2f} s'
+        print(f'  preset {fl["preset"] & ~lzma.PRESET_EXTREME}{extreme:1} lc={fl["lc"]} lp={fl["lp"]} pb={fl["pb"]}: '
+              f'{len(out):9} bytes {took}')
+    return min((out for _, out, _ in results), key=len)
+
+def check_fits(program, compressed, slot_size=SLOT_SIZE):
+    # Header, padding, LZMA stream, padding
+    if 0x100 + len(compressed) + 0x100 > slot_size:
+        print(f'Error: {program} doesn\'t fit into the slot of {human_size(slot_size)}')
+        sys.exit(1)
+
+def inject(f, offset, program, uncompressed, compressed):
     print(f'Injecting {program} into {f.name} @ {offset:#x}: {human_size(len(uncompressed))} -> {human_size(len(compressed))}')
 
     f.seek(offset)
@@ -51,15 +142,41 @@ def inject(f, offset, program):
     f.flush()
 
 def patch(args):
+    programs = [(MAIN, args.main)]
+    if args.recovery:
+        programs.append((RECOVERY, args.recovery))
+    inputs = {}
+    for _, program in programs:
+        with open(program, 'rb') as p:
+            inputs[program] = p.read()
+
+    # Identical programs are compressed once, different ones concurrently
+    unique = {}
+    for program, data in inputs.items():
+        unique.setdefault(data, program)
+    if args.smallest:
+        compress = lambda data: compress_smallest(data, unique[data])
+    else:
+        compress = compress_cached
+    with ThreadPoolExecutor(len(unique)) as pool:
+        compressed = dict(zip(unique, pool.map(compress, unique)))
+
+    for _, program in programs:
+        check_fits(program, compressed[inputs[program]], args.slot_size)
+
     with open(args.image, 'rb+') as f:
-        inject(f, 0x20000, args.main)
-        if args.recovery:
-            inject(f, 0x720000, args.recovery)
+        for offset, program in programs:
+            data = inputs[program]
+            inject(f, offset, program, data, compressed[data])
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Inject boot2 stage into a flash image')
     parser.add_argument('image', help='flash image')
     parser.add_argument('main', help='program to inject (main @ 0x20100)')
-    parser.add_argument('recovery', help='program to inject (recovery @ 0x720100)', nargs='?') # TODO
+    parser.add_argument('recovery', help='program to inject (recovery @ 0x720100)', nargs='?')
+    parser.add_argument('--smallest', action='store_true',
+                        help='try several compression settings, and use the smallest result')
+    parser.add_argument('--slot-size', type=lambda x: int(x, 0), default=SLOT_SIZE,
+                        help=f'space available for each copy (default: {SLOT_SIZE:#x})')
     args = parser.parse_args()
     patch(args)
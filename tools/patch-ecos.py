@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 # SPDX-License-Identifier: MIT
-import argparse, hashlib
+import argparse, hashlib, os, re, sys
+import sigcache
 from enum import Enum
 
 KiB = 1 << 10
@@ -43,41 +44,188 @@ class MIPSASM:
 
 
 BASE = 0x82000180
-
-def patch(args):
-    with open(args.program, 'rb') as f: prog = f.read()
-    with open(args.ecos, 'rb')    as f: ecos = bytearray(f.read())
-
-    if hashlib.sha256(ecos).digest().hex() != 'd8320d6b8d4f209b20bd217f19c5c0efde5a0488c243adb6dee531ed37764d99':
-        print('WARNING! eCos doesn\'t have the expected hash! You might run into problems.')
+ECOS_SHA256 = 'd8320d6b8d4f209b20bd217f19c5c0efde5a0488c243adb6dee531ed37764d99'
+
+# Patch sites, at their addresses in the known eCos build. In other builds,
+# they are located by signatures: the words around each site, as hex, with ?
+# for any nibble, e.g. '27bdffe0 0c?????? 00000000'. The program is put into
+# the hideout, which lies in padding between sections; in other builds, it is
+# located by the signature of the start of that padding. SIGNATURES is
+# generated from the known build with --signatures (or written by hand).
+# Resolved sites are cached per image in CACHE, along with signatures learned
+# from the known build on this machine, which are used if SIGNATURES is empty.
+SITES = {
+    'entry':       0x82007280,
+    'ota_message': 0x82263090,  # otaTunerCallback
+    'app_return':  0x8205e7b4,  # don't return, jump to monitor
+    'sig_check':   0x82052330,  # after "Error: Signature verification failed!"
+}
+DATA_SITES = {'ota_message'}    # matched exactly, not as instructions
+HIDEOUT = 0x822ba000
+SIGNATURES = {                  # name: (signature, offset of the site in it)
+}
+SIGNATURE_BEFORE = 16
+SIGNATURE_AFTER = 16
+CACHE = os.path.expanduser('~/.cache/msd7t75-patch-sites.json')
+
+def instruction_mask(word):
+    # Mask out the parts of an instruction that change when code moves around:
+    # jump targets, upper address halves, branch offsets, and immediates that
+    # aren't relative to the stack pointer
+    op, rs = word >> 26, (word >> 21) & 31
+    if op in (0x02, 0x03):
+        return 0xfc000000
+    if op in (0x01, 0x04, 0x05, 0x06, 0x07, 0x0f, 0x14, 0x15, 0x16, 0x17):
+        return 0xffff0000
+    if op in (0x08, 0x09, 0x0d) or op >= 0x20:
+        return 0xffffffff if rs == MIPSASM.Reg.sp.value else 0xffff0000
+    return 0xffffffff
+
+def make_signature(ecos, addr, data=False):
+    offset = addr - BASE - SIGNATURE_BEFORE
+    words = []
+    for i in range(offset, offset + SIGNATURE_BEFORE + SIGNATURE_AFTER, 4):
+        word = int.from_bytes(ecos[i:i+4], 'little')
+        mask = 0xffffffff if data else instruction_mask(word)
+        words.append(''.join(f'{word:08x}'[n] if f'{mask:08x}'[n] == 'f' else '?' for n in range(8)))
+    return ' '.join(words), SIGNATURE_BEFORE
+
+def signature_regex(signature):
+    # Each word is stored little-endian; bytes with wildcards become character classes
+    out = []
+    for word in signature.split():
+        value = int(word.replace('?', '0'), 16)
+        mask = int(''.join('0' if c == '?' else 'f' for c in word), 16)
+        for i in range(4):
+            v, m = value >> 8 * i & 0xff, mask >> 8 * i & 0xff
+            if m == 0xff:
+                out.append(re.escape(bytes([v])))
+            elif m == 0:
+                out.append(b'.')
+            else:
+                out.append(b'[' + b''.join(re.escape(bytes([b])) for b in range(256) if b & m == v) + b']')
+    return b''.join(out)
+
+def locate(ecos, signatures):
+    """Find all patch sites in one pass, by their signatures"""
+    names = list(signatures)
+    pattern = re.compile(b'|'.join(b'(' + signature_regex(signatures[n][0]) + b')' for n in names), re.DOTALL)
+    found = {}
+    for m in pattern.finditer(ecos):
+        name = names[m.lastindex - 1]
+        if name in found:
+            raise ValueError(f'Patch site {name} is ambiguous')
+        found[name] = BASE + m.start() + signatures[name][1]
+    missing = set(signatures) - set(found)
+    if missing:
+        raise ValueError(f'Patch sites not found: {", ".join(sorted(missing))}')
+    return found
+
+def hideout_signature(ecos):
+    # The signature of the (word-aligned) start of the run of zeros that the hideout is in
+    start = HIDEOUT - BASE
+    while start > 0 and ecos[start - 1] == 0:
+        start -= 1
+    start = (start + 3) & ~3
+    signature, offset = make_signature(ecos, BASE + start)
+    return signature, offset + HIDEOUT - BASE - start
+
+def learn(ecos):
+    """The signatures of the patch sites and the hideout in the known build"""
+    signatures = {name: make_signature(ecos, addr, name in DATA_SITES) for name, addr in SITES.items()}
+    signatures['hideout'] = hideout_signature(ecos)
+    if locate(ecos, signatures) != {**SITES, 'hideout': HIDEOUT}:
+        raise ValueError('The signatures match in the wrong places')
+    return signatures
+
+def resolve(ecos, size):
+    """Find the patch sites and a hideout for a program of the given size"""
+    sha256 = hashlib.sha256(ecos).hexdigest()
+    cache = sigcache.load(CACHE)
+    if sha256 == ECOS_SHA256:
+        if not SIGNATURES and set(cache['signatures']) != set(SITES) | {'hideout'}:
+            try:
+                cache['signatures'] = learn(ecos)
+                sigcache.save(CACHE, cache)
+            except ValueError as e:
+                print(f'Warning: not learning the signatures of the patch sites: {e}')
+        return dict(SITES), HIDEOUT
+    if sha256 in cache['images'] and cache['images'][sha256]['size'] >= size:
+        return cache['images'][sha256]['sites'], cache['images'][sha256]['hideout']
+
+    print('WARNING! eCos doesn\'t have the expected hash! Locating the patch sites by their signatures.')
+    signatures = SIGNATURES or cache['signatures']
+    if set(signatures) != set(SITES) | {'hideout'}:
+        raise ValueError('No signatures for the patch sites. Generate them from the known eCos build '
+                         'with --signatures, and add them to SIGNATURES.')
+    sites = locate(ecos, signatures)
+    hideout = (sites.pop('hideout') + 0xfff) & ~0xfff   # page-aligned, as in the known build
+    room = ecos[hideout - BASE:hideout - BASE + size]
+    if len(room) < size or any(room):
+        raise ValueError(f'No room for {size} bytes of program in the padding at {hideout:#x}')
+    print('Found patch sites: ' + ', '.join(f'{n} @ {a:#x}' for n, a in sites.items()) +
+          f'; hideout @ {hideout:#x}')
+
+    cache['images'][sha256] = dict(sites=sites, hideout=hideout, size=size)
+    sigcache.save(CACHE, cache)
+    return sites, hideout
+
+def patch_ecos(ecos, prog):
+    """Patch eCos (a bytearray) in place, to jump to prog"""
+    sites, hideout = resolve(ecos, len(prog))
 
     #ecos += (16*MiB - len(ecos)) * b'\0'
 
     asm = MIPSASM(ecos, BASE)
 
-    hideout = 0x822ba000
     asm.goto(hideout)
     asm.write(prog)
 
-    asm.goto(0x82007280)
+    asm.goto(sites['entry'])
     asm.j(hideout)
 
-    asm.goto(0x82263090) # otaTunerCallback
+    asm.goto(sites['ota_message'])
     asm.write(b'[%s] jn was here\n\0')
-    asm.goto(0x8205e7b4) # don't return, jump to monitor
+    asm.goto(sites['app_return'])
     asm.j(hideout)
 
-    asm.goto(0x82052330) # after "Error: Signature verification failed!"
+    asm.goto(sites['sig_check'])
     asm.addi(asm.Reg.v0, asm.Reg.zero, 0) # ignore the error
 
+def patch(args):
+    with open(args.program, 'rb') as f: prog = f.read()
+    with open(args.ecos, 'rb')    as f: ecos = bytearray(f.read())
+
+    patch_ecos(ecos, prog)
+
     with open(args.ecos, 'wb') as f:
         f.write(ecos)
         f.flush()
         f.close()
 
+def print_signatures(args):
+    with open(args.ecos, 'rb') as f: ecos = f.read()
+    if hashlib.sha256(ecos).hexdigest() != ECOS_SHA256:
+        raise ValueError(f'{args.ecos} is not the known eCos build')
+    print('SIGNATURES = {                  # name: (signature, offset of the site in it)')
+    for name, (signature, offset) in learn(ecos).items():
+        print(f'    {name!r}: ({signature!r}, {offset}),')
+    print('}')
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Patch eCos boot2 image to run custom code instead of jumping into the application')
     parser.add_argument('ecos', help='eCos program image')
-    parser.add_argument('program', help='program to inject')
+    parser.add_argument('program', help='program to inject', nargs='?')
+    parser.add_argument('--signatures', action='store_true',
+                        help='print the signatures of the patch sites in the known eCos build, for SIGNATURES')
     args = parser.parse_args()
-    patch(args)
+    if not args.signatures and not args.program:
+        parser.error('the program to inject is required')
+    try:
+        if args.signatures:
+            print_signatures(args)
+        else:
+            patch(args)
+    except ValueError as e:
+        print(f'Error: {e}')
+        sys.exit(1)
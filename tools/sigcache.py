@@ -0,0 +1,24 @@
+# SPDX-License-Identifier: MIT
+# The caches of the tools that find things in other firmware versions by
+# signature (extract-blobs.py, patch-ecos.py): signatures learned from the
+# known image, and the results per image, by SHA256. All of it can be found
+# again, so a cache that is missing or unreadable is simply empty.
+import json, os, tempfile
+
+def load(path):
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    cache.setdefault('signatures', {})
+    cache.setdefault('images', {})
+    return cache
+
+def save(path, cache):
+    # Replace the file atomically, so that concurrent runs don't see half of it
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'w') as f:
+        json.dump(cache, f, indent=1)
+    os.replace(tmp, path)